@@ -0,0 +1,102 @@
+"""
+Compares the in-memory channel layer with the broker layer ('chat.layers'):
+group_send throughput to a chamber-sized group and the group_send -> receive
+latency of a single event. The broker runs in its own process
+('manage.py runbroker'), and the broker layer's sender and receivers use
+separate connections, as two workers would.
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.channel_layers
+"""
+
+from statistics import median, quantiles
+from time import perf_counter
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from channels.layers import InMemoryChannelLayer
+from chat.events import chamber_event
+from chat.layers import BrokerChannelLayer
+
+
+CHAMBER_ID = "6f1c2f0e-8a4b-4f5e-9c1d-2b7a3e9d4c10"
+GROUP_SIZES = [10, 100, 500]
+EVENTS = 100
+LATENCY_ROUNDS = 500
+CAPACITY = EVENTS * 2
+
+
+async def throughput(sender, receiver, members):
+    channels = [await receiver.new_channel() for _ in range(members)]
+    for channel in channels:
+        await receiver.group_add("bench", channel)
+    event = chamber_event("chat.message", CHAMBER_ID, content="benchmark " * 10)
+
+    async def drain(channel):
+        for _ in range(EVENTS):
+            await receiver.receive(channel)
+
+    started = perf_counter()
+    drains = asyncio.gather(*(drain(channel) for channel in channels))
+    for _ in range(EVENTS):
+        await sender.group_send("bench", event)
+    await drains
+    elapsed = perf_counter() - started
+
+    for channel in channels:
+        await receiver.group_discard("bench", channel)
+    return EVENTS * members / elapsed
+
+
+async def latency(sender, receiver):
+    channel = await receiver.new_channel()
+    await receiver.group_add("latency", channel)
+    event = chamber_event("chat.message", CHAMBER_ID, content="ping")
+    samples = []
+    for _ in range(LATENCY_ROUNDS):
+        started = perf_counter()
+        await sender.group_send("latency", event)
+        await receiver.receive(channel)
+        samples.append(perf_counter() - started)
+    await receiver.group_discard("latency", channel)
+    return median(samples), quantiles(samples, n=100)[98]
+
+
+async def run(name, sender, receiver):
+    for members in GROUP_SIZES:
+        rate = await throughput(sender, receiver, members)
+        print(f"{name:>8} {members:>8} {rate:>14,.0f}")
+    p50, p99 = await latency(sender, receiver)
+    print(f"{name:>8} latency p50 {p50 * 1e6:.0f} us, p99 {p99 * 1e6:.0f} us")
+
+
+async def main(address):
+    print(f"{'layer':>8} {'members':>8} {'deliveries/s':>14}")
+    memory = InMemoryChannelLayer(capacity=CAPACITY)
+    await run("memory", memory, memory)
+
+    sender = BrokerChannelLayer(address, capacity=CAPACITY)
+    receiver = BrokerChannelLayer(address, capacity=CAPACITY)
+    await run("broker", sender, receiver)
+    await sender.close()
+    await receiver.close()
+
+
+if __name__ == "__main__":
+    address = f"unix://{tempfile.mkdtemp()}/broker.sock"
+    broker = subprocess.Popen(
+        [sys.executable, "manage.py", "runbroker", "--address", address],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        broker.stdout.readline()  # Listening
+        asyncio.run(main(address))
+    finally:
+        broker.terminate()
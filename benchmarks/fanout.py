@@ -0,0 +1,71 @@
+"""
+Compares the CPU cost of delivering one chamber event to every member:
+the event dict copied by the channel layer and 'json.dumps'-ed by each recipient's
+handler, as previously done by 'ChamberConsumer', against the event encoded once
+by 'chat.events.chamber_event' and forwarded as is.
+
+Both paths include the per-recipient copy the in-memory channel layer makes,
+and neither includes socket writes, which are the same for both.
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.fanout
+"""
+
+from copy import deepcopy
+from time import process_time
+import json
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from chat.events import chamber_event, encoded_events
+from chat.codecs import json_codec
+
+
+CHAMBER_ID = "6f1c2f0e-8a4b-4f5e-9c1d-2b7a3e9d4c10"
+CHAMBER_SIZES = [10, 100, 2000, 10000]
+CONTENT = {
+    "id": "0f8fad5b-d9cb-469f-a165-70867728950e",
+    "content": "See you all at the standup in five minutes. " * 4,
+    "sender": "precious",
+    "created": "Oct. 18, 2026",
+    "time": "9:41 a.m.",
+}
+
+
+def encode_per_recipient(members):
+    # Previous code path: each handler encodes its own copy of the event
+    event = {"type": "chat.message", **CONTENT}
+    for _ in range(members):
+        json.dumps(deepcopy(event))
+
+
+def encode_once(members):
+    event = chamber_event("chat.message", CHAMBER_ID, **CONTENT)
+    for _ in range(members):
+        encoded_events.encode(json_codec, deepcopy(event))
+
+
+def cpu_per_broadcast(function, members):
+    rounds = max(1, 20000 // members)
+    started = process_time()
+    for _ in range(rounds):
+        function(members)
+    return (process_time() - started) / rounds
+
+
+def main():
+    print(f"{'members':>8} {'per recipient':>16} {'encode once':>14} {'speedup':>9}")
+    for members in CHAMBER_SIZES:
+        before = cpu_per_broadcast(encode_per_recipient, members)
+        after = cpu_per_broadcast(encode_once, members)
+        print(
+            f"{members:>8} {before * 1e3:>13.2f} ms {after * 1e3:>11.2f} ms"
+            f" {before / after:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
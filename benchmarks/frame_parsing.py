@@ -0,0 +1,56 @@
+"""
+Compares the cost of parsing binary media frames:
+the delimiter scan-and-split used previously by 'ChamberConsumer.receive',
+against the length-prefixed header parsed with memoryview slices ('chat.frames').
+
+Run with: python -m benchmarks.frame_parsing
+"""
+
+from timeit import repeat
+import json
+
+from chat.frames import build_frame, parse_frame, LEGACY_DELIMITER
+
+
+SIZES = {
+    "100 KB": 100 * 1024,
+    "10 MB": 10 * 1024 * 1024,
+    "100 MB": 100 * 1024 * 1024,
+}
+METADATA = {"message_type": "video", "media_type": "video"}
+
+
+def parse_delimited_frame(bytes_data):
+    # Previous code path in 'ChamberConsumer.receive'
+    delimiter = b"<delimiter>"
+    if delimiter in bytes_data:
+        json_data, media_data = bytes_data.split(delimiter, 1)
+        metadata = json.loads(json_data.decode("utf-8"))
+        return metadata, media_data
+
+
+def best_of(function, frame, number):
+    return min(repeat(lambda: function(frame), number=number, repeat=5)) / number
+
+
+def main():
+    print(
+        f"{'frame size':>10} {'delimiter split':>18} {'length prefix':>16} {'speedup':>9}"
+    )
+    for label, size in SIZES.items():
+        # Media bytes that never contain the delimiter, so both paths are valid
+        payload = b"\x00" * size
+        legacy_frame = json.dumps(METADATA).encode() + LEGACY_DELIMITER + payload
+        frame = build_frame(METADATA, payload)
+        number = max(1, 2000 // (size // (100 * 1024)))
+
+        split_time = best_of(parse_delimited_frame, legacy_frame, number)
+        header_time = best_of(parse_frame, frame, number)
+        print(
+            f"{label:>10} {split_time * 1e6:>15.1f} us {header_time * 1e6:>13.1f} us"
+            f" {split_time / header_time:>8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares serializing a page of chamber history (1,000 messages, a tenth of them
+images) on SQLite: 'MessageSerializer' as it was (following 'sender' and 'chamber'
+for every row), 'MessageSerializer' as it is, and the 'values()'-based
+'MessageHistorySerializer', with and without the sender's username and avatar.
+Times include the query; the database is a temporary file.
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.history_serialization
+"""
+
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from chat.models import Chamber, Message
+from chat.serializers import MessageSerializer, MessageHistorySerializer
+from user.models import User
+
+
+MESSAGES = 1000
+ROUNDS = 5
+
+
+class PreviousMessageSerializer(MessageSerializer):
+    # Previous code path: each row loads its sender and chamber
+    def get_sender(self, obj):
+        return str(obj.sender.id)
+
+    def get_chamber(self, obj):
+        return str(obj.chamber.id)
+
+
+def measure(serialize, messages):
+    best = None
+    for _ in range(ROUNDS):
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as queries:
+            started = perf_counter()
+            serialize(messages.all())
+            elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(queries)
+
+
+def main(chamber):
+    messages = Message.objects.filter(chamber=chamber).order_by("-created", "-id")
+    paths = {
+        "MessageSerializer (previous)": lambda queryset: PreviousMessageSerializer(
+            queryset, many=True
+        ).data,
+        "MessageSerializer": lambda queryset: MessageSerializer(
+            queryset, many=True
+        ).data,
+        "MessageHistorySerializer": MessageHistorySerializer().serialize,
+        "  with sender": MessageHistorySerializer(include_sender=True).serialize,
+    }
+    print(f"{'serializer':>30} {'time':>10} {'queries':>8}")
+    for name, serialize in paths.items():
+        elapsed, queries = measure(serialize, messages)
+        print(f"{name:>30} {elapsed * 1e3:>7.1f} ms {queries:>8}")
+
+
+if __name__ == "__main__":
+    with TemporaryDirectory() as directory:
+        connection.settings_dict["TEST"]["NAME"] = str(
+            Path(directory) / "benchmark.sqlite3"
+        )
+        connection.creation.create_test_db(verbosity=0)
+        user = User.objects.create_user(
+            email="benchmark@example.com", password="Benchm4rk!"
+        )
+        chamber = Chamber.objects.create(chambername="benchmark", creator=user)
+        Message.objects.bulk_create(
+            Message(
+                text_content=f"message {i}" if i % 10 else "",
+                message_type="IMG" if i % 10 == 0 else "TXT",
+                image_content=f"images/media_{i}.png" if i % 10 == 0 else "",
+                sender=user,
+                chamber=chamber,
+                seq=i + 1,
+            )
+            for i in range(MESSAGES)
+        )
+        main(chamber)
@@ -0,0 +1,117 @@
+"""
+Compares random ('uuid4') and time-ordered ('chat.utils.uuid7') message ids on
+SQLite: insert throughput while the table grows to a few million rows, and the size
+of the primary key and chamber history indexes afterwards.
+Each id kind gets its own database file with the 'chat_message' table and indexes
+as Django creates them; rows are inserted in transactions of BATCH rows, spread
+over CHAMBERS chambers.
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.message_ids [rows]
+"""
+
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from datetime import datetime, timezone
+from pathlib import Path
+from uuid import uuid4
+import sqlite3
+import sys
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from django.db import connection
+
+from chat.models import Message
+from chat.utils import uuid7
+
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+BATCH = 10_000
+CHAMBERS = 100
+
+
+def message_table_sql():
+    with connection.schema_editor(collect_sql=True) as schema_editor:
+        schema_editor.create_model(Message)
+    return schema_editor.collected_sql
+
+
+def insert_rows(database, new_id):
+    chambers = [uuid4().hex for _ in range(CHAMBERS)]
+    sender = uuid4().hex
+    created = datetime.now(timezone.utc).isoformat(" ")
+    rates = []
+    for start in range(0, ROWS, BATCH):
+        rows = [
+            (
+                new_id().hex,
+                "TXT",
+                f"message {i}",
+                chambers[i % CHAMBERS],
+                sender,
+                created,
+                created,
+                i // CHAMBERS + 1,
+            )
+            for i in range(start, min(start + BATCH, ROWS))
+        ]
+        started = perf_counter()
+        with database:
+            database.executemany(
+                "INSERT INTO chat_message (id, message_type, text_content, "
+                "image_content, audio_content, video_content, is_reply, chamber_id, "
+                "sender_id, created, updated, seq) "
+                "VALUES (?, ?, ?, '', '', '', 0, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        rates.append(len(rows) / (perf_counter() - started))
+    return rates
+
+
+def index_sizes(database):
+    # Bytes per table/index, from SQLite's 'dbstat' virtual table ('id' is the
+    # first automatic index)
+    page_size = database.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        name: pages * page_size
+        for name, pages in database.execute(
+            "SELECT name, COUNT(*) FROM dbstat GROUP BY name"
+        )
+    }
+
+
+def main(directory):
+    table_sql = message_table_sql()
+    print(f"{ROWS:,} rows, {BATCH:,} rows per transaction\n")
+    print(
+        f"{'ids':>6} {'total':>9} {'rows/s':>9} {'last 10%':>9} "
+        f"{'primary key':>12} {'history idx':>12} {'file':>9}"
+    )
+    for name, new_id in (("uuid4", uuid4), ("uuid7", uuid7)):
+        path = Path(directory) / f"{name}.sqlite3"
+        database = sqlite3.connect(path)
+        for statement in table_sql:
+            database.execute(statement)
+        started = perf_counter()
+        rates = insert_rows(database, new_id)
+        elapsed = perf_counter() - started
+        sizes = index_sizes(database)
+        database.close()
+
+        tail = rates[-max(len(rates) // 10, 1) :]
+        print(
+            f"{name:>6} {elapsed:>7.1f} s {ROWS / elapsed:>9,.0f} "
+            f"{sum(tail) / len(tail):>9,.0f} "
+            f"{sizes['sqlite_autoindex_chat_message_1'] / 2**20:>9.1f} MB "
+            f"{sizes['chamber_history_idx'] / 2**20:>9.1f} MB "
+            f"{path.stat().st_size / 2**20:>6.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    with TemporaryDirectory() as directory:
+        main(directory)
@@ -0,0 +1,80 @@
+"""
+Compares chat message insert throughput on SQLite:
+one 'Message.objects.create' (plus the follow-up 'save()' of the reply/media paths)
+per message, as previously done by 'create_new_*' in 'chat.utils',
+against the group-commit writer ('chat.writer').
+
+Each run starts a number of concurrent senders (as separate consumers would),
+each writing the same number of messages. The database is a temporary file,
+so commit costs are real.
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.message_writer
+"""
+
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import asyncio
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from django.db import connection
+from asgiref.sync import sync_to_async
+
+from chat.models import Chamber, Message
+from chat.utils import create_new_message
+from user.models import User
+
+
+SENDERS = [1, 10, 100]
+MESSAGES = 2000
+
+
+@sync_to_async
+def create_message_per_transaction(content, user, chamber_id):
+    # Previous code path: one insert, then a second write to set the type
+    message = Message.objects.create(
+        text_content=content, sender=user, chamber_id=chamber_id
+    )
+    message.save()
+    return message.id, message.created
+
+
+async def run(create, senders, user, chamber_id):
+    per_sender = MESSAGES // senders
+
+    async def sender(number):
+        for i in range(per_sender):
+            await create(f"message {number}-{i}", user, chamber_id)
+
+    started = perf_counter()
+    await asyncio.gather(*(sender(number) for number in range(senders)))
+    return per_sender * senders / (perf_counter() - started)
+
+
+async def main(user, chamber_id):
+    print(f"{'senders':>8} {'per message':>16} {'group commit':>16} {'speedup':>9}")
+    for senders in SENDERS:
+        before = await run(create_message_per_transaction, senders, user, chamber_id)
+        after = await run(create_new_message, senders, user, chamber_id)
+        print(
+            f"{senders:>8} {before:>11.0f} msg/s {after:>11.0f} msg/s"
+            f" {after / before:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    with TemporaryDirectory() as directory:
+        connection.settings_dict["TEST"]["NAME"] = str(
+            Path(directory) / "benchmark.sqlite3"
+        )
+        connection.creation.create_test_db(verbosity=0)
+        user = User.objects.create_user(
+            email="benchmark@example.com", password="Benchm4rk!"
+        )
+        chamber = Chamber.objects.create(chambername="benchmark", creator=user)
+        asyncio.run(main(user, chamber.id))
@@ -0,0 +1,97 @@
+"""
+Compares delivering a burst of small chamber events to one connection as one
+websocket frame per event against opt-in micro-batched array frames ('chat.outbound').
+
+Frames are written to a real socket (drained by a reader thread), so each frame
+costs the syscall it would in production. Reports frames per second, events per
+second and CPU per event (process-wide, so including the reader).
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.outbound_batching
+"""
+
+from threading import Thread
+from time import perf_counter, process_time
+import asyncio
+import os
+import socket
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from django.test import override_settings
+from django.conf import settings
+
+from chat.codecs import json_codec
+from chat.events import chamber_event
+from chat.outbound import OutboundQueue
+
+
+CHAMBER_ID = "6f1c2f0e-8a4b-4f5e-9c1d-2b7a3e9d4c10"
+BURSTS = 200
+BURST_SIZE = 40  # Events arriving back to back
+BURST_INTERVAL = 0.005  # Seconds between bursts
+
+
+def drain(reader):
+    while reader.recv(1 << 20):
+        pass
+
+
+async def run(batching):
+    writer, reader = socket.socketpair()
+    Thread(target=drain, args=(reader,), daemon=True).start()
+    loop = asyncio.get_running_loop()
+    writer.setblocking(False)
+    frames = 0
+
+    async def send(data):
+        nonlocal frames
+        frames += 1
+        await loop.sock_sendall(writer, data.encode("utf-8"))
+
+    queue = OutboundQueue(send)
+    if batching:
+        queue.enable_batching(json_codec.encode_batch)
+
+    events = [
+        chamber_event(
+            "chat.message", CHAMBER_ID, id=str(i), content="ok", sender="precious"
+        )["text"]
+        for i in range(BURST_SIZE)
+    ]
+    started, cpu_started = perf_counter(), process_time()
+    for _ in range(BURSTS):
+        for text in events:
+            queue.put("chat.message", text)
+            await asyncio.sleep(0)  # Events arrive one handler call at a time
+        await asyncio.sleep(BURST_INTERVAL)
+    while len(queue):
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(settings.OUTBOUND_QUEUE["BATCH_WINDOW"] * 2)
+    elapsed, cpu = perf_counter() - started, process_time() - cpu_started
+
+    queue.stop()
+    writer.close()
+    return frames, elapsed, cpu
+
+
+def main():
+    total = BURSTS * BURST_SIZE
+    print(
+        f"{'mode':>10} {'frames':>8} {'frames/s':>10} {'events/s':>10} {'cpu/event':>11}"
+    )
+    with override_settings(
+        OUTBOUND_QUEUE={**settings.OUTBOUND_QUEUE, "MAX_SIZE": BURST_SIZE * 10}
+    ):
+        for label, batching in (("per event", False), ("batched", True)):
+            frames, elapsed, cpu = asyncio.run(run(batching))
+            print(
+                f"{label:>10} {frames:>8} {frames / elapsed:>10.0f}"
+                f" {total / elapsed:>10.0f} {cpu / total * 1e6:>8.2f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compares the websocket wire protocols ('chat.codecs') on a realistic event mix:
+bytes on the wire and encode/decode CPU per event, for the JSON protocol
+(the standard library backend, plus orjson when installed) and the compact
+binary protocol.
+
+Run with: SECRET_KEY=x DEBUG_VALUE=true python -m benchmarks.wire_codecs
+"""
+
+from datetime import datetime, timezone
+from importlib import import_module
+from importlib.util import find_spec
+from time import process_time
+from uuid import uuid4
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
+django.setup()
+
+from chat.codecs import JSONCodec, compact_codec
+
+
+ROUNDS = 2000
+
+
+def event_mix():
+    created = datetime(2026, 10, 18, 9, 41, tzinfo=timezone.utc)
+    message_id = str(uuid4())
+    message = {
+        "type": "chat.message",
+        "id": message_id,
+        "content": "Are we still on for the review at three?",
+        "sender": "precious",
+        "timestamp": created,
+    }
+    reply = {
+        "type": "chat.reply",
+        "reply_format": "text",
+        "id": str(uuid4()),
+        "content": "Yes, same room as last week.",
+        "previous_sender": "precious",
+        "previous_message_content": message["content"],
+        "previous_message_id": message_id,
+        "sender": "whisperer",
+        "timestamp": created,
+    }
+    media = {
+        "type": "chat.media",
+        "id": str(uuid4()),
+        "url": "/media/images/media_1760780460000_482913.png",
+        "size": 482913,
+        "content_type": "image/png",
+        "filename": "media_1760780460000_482913.png",
+        "sender": "whisperer",
+        "timestamp": created,
+    }
+    typing = {
+        "type": "chat.typing",
+        "typists": ["precious", "whisperer"],
+        "content": "precious and whisperer are typing...",
+    }
+    active = {"type": "chat.active", "content": 12}
+    # Roughly the share of each event in a busy chamber
+    return [message] * 6 + [reply] * 2 + [media] + [typing] * 4 + [active]
+
+
+def measure(codec, events):
+    encoded = [codec.encode(event) for event in events]
+    size = sum(
+        len(data.encode("utf-8") if isinstance(data, str) else data) for data in encoded
+    )
+
+    started = process_time()
+    for _ in range(ROUNDS):
+        for event in events:
+            codec.encode(event)
+    encode_time = (process_time() - started) / (ROUNDS * len(events))
+
+    started = process_time()
+    for _ in range(ROUNDS):
+        for data in encoded:
+            codec.decode(data)
+    decode_time = (process_time() - started) / (ROUNDS * len(events))
+    return size / len(events), encode_time, decode_time
+
+
+def main():
+    codecs = {"json": JSONCodec(import_module("json"))}
+    if find_spec("orjson") is not None:
+        codecs["json (orjson)"] = JSONCodec(import_module("orjson"))
+    codecs["compact"] = compact_codec
+
+    events = event_mix()
+    print(f"{'protocol':>14} {'bytes/event':>12} {'encode':>10} {'decode':>10}")
+    for name, codec in codecs.items():
+        size, encode_time, decode_time = measure(codec, events)
+        print(
+            f"{name:>14} {size:>12.0f} {encode_time * 1e6:>7.2f} us"
+            f" {decode_time * 1e6:>7.2f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
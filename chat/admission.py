@@ -0,0 +1,127 @@
+from django.conf import settings
+from collections import deque
+import asyncio
+
+
+class AdmissionController:
+    """
+    Per-worker admission control for websocket handshakes, to smooth connect storms
+    (e.g. every client reconnecting after a deploy).
+    At most MAX_IN_FLIGHT handshakes run at once; the excess waits in a FIFO queue of
+    at most MAX_QUEUED for up to QUEUE_TIMEOUT seconds. Handshakes that find the queue
+    full or time out are rejected, as are connections beyond MAX_CONNECTIONS per
+    worker or MAX_USER_CONNECTIONS per user; rejected clients are told to retry
+    after RETRY_AFTER seconds (see 'ChamberEventConsumer.reject_overloaded').
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._in_flight = 0
+        self._waiters = deque()  # futures of queued handshakes
+        self._user_connections = {}  # user id -> open connections
+        self.connections = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = {
+            "queue_full": 0,
+            "timeout": 0,
+            "worker_full": 0,
+            "user_full": 0,
+        }
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Handshakes and connections of a previous event loop are gone
+            self._loop = loop
+            self._in_flight = 0
+            self._waiters = deque()
+            self._user_connections = {}
+            self.connections = 0
+
+    async def acquire(self):
+        """
+        Waits for a handshake slot. Returns None once admitted, otherwise the
+        rejection reason; an admitted handshake must call 'release' when done.
+        """
+        self._bind_loop()
+        admission_settings = settings.ADMISSION
+        if self.connections >= admission_settings["MAX_CONNECTIONS"]:
+            return self._reject("worker_full")
+        if self._in_flight < admission_settings["MAX_IN_FLIGHT"] and not self._waiters:
+            self._in_flight += 1
+            self.admitted += 1
+            return None
+        if len(self._waiters) >= admission_settings["MAX_QUEUED"]:
+            return self._reject("queue_full")
+
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            async with asyncio.timeout(admission_settings["QUEUE_TIMEOUT"]):
+                await waiter
+        except TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # The slot was handed over as the deadline passed
+            return self._reject("timeout")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # Handed a slot, then cancelled before taking it
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self.admitted += 1
+        return None
+
+    def release(self):
+        # The slot passes straight to the oldest queued handshake, if any
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def open_connection(self, user_id):
+        """
+        Counts an established connection against the worker and per-user limits.
+        Returns False, counting nothing, when either is reached.
+        """
+        admission_settings = settings.ADMISSION
+        if self.connections >= admission_settings["MAX_CONNECTIONS"]:
+            self._reject("worker_full")
+            return False
+        user_connections = self._user_connections.get(user_id, 0)
+        if user_connections >= admission_settings["MAX_USER_CONNECTIONS"]:
+            self._reject("user_full")
+            return False
+        self._user_connections[user_id] = user_connections + 1
+        self.connections += 1
+        return True
+
+    def close_connection(self, user_id):
+        user_connections = self._user_connections.get(user_id, 0)
+        if user_connections <= 1:
+            self._user_connections.pop(user_id, None)
+        else:
+            self._user_connections[user_id] = user_connections - 1
+        self.connections = max(self.connections - 1, 0)
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return reason
+
+    def stats(self):
+        return {
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiters),
+            "connections": self.connections,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
+
+
+admission = AdmissionController()
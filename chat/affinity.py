@@ -0,0 +1,647 @@
+from django.conf import settings
+from bisect import bisect, insort
+from hashlib import blake2b
+from uuid import uuid4
+import asyncio
+import hmac
+import json
+from .broker import (
+    BrokerError,
+    FRAME_HEADER_SIZE,
+    MAX_FRAME_SIZE,
+    link_secret,
+    open_broker_connection,
+    start_frame_server,
+)
+from .membership import chamber_index
+from .outbound import outbound_counters
+from .routing import websocket_urlpatterns
+
+
+# Scope keys forwarded to chamber workers; the rest (e.g. lifespan state) stay local
+SCOPE_KEYS = [
+    "type",
+    "asgi",
+    "http_version",
+    "scheme",
+    "path",
+    "raw_path",
+    "query_string",
+    "root_path",
+    "headers",
+    "client",
+    "server",
+    "subprotocols",
+    "extensions",
+]
+
+
+def encode_asgi(value, blobs, offset=0):
+    """
+    Makes ASGI scopes and messages JSON serializable for the relay frames: bytes
+    (e.g. binary websocket frames) are appended to 'blobs' and referenced by index
+    (plus 'offset'), so they travel raw after the JSON instead of being re-encoded.
+    """
+    if isinstance(value, bytes):
+        blobs.append(value)
+        return {"__blob__": offset + len(blobs) - 1}
+    if isinstance(value, dict):
+        return {key: encode_asgi(item, blobs, offset) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_asgi(item, blobs, offset) for item in value]
+    return value
+
+
+def decode_asgi(value, blobs):
+    if isinstance(value, dict):
+        if value.keys() == {"__blob__"}:
+            return blobs[value["__blob__"]]
+        return {key: decode_asgi(item, blobs) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_asgi(item, blobs) for item in value]
+    return value
+
+
+def decode_operation(operation, blobs):
+    """
+    Returns the (action, connection id, ASGI payload) of a relay operation.
+    Raises BrokerError for a malformed one.
+    """
+    try:
+        action, connection_id, payload = operation
+        return action, connection_id, decode_asgi(payload, blobs)
+    except (ValueError, TypeError, IndexError, KeyError) as error:
+        raise BrokerError(f"Malformed relay operation: {error!r}")
+
+
+def operation_connection(operation):
+    # The connection a malformed operation was meant for, if it can be told
+    if isinstance(operation, list) and len(operation) == 3:
+        if isinstance(operation[1], str):
+            return operation[1]
+    return None
+
+
+def write_relay_frame(writer, data, blobs):
+    """
+    Relay frames are the JSON operations ('data') and the count of blobs, then each
+    blob as a length-prefixed raw payload.
+    """
+    chunks = [
+        len(data).to_bytes(FRAME_HEADER_SIZE, "big")
+        + len(blobs).to_bytes(FRAME_HEADER_SIZE, "big"),
+        data,
+    ]
+    for blob in blobs:
+        chunks += [len(blob).to_bytes(FRAME_HEADER_SIZE, "big"), blob]
+    writer.writelines(chunks)
+
+
+async def skip_bytes(reader, size):
+    while size:
+        size -= len(await reader.readexactly(min(size, 64 * 1024)))
+
+
+async def read_relay_frame(reader):
+    """
+    Returns the next frame's (operations, blobs), or None once the peer has closed
+    the connection. A frame over MAX_FRAME_SIZE, or whose JSON does not decode,
+    is read past and raises BrokerError, so the next frame can still be read.
+    """
+    try:
+        header = await reader.readexactly(2 * FRAME_HEADER_SIZE)
+        size = int.from_bytes(header[:FRAME_HEADER_SIZE], "big")
+        count = int.from_bytes(header[FRAME_HEADER_SIZE:], "big")
+        oversized = size > MAX_FRAME_SIZE
+        if oversized:
+            await skip_bytes(reader, size)
+        else:
+            data = await reader.readexactly(size)
+        blobs = []
+        for _ in range(count):
+            blob_size = int.from_bytes(
+                await reader.readexactly(FRAME_HEADER_SIZE), "big"
+            )
+            size += FRAME_HEADER_SIZE + blob_size
+            oversized = oversized or size > MAX_FRAME_SIZE
+            if oversized:
+                blobs = []
+                await skip_bytes(reader, blob_size)
+            else:
+                blobs.append(await reader.readexactly(blob_size))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    if oversized:
+        raise BrokerError(f"Frame of {size} bytes exceeds the maximum frame size.")
+    try:
+        operations = json.loads(data)
+    except ValueError as error:
+        raise BrokerError(f"Undecodable relay frame: {error}")
+    if not isinstance(operations, list):
+        raise BrokerError("Relay frames must be lists of operations.")
+    return operations, blobs
+
+
+def relay_queue():
+    # Bounded like a connection's outbound queue (see 'chat.outbound')
+    return asyncio.Queue(maxsize=settings.OUTBOUND_QUEUE["MAX_SIZE"])
+
+
+def close_relay_queue(queue, *messages):
+    """
+    Queues the 'messages' ending a connection after what 'queue' still holds, or in
+    its place when there is no room left (the other side is too far behind anyway).
+    """
+    if queue.qsize() + len(messages) > queue.maxsize:
+        while not queue.empty():
+            queue.get_nowait()
+    for message in messages:
+        queue.put_nowait(message)
+
+
+def worker_link_secret():
+    return link_secret(settings.CHAMBER_AFFINITY["SECRET"], "chat.affinity")
+
+
+def chamber_for(scope):
+    """
+    Returns the chamber id of a chamber websocket scope, or None.
+    """
+    if scope["type"] != "websocket":
+        return None
+    path = scope["path"].lstrip("/")
+    for route in websocket_urlpatterns:
+        match = route.pattern.match(path)
+        if match and "chamber_id" in match[2]:
+            return match[2]["chamber_id"]
+    return None
+
+
+class HashRing:
+    """
+    Consistent hash ring: each node owns REPLICAS points, and a key belongs to the
+    node with the first point at or after the key's hash. Adding or removing a node
+    only moves the keys on the arcs next to that node's points.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []  # sorted hashes
+        self._owners = {}  # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def __contains__(self, node):
+        return node in self._owners.values()
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            if point not in self._owners:
+                insort(self._points, point)
+                self._owners[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            if self._owners.get(point) == node:
+                self._points.remove(point)
+                del self._owners[point]
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        index = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class FrameQueue:
+    """
+    Operations queued during one loop iteration, written as a single frame (or more,
+    to stay under MAX_FRAME_SIZE).
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._operations = []  # JSON encoded operations
+        self._blobs = []
+        self._size = 0
+
+    def _encode(self, action, connection_id, message, blobs, offset):
+        operation = [action, connection_id, encode_asgi(message, blobs, offset)]
+        data = json.dumps(operation, separators=(",", ":")).encode("utf-8")
+        return data, len(data) + sum(FRAME_HEADER_SIZE + len(blob) for blob in blobs)
+
+    def put(self, action, connection_id, message=None):
+        """
+        Returns False, queuing nothing, if the operation alone would not fit in a
+        frame; the caller then closes that connection rather than the link.
+        """
+        blobs = []
+        operation, size = self._encode(
+            action, connection_id, message, blobs, len(self._blobs)
+        )
+        if size + 2 * FRAME_HEADER_SIZE + 2 > MAX_FRAME_SIZE:
+            return False
+        if self._operations and self._size + size + 1 > MAX_FRAME_SIZE:
+            self._write()
+            blobs = []
+            operation, size = self._encode(action, connection_id, message, blobs, 0)
+
+        self._operations.append(operation)
+        self._blobs += blobs
+        self._size += size + 1
+        if len(self._operations) == 1:
+            asyncio.get_running_loop().call_soon(self._write)
+        return True
+
+    def _write(self):
+        operations, self._operations = self._operations, []
+        blobs, self._blobs = self._blobs, []
+        self._size = 0
+        if operations and not self.writer.is_closing():
+            data = b"[" + b",".join(operations) + b"]"
+            write_relay_frame(self.writer, data, blobs)
+
+
+class ChamberWorker:
+    """
+    Runs the websocket connections a front door ('ChamberAffinityRouter') hands over.
+    Started with 'python manage.py runchamberworker'.
+    A front door must open with a 'hello' carrying the worker link secret
+    (CHAMBER_AFFINITY['SECRET']); other links are closed. A connection whose
+    application falls OUTBOUND_QUEUE['MAX_SIZE'] messages behind its client is
+    closed with the resync code.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.connections = 0
+        self.rejected_frames = 0
+        self.rejected_links = 0
+
+    async def handle_front_door(self, reader, writer):
+        frames = FrameQueue(writer)
+        inboxes = {}  # connection id -> queue of ASGI messages for the application
+        tasks = set()
+        authenticated = False
+        try:
+            while True:
+                try:
+                    frame = await read_relay_frame(reader)
+                except BrokerError:
+                    self.rejected_frames += 1  # Skipped; the link carries on
+                    continue
+                if frame is None:
+                    break
+                operations, blobs = frame
+                for operation in operations:
+                    try:
+                        action, connection_id, payload = decode_operation(
+                            operation, blobs
+                        )
+                    except BrokerError:
+                        self.rejected_frames += 1
+                        self._close(frames, inboxes, operation_connection(operation))
+                        continue
+                    if not authenticated:
+                        if action != "hello" or not self._accepts(payload):
+                            self.rejected_links += 1
+                            return
+                        authenticated = True
+                    elif action == "open":
+                        inboxes[connection_id] = relay_queue()
+                        task = asyncio.get_running_loop().create_task(
+                            self._run(frames, inboxes, connection_id, payload)
+                        )
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    elif connection_id in inboxes:
+                        try:
+                            inboxes[connection_id].put_nowait(payload)
+                        except asyncio.QueueFull:
+                            outbound_counters.overflow_closes += 1
+                            self._close(
+                                frames,
+                                inboxes,
+                                connection_id,
+                                settings.OUTBOUND_QUEUE["RESYNC_CLOSE_CODE"],
+                            )
+        finally:
+            # The front door is gone, and its clients with it
+            for inbox in inboxes.values():
+                close_relay_queue(inbox, {"type": "websocket.disconnect", "code": 1006})
+            writer.close()
+
+    @staticmethod
+    def _accepts(payload):
+        secret = payload.get("secret") if isinstance(payload, dict) else None
+        return isinstance(secret, str) and hmac.compare_digest(
+            secret, worker_link_secret()
+        )
+
+    async def _run(self, frames, inboxes, connection_id, scope):
+        inbox = inboxes[connection_id]
+
+        async def receive():
+            message = await inbox.get()
+            if message is None:  # Closed by the front door
+                return {"type": "websocket.disconnect", "code": 1006}
+            return message
+
+        async def send(message):
+            if not frames.put("send", connection_id, message):
+                self._close(frames, inboxes, connection_id, code=1009)
+
+        self.connections += 1
+        try:
+            await self.application(scope, receive, send)
+        finally:
+            self.connections -= 1
+            inboxes.pop(connection_id, None)
+            frames.put("close", connection_id)
+
+    @staticmethod
+    def _close(frames, inboxes, connection_id, code=1011):
+        # Ends one relayed connection: the client is closed, the application told
+        inbox = inboxes.pop(connection_id, None)
+        if inbox is None:
+            return
+        frames.put("send", connection_id, {"type": "websocket.close", "code": code})
+        close_relay_queue(inbox, None)
+
+    async def start(self, address):
+        return await start_frame_server(self.handle_front_door, address)
+
+
+class WorkerConnection:
+    """
+    The front door's connection to one chamber worker, carrying all the websocket
+    connections it forwards there. A client falling OUTBOUND_QUEUE['MAX_SIZE']
+    messages behind is closed with the resync code.
+    """
+
+    def __init__(self, worker, reader, writer, on_lost):
+        self.worker = worker
+        self.frames = FrameQueue(writer)
+        self.outboxes = {}  # connection id -> queue of ASGI messages for the client
+        self.closed = False
+        self.rejected_frames = 0
+        self._on_lost = on_lost
+        self.frames.put("hello", None, {"secret": worker_link_secret()})
+        self._task = asyncio.get_running_loop().create_task(self._read(reader))
+
+    def open(self, connection_id, scope):
+        self.outboxes[connection_id] = outbox = relay_queue()
+        scope = {key: scope[key] for key in SCOPE_KEYS if key in scope}
+        if not self.frames.put("open", connection_id, scope):
+            self.close_connection(connection_id, 1009)
+        return outbox
+
+    def forward(self, connection_id, message):
+        if not self.closed and not self.frames.put("receive", connection_id, message):
+            self.close_connection(connection_id, 1009)
+
+    def close_connection(self, connection_id, code):
+        """
+        Closes one client with 'code' and ends it on the worker, leaving the link
+        and its other connections running.
+        """
+        outbox = self.outboxes.pop(connection_id, None)
+        if outbox is None:
+            return
+        close_relay_queue(outbox, {"type": "websocket.close", "code": code}, None)
+        if not self.closed:
+            self.frames.put("close", connection_id)
+
+    def forget(self, connection_id):
+        if self.outboxes.pop(connection_id, None) is not None and not self.closed:
+            self.frames.put("close", connection_id)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                try:
+                    frame = await read_relay_frame(reader)
+                except BrokerError:
+                    self.rejected_frames += 1  # Skipped; the link carries on
+                    continue
+                if frame is None:
+                    break
+                operations, blobs = frame
+                for operation in operations:
+                    try:
+                        action, connection_id, message = decode_operation(
+                            operation, blobs
+                        )
+                    except BrokerError:
+                        self.rejected_frames += 1
+                        connection_id = operation_connection(operation)
+                        if connection_id is not None:
+                            self.close_connection(connection_id, 1011)
+                        continue
+                    outbox = self.outboxes.get(connection_id)
+                    if outbox is None:
+                        continue
+                    if action == "send":
+                        try:
+                            outbox.put_nowait(message)
+                        except asyncio.QueueFull:
+                            outbound_counters.overflow_closes += 1
+                            self.close_connection(
+                                connection_id,
+                                settings.OUTBOUND_QUEUE["RESYNC_CLOSE_CODE"],
+                            )
+                    elif action == "close":
+                        del self.outboxes[connection_id]
+                        close_relay_queue(outbox, None)
+        finally:
+            self.closed = True
+            self.frames.writer.close()
+            self._on_lost(self)
+
+
+class ChamberAffinityRouter:
+    """
+    Front door for several worker processes: every chamber websocket is forwarded to
+    the worker owning its chamber on a consistent hash ring, so a chamber's members
+    share one process and its fan-out stays in-process. Other traffic, and chamber
+    websockets while no worker is reachable, are served by 'application' locally.
+
+    A lost worker leaves the ring at once; lost workers are retried every
+    HEALTH_INTERVAL seconds and rejoin the ring when they answer. When ownership moves,
+    the affected clients are closed with REBALANCE_CLOSE_CODE to reconnect (and replay
+    what they missed) on their new worker. Workers and front doors must share the
+    broker channel layer, since HTTP views and moving chambers still cross processes.
+    """
+
+    def __init__(self, application, workers=None):
+        affinity_settings = settings.CHAMBER_AFFINITY
+        self.application = application
+        self.workers = list(workers or affinity_settings["WORKERS"])
+        self.ring = HashRing(self.workers, affinity_settings["REPLICAS"])
+        self._connections = {}  # worker -> WorkerConnection
+        self._connecting = {}  # worker -> task opening its connection
+        self._forwarded = {}  # connection id -> [chamber id, worker, outbox]
+        self._watcher = None
+        self.rebalanced = 0
+
+    async def __call__(self, scope, receive, send):
+        # Normalized, so every spelling of a chamber id lands on the same worker
+        chamber_id = chamber_index.normalize(chamber_for(scope))
+        if chamber_id is None:
+            return await self.application(scope, receive, send)
+        self._ensure_watcher()
+
+        while (worker := self.ring.node_for(chamber_id)) is not None:
+            try:
+                connection = await self._connection(worker)
+            except OSError:
+                self._lose(worker)
+                continue
+            return await self._forward(connection, chamber_id, scope, receive, send)
+        return await self.application(scope, receive, send)
+
+    async def _connection(self, worker):
+        connection = self._connections.get(worker)
+        if connection is not None:
+            return connection
+        task = self._connecting.get(worker)
+        if task is None:
+            task = self._connecting[worker] = asyncio.get_running_loop().create_task(
+                open_broker_connection(worker)
+            )
+        try:
+            reader, writer = await asyncio.shield(task)
+        finally:
+            self._connecting.pop(worker, None)
+        if worker not in self._connections:
+            self._connections[worker] = WorkerConnection(
+                worker, reader, writer, self._on_connection_lost
+            )
+        return self._connections[worker]
+
+    async def _forward(self, connection, chamber_id, scope, receive, send):
+        connection_id = uuid4().hex
+        outbox = connection.open(connection_id, scope)
+        self._forwarded[connection_id] = [chamber_id, connection.worker, outbox]
+
+        async def forward_client():
+            while True:
+                message = await receive()
+                connection.forward(connection_id, message)
+                if message["type"] == "websocket.disconnect":
+                    return
+
+        forwarder = asyncio.get_running_loop().create_task(forward_client())
+        closed = False
+        try:
+            while (message := await outbox.get()) is not None:
+                if closed:
+                    continue  # The worker has not seen the disconnect yet
+                await send(message)
+                closed = message["type"] == "websocket.close"
+        finally:
+            forwarder.cancel()
+            self._forwarded.pop(connection_id, None)
+            connection.forget(connection_id)
+
+    def _close_forwarded(self, connection_ids, final=False):
+        close_code = settings.CHAMBER_AFFINITY["REBALANCE_CLOSE_CODE"]
+        for connection_id in connection_ids:
+            outbox = self._forwarded[connection_id][2]
+            messages = [{"type": "websocket.close", "code": close_code}]
+            if final:  # No worker left to end the connection
+                messages.append(None)
+            close_relay_queue(outbox, *messages)
+            self.rebalanced += 1
+
+    def _on_connection_lost(self, connection):
+        if self._connections.get(connection.worker) is connection:
+            del self._connections[connection.worker]
+        self._lose(connection.worker)
+        self._close_forwarded(
+            [
+                connection_id
+                for connection_id, (_, worker, _) in self._forwarded.items()
+                if worker == connection.worker
+            ],
+            final=True,
+        )
+
+    def _lose(self, worker):
+        if worker in self.ring:
+            self.ring.remove(worker)
+
+    def add_worker(self, worker):
+        """
+        Puts 'worker' on the ring and moves the chambers it now owns.
+        """
+        if worker not in self.workers:
+            self.workers.append(worker)
+        if worker in self.ring:
+            return
+        self.ring.add(worker)
+        self._close_forwarded(
+            [
+                connection_id
+                for connection_id, (chamber_id, owner, _) in self._forwarded.items()
+                if self.ring.node_for(chamber_id) != owner
+            ]
+        )
+
+    def remove_worker(self, worker):
+        """
+        Takes 'worker' off the ring; its clients reconnect to the chambers' new owners.
+        """
+        if worker in self.workers:
+            self.workers.remove(worker)
+        self._lose(worker)
+        self._close_forwarded(
+            [
+                connection_id
+                for connection_id, (_, owner, _) in self._forwarded.items()
+                if owner == worker
+            ]
+        )
+
+    def _ensure_watcher(self):
+        loop = asyncio.get_running_loop()
+        if self._watcher is None or self._watcher.get_loop() is not loop:
+            # Connections belong to the loop they were opened on
+            self._connections = {}
+            self._connecting = {}
+            self._watcher = loop.create_task(self._watch_workers())
+
+    async def _watch_workers(self):
+        while True:
+            await asyncio.sleep(settings.CHAMBER_AFFINITY["HEALTH_INTERVAL"])
+            for worker in list(self.workers):
+                if worker in self.ring:
+                    continue
+                try:
+                    await self._connection(worker)
+                except OSError:
+                    continue
+                self.add_worker(worker)
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        for connection in list(self._connections.values()):
+            connection.frames.writer.close()
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "available": [worker for worker in self.workers if worker in self.ring],
+            "forwarded": len(self._forwarded),
+            "rebalanced": self.rebalanced,
+            "rejected_frames": sum(
+                connection.rejected_frames for connection in self._connections.values()
+            ),
+        }
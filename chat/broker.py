@@ -0,0 +1,232 @@
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+from urllib.parse import urlparse
+from time import time
+import asyncio
+import hmac
+import json
+import os
+
+
+FRAME_HEADER_SIZE = 4
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class BrokerError(Exception):
+    pass
+
+
+def link_secret(configured, purpose):
+    """
+    The shared secret peers present when opening an internal link: the configured
+    one, or else one derived from SECRET_KEY, which every process shares.
+    """
+    return configured or salted_hmac(purpose, "link secret").hexdigest()
+
+
+def broker_link_secret():
+    return link_secret(settings.CHANNEL_BROKER_SECRET, "chat.broker")
+
+
+def parse_address(address):
+    """
+    Returns ("unix", path) or ("tcp", (host, port)) for a 'unix:///path/to.sock'
+    or 'tcp://host:port' address.
+    """
+    parsed = urlparse(address)
+    if parsed.scheme == "unix":
+        return "unix", parsed.path
+    if parsed.scheme == "tcp" and parsed.hostname and parsed.port:
+        return "tcp", (parsed.hostname, parsed.port)
+    raise BrokerError(f"Unsupported broker address: {address}")
+
+
+async def open_broker_connection(address):
+    kind, location = parse_address(address)
+    if kind == "unix":
+        return await asyncio.open_unix_connection(location)
+    return await asyncio.open_connection(*location)
+
+
+async def start_frame_server(handler, address):
+    kind, location = parse_address(address)
+    if kind == "unix":
+        if os.path.exists(location):
+            os.unlink(location)  # Left behind by a previous server
+        return await asyncio.start_unix_server(handler, location)
+    return await asyncio.start_server(handler, *location)
+
+
+def write_frame(writer, payload):
+    data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    writer.write(len(data).to_bytes(FRAME_HEADER_SIZE, "big") + data)
+
+
+async def read_frame(reader):
+    """
+    Returns the next decoded frame, or None once the peer has closed the connection.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER_SIZE)
+        size = int.from_bytes(header, "big")
+        if size > MAX_FRAME_SIZE:
+            raise BrokerError(f"Frame of {size} bytes exceeds the maximum frame size.")
+        data = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return json.loads(data)
+
+
+def channel_owner(channel):
+    """
+    Process-specific channels are named '<prefix>.<client id>!<suffix>'.
+    """
+    return channel[: channel.find("!")].rsplit(".", 1)[-1]
+
+
+class ChannelBroker:
+    """
+    Routes channel layer traffic between worker processes ('chat.layers').
+
+    Every worker holds one connection per event loop and names its channels after
+    that connection's client id, so the broker knows where each channel lives.
+    The broker tracks group membership; a 'group_send' is delivered to each worker
+    as one frame listing that worker's member channels, and the worker fans it out
+    locally. Deliveries produced while handling one incoming frame are batched into
+    one outgoing frame per worker. A worker whose unsent output exceeds
+    MAX_PENDING_BYTES has further deliveries dropped instead of buffering without bound.
+    Memberships of a worker are removed when its connection closes.
+
+    A connection must open with a 'hello' carrying the broker link secret and a client
+    id no other open connection uses; otherwise it is closed and counted in
+    'rejected_links'.
+
+    Frames are length-prefixed JSON lists of operations, so messages must be JSON
+    serializable (chamber events are).
+    """
+
+    MAX_PENDING_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, group_expiry=86400):
+        self.group_expiry = group_expiry
+        self._clients = {}  # client id -> writer
+        self._groups = {}  # group -> {channel: added at}
+        self._memberships = {}  # client id -> {(group, channel)}
+        self.frames = 0
+        self.deliveries = 0
+        self.dropped = 0
+        self.rejected_links = 0
+
+    async def handle_client(self, reader, writer):
+        client_id = None
+        try:
+            while True:
+                operations = await read_frame(reader)
+                if operations is None:
+                    break
+                self.frames += 1
+                outgoing = {}
+                for operation in operations:
+                    if client_id is None:
+                        if not self._accepts(operation):
+                            self.rejected_links += 1
+                            return
+                        client_id = operation[1]
+                        self._clients[client_id] = writer
+                    else:
+                        self._handle(client_id, operation, outgoing)
+                self._write_outgoing(outgoing)
+        finally:
+            self._remove_client(client_id, writer)
+            writer.close()
+
+    def _accepts(self, hello):
+        if not isinstance(hello, list) or len(hello) != 3 or hello[0] != "hello":
+            return False
+        _, client_id, secret = hello
+        if not isinstance(client_id, str) or not isinstance(secret, str):
+            return False
+        if not hmac.compare_digest(secret, broker_link_secret()):
+            return False
+        # A second connection must not take over a connected client's channels
+        writer = self._clients.get(client_id)
+        return writer is None or writer.is_closing()
+
+    def _handle(self, client_id, operation, outgoing):
+        action = operation[0]
+        if action == "send":
+            _, channel, message = operation
+            self._deliver(outgoing, channel_owner(channel), [channel], message)
+        elif action == "group_send":
+            _, group, message = operation
+            members = self._groups.get(group)
+            if not members:
+                return
+            expired_before = time() - self.group_expiry
+            by_owner = {}
+            for channel, added in list(members.items()):
+                if added < expired_before:
+                    self._discard(group, channel)
+                    continue
+                by_owner.setdefault(channel_owner(channel), []).append(channel)
+            for owner, channels in by_owner.items():
+                self._deliver(outgoing, owner, channels, message)
+        elif action == "group_add":
+            _, group, channel, ack_id = operation
+            self._groups.setdefault(group, {})[channel] = time()
+            self._memberships.setdefault(channel_owner(channel), set()).add(
+                (group, channel)
+            )
+            outgoing.setdefault(client_id, []).append(["ack", ack_id])
+        elif action == "group_discard":
+            _, group, channel = operation
+            self._discard(group, channel)
+
+    def _deliver(self, outgoing, owner, channels, message):
+        if owner in self._clients:
+            outgoing.setdefault(owner, []).append(["deliver", channels, message])
+
+    def _write_outgoing(self, outgoing):
+        for owner, frame in outgoing.items():
+            writer = self._clients.get(owner)
+            if writer is None or writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > self.MAX_PENDING_BYTES:
+                self.dropped += len(frame)
+                continue
+            write_frame(writer, frame)
+            self.deliveries += len(frame)
+
+    def _discard(self, group, channel):
+        members = self._groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self._groups[group]
+        memberships = self._memberships.get(channel_owner(channel))
+        if memberships is not None:
+            memberships.discard((group, channel))
+
+    def _remove_client(self, client_id, writer):
+        if client_id is None or self._clients.get(client_id) is not writer:
+            return  # Rejected, or already replaced by a reconnected link
+        self._clients.pop(client_id, None)
+        for group, channel in self._memberships.pop(client_id, set()):
+            members = self._groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del self._groups[group]
+
+    async def start(self, address):
+        return await start_frame_server(self.handle_client, address)
+
+    def stats(self):
+        return {
+            "clients": len(self._clients),
+            "groups": len(self._groups),
+            "frames": self.frames,
+            "deliveries": self.deliveries,
+            "dropped": self.dropped,
+            "rejected_links": self.rejected_links,
+        }
@@ -0,0 +1,422 @@
+from django.conf import settings
+from django.utils.dateformat import format
+from datetime import datetime, timezone
+from importlib import import_module
+from uuid import UUID
+import struct
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    """
+    Encodes chamber events for, and decodes messages from, websocket clients.
+    Payloads are plain dicts; a 'timestamp' key holds the event's datetime,
+    which each codec renders in its own wire format.
+    """
+
+    subprotocol = None
+    binary = False
+
+    def encode(self, payload):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def encode_batch(self, frames):
+        """
+        Combines already encoded frames into one array frame.
+        """
+        raise NotImplementedError
+
+    def decode_batch(self, data):
+        raise NotImplementedError
+
+    def accepts(self, bytes_data):
+        """
+        Whether a binary frame is an encoded message (as opposed to a media frame).
+        """
+        return False
+
+
+class JSONCodec(Codec):
+    """
+    The default text protocol. 'timestamp' is rendered as the formatted 'created'
+    and 'time' strings clients already display. The JSON implementation is any module
+    with 'dumps' and 'loads' (WEBSOCKET_CODECS['JSON_BACKEND']), so a faster one can
+    be dropped in.
+    """
+
+    subprotocol = "whisper.json.v1"
+
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = import_module(settings.WEBSOCKET_CODECS["JSON_BACKEND"])
+        return self._backend
+
+    def encode(self, payload):
+        timestamp = payload.get("timestamp")
+        if timestamp is not None:
+            # 'created' and 'time' take the place of 'timestamp', so the payload can
+            # be rebuilt in its original key order (see 'EncodedEvents')
+            rendered = {}
+            for key, value in payload.items():
+                if key == "timestamp":
+                    rendered["created"] = format(timestamp, "M. d, Y")
+                    rendered["time"] = format(timestamp, "P")
+                else:
+                    rendered[key] = value
+            payload = rendered
+
+        text_data = self.backend.dumps(payload)
+        if isinstance(text_data, bytes):
+            text_data = text_data.decode("utf-8")
+        return text_data
+
+    def decode(self, data):
+        try:
+            return self.backend.loads(data)
+        except ValueError as error:
+            raise CodecError(f"Invalid JSON message: {error}")
+
+    def encode_batch(self, frames):
+        return f"[{','.join(frames)}]"
+
+    def decode_batch(self, data):
+        return self.decode(data)
+
+
+class CompactCodec(Codec):
+    """
+    Binary protocol: a marker byte, the number of fields, then each field as a one-byte
+    tag (FIELDS) and a typed value. Frequent strings are sent as one-byte references
+    (STRINGS), ids as 16-byte UUIDs and 'timestamp' as epoch milliseconds. Integers
+    and timestamps are zigzag varints; integers beyond 64 bits are sent as decimal
+    strings.
+    Unknown keys are sent as tag 0 followed by the key itself. Lists and dicts may be
+    nested at most MAX_DEPTH levels deep.
+    """
+
+    subprotocol = "whisper.compact.v1"
+    binary = True
+
+    MARKER = 0xC7
+    BATCH_MARKER = 0xC8
+    MAX_DEPTH = 4
+    FIELDS = (
+        "type",
+        "id",
+        "content",
+        "sender",
+        "timestamp",
+        "reply_format",
+        "previous_sender",
+        "previous_message_content",
+        "previous_message_id",
+        "url",
+        "size",
+        "content_type",
+        "filename",
+        "typists",
+        "message",
+        "message_type",
+        "media_type",
+        "upload_id",
+        "chunk_size",
+        "offset",
+        "next_chunk",
+        "chunk",
+        "created",
+        "time",
+        "seq",
+        "chamber_id",
+        "chamber_ids",
+        "rejected",
+        "last_seq",
+    )
+    STRINGS = (
+        "chat.message",
+        "chat.reply",
+        "chat.media",
+        "chat.typing",
+        "chat.active",
+        "chat.notification",
+        "text",
+        "media",
+        "image/png",
+        "audio/wav",
+        "video/mp4",
+        "IMAGE",
+        "AUDIO",
+        "VIDEO",
+        "message",
+        "reply",
+        "typing",
+        "not_typing",
+        "image",
+        "audio",
+        "video",
+        "upload.ready",
+        "upload.ack",
+        "upload.offset",
+        "upload.error",
+        "upload_begin",
+        "upload_offset",
+        "upload_commit",
+        "chat.resync",
+        "chat.subscribed",
+        "chat.unsubscribed",
+        "subscribe",
+        "unsubscribe",
+    )
+    UUID_FIELDS = {"id", "previous_message_id", "upload_id", "chamber_id"}
+
+    # Value types
+    (
+        NONE,
+        TRUE,
+        FALSE,
+        INT,
+        FLOAT,
+        STR,
+        REF,
+        BINARY_UUID,
+        TIMESTAMP,
+        LIST,
+        DICT,
+        BIG_INT,
+    ) = range(12)
+
+    _double = struct.Struct("!d")
+
+    def __init__(self):
+        self._field_tags = {name: tag for tag, name in enumerate(self.FIELDS, 1)}
+        self._string_refs = {value: ref for ref, value in enumerate(self.STRINGS)}
+
+    def accepts(self, bytes_data):
+        return bytes_data[:1] == bytes((self.MARKER,))
+
+    def encode(self, payload):
+        buffer = bytearray((self.MARKER,))
+        self._write_varint(buffer, len(payload))
+        for key, value in payload.items():
+            tag = self._field_tags.get(key, 0)
+            buffer.append(tag)
+            if not tag:
+                self._write_str(buffer, key)
+            self._write_value(buffer, value, uuid_field=key in self.UUID_FIELDS)
+        return bytes(buffer)
+
+    def decode(self, data):
+        data = memoryview(data)
+        if not self.accepts(data):
+            raise CodecError("Missing compact message marker.")
+        try:
+            count, position = self._read_varint(data, 1)
+            payload = {}
+            for _ in range(count):
+                tag = data[position]
+                position += 1
+                if tag:
+                    key = self.FIELDS[tag - 1]
+                else:
+                    key, position = self._read_str(data, position)
+                payload[key], position = self._read_value(data, position)
+        except (IndexError, ValueError, OverflowError, struct.error) as error:
+            raise CodecError(f"Invalid compact message: {error}")
+        if position != len(data):
+            raise CodecError("Trailing bytes after compact message.")
+        return payload
+
+    def encode_batch(self, frames):
+        # Batch marker, frame count, then each frame prefixed with its length
+        buffer = bytearray((self.BATCH_MARKER,))
+        self._write_varint(buffer, len(frames))
+        for frame in frames:
+            self._write_varint(buffer, len(frame))
+            buffer += frame
+        return bytes(buffer)
+
+    def decode_batch(self, data):
+        data = memoryview(data)
+        if data[:1] != bytes((self.BATCH_MARKER,)):
+            raise CodecError("Missing compact batch marker.")
+        try:
+            count, position = self._read_varint(data, 1)
+            payloads = []
+            for _ in range(count):
+                length, position = self._read_varint(data, position)
+                payloads.append(self.decode(data[position : position + length]))
+                position += length
+        except IndexError as error:
+            raise CodecError(f"Invalid compact batch: {error}")
+        return payloads
+
+    def _write_value(self, buffer, value, uuid_field=False):
+        if value is None:
+            buffer.append(self.NONE)
+        elif value is True:
+            buffer.append(self.TRUE)
+        elif value is False:
+            buffer.append(self.FALSE)
+        elif isinstance(value, int):
+            if -(1 << 63) <= value < 1 << 63:
+                buffer.append(self.INT)
+                self._write_varint(buffer, self._zigzag(value))
+            else:
+                buffer.append(self.BIG_INT)
+                self._write_str(buffer, str(value))
+        elif isinstance(value, float):
+            buffer.append(self.FLOAT)
+            buffer += self._double.pack(value)
+        elif isinstance(value, UUID):
+            buffer.append(self.BINARY_UUID)
+            buffer += value.bytes
+        elif isinstance(value, datetime):
+            buffer.append(self.TIMESTAMP)
+            self._write_varint(buffer, self._zigzag(round(value.timestamp() * 1000)))
+        elif isinstance(value, str):
+            ref = self._string_refs.get(value)
+            if ref is not None:
+                buffer.append(self.REF)
+                buffer.append(ref)
+                return
+            if uuid_field:
+                try:
+                    parsed = UUID(value)
+                except ValueError:
+                    parsed = None
+                if parsed is not None and str(parsed) == value:
+                    buffer.append(self.BINARY_UUID)
+                    buffer += parsed.bytes
+                    return
+            buffer.append(self.STR)
+            self._write_str(buffer, value)
+        elif isinstance(value, (list, tuple)):
+            buffer.append(self.LIST)
+            self._write_varint(buffer, len(value))
+            for item in value:
+                self._write_value(buffer, item)
+        elif isinstance(value, dict):
+            buffer.append(self.DICT)
+            self._write_varint(buffer, len(value))
+            for key, item in value.items():
+                self._write_str(buffer, key)
+                self._write_value(buffer, item)
+        else:
+            raise CodecError(f"Cannot encode value of type {type(value).__name__}.")
+
+    def _read_value(self, data, position, depth=0):
+        value_type = data[position]
+        position += 1
+        if value_type == self.NONE:
+            return None, position
+        if value_type == self.TRUE:
+            return True, position
+        if value_type == self.FALSE:
+            return False, position
+        if value_type == self.INT:
+            value, position = self._read_varint(data, position)
+            return self._unzigzag(value), position
+        if value_type == self.BIG_INT:
+            value, position = self._read_str(data, position)
+            return int(value), position
+        if value_type == self.FLOAT:
+            end = position + self._double.size
+            return self._double.unpack(data[position:end])[0], end
+        if value_type == self.STR:
+            return self._read_str(data, position)
+        if value_type == self.REF:
+            return self.STRINGS[data[position]], position + 1
+        if value_type == self.BINARY_UUID:
+            end = position + 16
+            if end > len(data):
+                raise ValueError("truncated UUID")
+            return str(UUID(bytes=bytes(data[position:end]))), end
+        if value_type == self.TIMESTAMP:
+            value, position = self._read_varint(data, position)
+            return (
+                datetime.fromtimestamp(self._unzigzag(value) / 1000, timezone.utc),
+                position,
+            )
+        if value_type in (self.LIST, self.DICT) and depth >= self.MAX_DEPTH:
+            raise ValueError("containers nested too deeply")
+        if value_type == self.LIST:
+            count, position = self._read_varint(data, position)
+            items = []
+            for _ in range(count):
+                item, position = self._read_value(data, position, depth + 1)
+                items.append(item)
+            return items, position
+        if value_type == self.DICT:
+            count, position = self._read_varint(data, position)
+            items = {}
+            for _ in range(count):
+                key, position = self._read_str(data, position)
+                items[key], position = self._read_value(data, position, depth + 1)
+            return items, position
+        raise ValueError(f"unknown value type {value_type}")
+
+    @staticmethod
+    def _zigzag(value):
+        # Small negative numbers get short varints too: 0, -1, 1, -2... -> 0, 1, 2, 3...
+        return value << 1 if value >= 0 else (~value << 1) | 1
+
+    @staticmethod
+    def _unzigzag(value):
+        return (value >> 1) ^ -(value & 1)
+
+    @staticmethod
+    def _write_varint(buffer, value):
+        while value > 0x7F:
+            buffer.append((value & 0x7F) | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+    @staticmethod
+    def _read_varint(data, position):
+        value = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, position
+            shift += 7
+
+    def _write_str(self, buffer, value):
+        encoded = value.encode("utf-8")
+        self._write_varint(buffer, len(encoded))
+        buffer += encoded
+
+    def _read_str(self, data, position):
+        length, position = self._read_varint(data, position)
+        end = position + length
+        if end > len(data):
+            raise ValueError("truncated string")
+        return str(data[position:end], "utf-8"), end
+
+
+json_codec = JSONCodec()
+compact_codec = CompactCodec()
+
+CODECS = {codec.subprotocol: codec for codec in (json_codec, compact_codec)}
+
+
+def negotiate_codec(subprotocols):
+    """
+    Returns the codec for the first supported subprotocol the client offered,
+    or the JSON codec (without a subprotocol) when none was offered or supported.
+    """
+    for subprotocol in subprotocols:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    return json_codec, None
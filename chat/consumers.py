@@ -3,95 +3,291 @@ from .utils import (
     confirm_authorization,
     check_user_in_chamber,
     ChamberDetail,
-    set_user_status,
     create_new_message,
     get_replied_message,
     create_new_reply,
     generate_random_filename,
     create_new_media_message,
-    update_media_message,
-    get_active_users_count,
+    save_media_message,
+    save_uploaded_media_message,
+    get_missed_events,
 )
-import json
-from django.utils.dateformat import format
-from base64 import b64encode
+from .uploads import chunked_uploads, UploadError
+from .frames import parse_frame, FrameError
+from .presence import presence, chamber_activity
+from .typing import typing_aggregator, describe_typists
+from .events import chamber_event, encoded_events, PROCESS_ID
+from .codecs import negotiate_codec, json_codec, CodecError
+from .outbound import OutboundQueue
+from .replay import recent_events
+from .membership import chamber_index
+from .admission import admission
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from urllib.parse import parse_qs
 
 
-class ChamberConsumer(AsyncWebsocketConsumer):
+class ChamberEventConsumer(AsyncWebsocketConsumer):
+    """
+    Delivery of chamber group events to one authenticated websocket: the outbound
+    queue, the negotiated codec, replay of missed messages and the group handlers.
+    With 'tag_events', payloads carry the id of the chamber they belong to.
+    """
+
+    tag_events = False
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self.chamber = None
-        self.chamber_id = None
-        self.chamber_group_name = None
         self.user = None
         self.username = None
+        self.visible_typists = {}  # chamber id -> typists last sent
+        self.codec = json_codec
+        self.outbound = None
+        self.admitted_user_id = None
 
     async def connect(self):
+        """
+        Runs 'handshake' under admission control (see 'chat.admission').
+        """
+        if await admission.acquire() is not None:
+            await self.reject_overloaded()
+            return
+        try:
+            await self.handshake()
+        except Exception:
+            # E.g. the membership or replay query failed: the consumer never gets a
+            # 'websocket.disconnect', so the connection slot is given back here
+            self.close_admitted_connection()
+            raise
+        finally:
+            admission.release()
+
+    async def admit(self, user):
+        """
+        Counts the connection against the worker and per-user connection limits,
+        or rejects it when either is reached.
+        """
+        if not admission.open_connection(user.id):
+            await self.reject_overloaded()
+            return False
+        self.admitted_user_id = user.id
+        return True
+
+    async def reject_overloaded(self):
+        # Accepted first, so the client sees the close code and when to retry
+        admission_settings = settings.ADMISSION
+        await self.accept()
+        await self.close(
+            code=admission_settings["RETRY_CLOSE_CODE"],
+            reason=f"retry-after={admission_settings['RETRY_AFTER']}",
+        )
+
+    def close_admitted_connection(self):
+        if self.admitted_user_id is not None:
+            admission.close_connection(self.admitted_user_id)
+            self.admitted_user_id = None
+
+    async def websocket_disconnect(self, message):
+        self.close_admitted_connection()
+        await super().websocket_disconnect(message)
+
+    async def replay_missed_events(self, chamber_id, last_seq):
+        """
+        Sends the messages broadcast after 'last_seq', from this process's recent events
+        when they are all buffered, otherwise from the database. Gaps larger than
+        REPLAY['MAX_DATABASE_EVENTS'] end with a 'chat.resync' event telling the client
+        to fetch the rest over HTTP.
+        """
+        events = recent_events.since(chamber_id, last_seq)
+        has_more = False
+        if events is None:
+            events, has_more = await get_missed_events(
+                chamber_id, last_seq, settings.REPLAY["MAX_DATABASE_EVENTS"]
+            )
+        for event in events:
+            await self.send_event(event)
+        if has_more:
+            await self.send_payload(
+                {"type": "chat.resync", "after_seq": events[-1]["seq"]}, chamber_id
+            )
+
+    async def send_payload(self, payload, chamber_id=None):
+        if self.tag_events and chamber_id is not None:
+            payload = {**payload, "chamber_id": str(chamber_id)}
+        await self.send_encoded(payload["type"], self.codec.encode(payload), chamber_id)
+
+    async def send_event(self, event):
+        await self.send_encoded(
+            event["type"],
+            encoded_events.encode(self.codec, event, tagged=self.tag_events),
+            event.get("chamber_id"),
+        )
+
+    async def send_encoded(self, event_type, data, chamber_id=None):
+        """
+        Queues the frame on the connection's outbound queue (see 'chat.outbound'),
+        where ephemeral events are coalesced per chamber.
+        A client too slow to keep up is disconnected, once, with the resync close code.
+        """
+        if self.outbound is None or self.outbound.closed:
+            return  # Closing after an overflow or a failed send; the rest is dropped
+        chamber_id = str(chamber_id) if chamber_id is not None else None
+        if not self.outbound.put(event_type, data, chamber_id):
+            await self.close(code=settings.OUTBOUND_QUEUE["RESYNC_CLOSE_CODE"])
+
+    async def write_frame(self, data):
+        if self.codec.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    # Receive message from chamber group
+    async def chat_notification(self, event):
+        await self.send_event(event)
+
+    async def chat_active(self, event):
+        # Each process sends the chamber-wide count to its own connections
+        if event.get("process") == PROCESS_ID:
+            await self.send_event(event)
+
+    async def chat_message(self, event):  # Handler for chat.message
+        recent_events.record(event["chamber_id"], event)
+        await self.send_event(event)
+
+    async def chat_reply(self, event):  # Handler for chat.reply
+        recent_events.record(event["chamber_id"], event)
+        await self.send_event(event)
+
+    async def chat_typing(self, event):  # Handler for chat.typing
+        # Broadcasts carry one process's typists; clients get the chamber-wide list.
+        # The sender never sees itself typing, and unchanged lists are not resent
+        event = typing_aggregator.receive(event)
+        typists = [
+            username for username in event["typists"] if username != self.username
+        ]
+        if typists == self.visible_typists.get(event["chamber_id"], []):
+            return
+        self.visible_typists[event["chamber_id"]] = typists
+        if len(typists) == len(event["typists"]):
+            await self.send_event(event)
+        else:
+            await self.send_payload(
+                {
+                    "type": "chat.typing",
+                    "typists": typists,
+                    "content": describe_typists(typists),
+                },
+                event["chamber_id"],
+            )
+
+    async def chat_media(self, event):  # Handler for chat.audio
+        recent_events.record(event["chamber_id"], event)
+        await self.send_event(event)
+
+
+class ChamberConsumer(ChamberEventConsumer):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.chamber = None
+        self.chamber_id = None
+        self.chamber_group_name = None
+
+    async def handshake(self):
         """
         Initiates handshake to connect consumer to websocket client and join the chat group.
         Includes extra authorization check for 'request.user' to ensure current user is part of chat.
         """
-        # Retrieve 'chamber_id' value from scope and use it to set group name
-        self.chamber_id = self.scope["url_route"]["kwargs"]["chamber_id"]
-        self.chamber = await ChamberDetail(self.chamber_id).retrieve_chamber_obj()
-        self.chamber_group_name = self.chamber_id
+        # Retrieve 'chamber_id' value from scope; chamber metadata and membership
+        # come from the in-memory index, so a warm chamber costs no database queries
+        self.chamber = await ChamberDetail(
+            self.scope["url_route"]["kwargs"]["chamber_id"]
+        ).retrieve_chamber_obj()
 
         headers = dict(self.scope["headers"])
         user = await confirm_authorization(headers)
+        if self.chamber is None or user is None:
+            await self.close(code=4001)
+            return
         self.user = user
         self.username = user.username
-        user_in_chamber = await check_user_in_chamber(self.user.id, self.chamber_id)
+        user_in_chamber = await check_user_in_chamber(self.user.id, self.chamber.id)
         if not user_in_chamber:
             await self.close(code=4001)
+            return
+        if not await self.admit(user):
+            return
 
-        # Join chamber group and confirm websocket connection
+        self.chamber_id = self.chamber.id
+        self.chamber_group_name = self.chamber_id
+
+        # Join chamber group and confirm websocket connection, with the wire
+        # protocol the client asked for (see 'chat.codecs')
+        self.codec, subprotocol = negotiate_codec(self.scope.get("subprotocols", []))
         await self.channel_layer.group_add(self.chamber_group_name, self.channel_name)
-        await self.accept()
+        presence.connect(self.user.id)
+        await self.accept(subprotocol)
+        self.outbound = OutboundQueue(self.write_frame, self.close)
 
-        await set_user_status(self.user, status="online")
-        active_count = await get_active_users_count(self.chamber_id)
-        await self.channel_layer.group_send(
-            self.chamber_group_name, {"type": "chat.active", "content": active_count}
-        )
+        chamber_activity.join(self.chamber_id, self.user.id, self.channel_layer)
+
+        # A reconnecting client passes the last sequence number it saw
+        query = parse_qs(self.scope.get("query_string", b"").decode("utf-8"))
+        last_seq = query.get("last_seq", [""])[0]
+        if last_seq.isdigit():
+            await self.replay_missed_events(self.chamber_id, int(last_seq))
 
     async def disconnect(self, close_code):
+        if self.chamber_group_name is None:
+            return
+        if self.outbound is not None:
+            self.outbound.stop()
+            self.outbound = None
         await self.channel_layer.group_discard(
             self.chamber_group_name, self.channel_name
         )
-        await set_user_status(self.user, status="offline")
-        active_count = await get_active_users_count(self.chamber_id)
-        await self.channel_layer.group_send(
-            self.chamber_group_name, {"type": "chat.active", "content": active_count}
+        presence.disconnect(self.user.id)
+        chamber_activity.leave(self.chamber_id, self.user.id, self.channel_layer)
+        if not chamber_activity.count(self.chamber_id):
+            # Without local connections, events stop being recorded for replay
+            recent_events.discard(self.chamber_id)
+        typing_aggregator.update(
+            self.chamber_id, self.user.id, self.username, False, self.channel_layer
         )
 
     async def receive(self, text_data=None, bytes_data=None):
-        if text_data:
-            text_data_json = json.loads(text_data)
+        if text_data or (bytes_data and self.codec.accepts(bytes_data)):
+            # JSON text, or a control message in the negotiated binary protocol
+            codec = json_codec if text_data else self.codec
+            try:
+                text_data_json = codec.decode(text_data or bytes_data)
+            except CodecError:
+                return
             message = text_data_json.get("message")
             message_type = text_data_json.get("message_type")
 
             # Send message to chamber group
             if message_type == "message":
                 if message:
-                    message_id, created = await create_new_message(
-                        message, self.user, self.chamber
+                    message_id, created, seq = await create_new_message(
+                        message, self.user, self.chamber_id
                     )
                     await self.channel_layer.group_send(
                         self.chamber_group_name,
-                        {
-                            "type": "chat.message",
-                            "id": str(message_id),
-                            "content": message,
-                            "sender": self.username,
-                            "created": format(created, "M. d, Y"),
-                            "time": format(created, "P"),
-                        },
+                        chamber_event(
+                            "chat.message",
+                            self.chamber_id,
+                            id=str(message_id),
+                            content=message,
+                            sender=self.username,
+                            timestamp=created,
+                            seq=seq,
+                        ),
                     )
             elif message_type == "reply":
                 previous_message_id = text_data_json.get("previous_message_id")
                 if message:
                     replied_message = await get_replied_message(
-                        previous_message_id, self.chamber
+                        previous_message_id, self.chamber_id
                     )
                     if replied_message["message_type"] == "IMG":
                         previous_message_content = "IMAGE"
@@ -102,150 +298,330 @@ class ChamberConsumer(AsyncWebsocketConsumer):
                     else:
                         previous_message_content = replied_message["text_content"]
 
-                    reply_id, created = await create_new_reply(
+                    reply_id, created, seq = await create_new_reply(
                         self.user,
                         replied_message["sender"],
                         previous_message_content,
                         previous_message_id,
-                        self.chamber,
+                        self.chamber_id,
                         message,
                     )
                     await self.channel_layer.group_send(
                         self.chamber_group_name,
-                        {
-                            "type": "chat.reply",
-                            "reply_format": "text",
-                            "id": str(reply_id),
-                            "content": message,
-                            "previous_sender": replied_message["sender"],
-                            "previous_message_content": previous_message_content,
-                            "previous_message_id": previous_message_id,
-                            "sender": self.username,
-                            "created": format(created, "M. d, Y"),
-                            "time": format(created, "P"),
-                        },
+                        chamber_event(
+                            "chat.reply",
+                            self.chamber_id,
+                            reply_format="text",
+                            id=str(reply_id),
+                            content=message,
+                            previous_sender=replied_message["sender"],
+                            previous_message_content=previous_message_content,
+                            previous_message_id=previous_message_id,
+                            sender=self.username,
+                            timestamp=created,
+                            seq=seq,
+                        ),
                     )
             elif message_type == "typing":
-                print("hiiiiii")
-                await self.channel_layer.group_send(
-                    self.chamber_group_name,
-                    {
-                        "type": "chat.typing",
-                        "username": self.username,
-                        "content": (
-                            f"{self.user} is typing..." if message == "typing" else None
-                        ),
-                    },
+                # Typing signals are coalesced per chamber and broadcast periodically
+                typing_aggregator.update(
+                    self.chamber_id,
+                    self.user.id,
+                    self.username,
+                    message == "typing",
+                    self.channel_layer,
                 )
+            elif message_type == "batch_frames":
+                # Opt-in: receive events as array frames (see 'chat.outbound')
+                if text_data_json.get("enabled", True):
+                    self.outbound.enable_batching(self.codec.encode_batch)
+                else:
+                    self.outbound.disable_batching()
+            elif message_type in ("upload_begin", "upload_offset", "upload_commit"):
+                await self.handle_upload_control(message_type, text_data_json)
         elif bytes_data:
             """
-            Seperates the bytes data into its audio and json components using the delimiter(plain text).
-            Audio data is base64-encoded, while Json data is decoded and loaded into a metadata variable.
-            The message is then processed and sent as normal audio, or as an audio reply.
+            Separates the binary frame into its JSON metadata and media payload (see 'chat.frames').
+            The media is written once to storage and only a reference (url, size, content type)
+            is broadcast to the group, instead of the encoded payload itself.
+            The message is then processed and sent as normal media, or as a media reply.
+            Frames with an 'upload_chunk' message type carry one chunk of a chunked upload.
             """
-            # Define the delimiter
-            delimiter = b"<delimiter>"
-
-            # Separate the JSON metadata from the audio data using the delimiter
-            if delimiter in bytes_data:
-                json_data, media_data = bytes_data.split(delimiter, 1)
-
-                # Decode the JSON metadata
-                metadata = json.loads(json_data.decode("utf-8"))
-                message_type = metadata.get("message_type")
-                media_type = metadata.get("media_type")
-
-                # Handle binary data (audio message)
-                filename = await generate_random_filename(media_type)
-                message = b64encode(media_data).decode(
-                    "utf-8"
-                )  # Encode to base64 for sending as text
-
-                if message_type != "reply":
-                    media_message_id, created = await create_new_media_message(
-                        media_type, self.user, self.chamber
-                    )
+            try:
+                metadata, media_data = parse_frame(bytes_data)
+            except FrameError:
+                return
 
-                    await self.channel_layer.group_send(
-                        self.chamber_group_name,
-                        {
-                            "type": "chat.media",
-                            "id": str(media_message_id),
-                            "content": message,
-                            "filename": filename,
-                            "sender": self.username,
-                            "created": format(created, "M. d, Y"),
-                            "time": format(created, "P"),
-                        },
-                    )
-                    await update_media_message(
-                        media_message_id, message, filename, media_type
-                    )
-                else:
-                    """
-                    For 'reply' messages.
-                    """
-                    previous_message_content = None
-                    previous_message_id = metadata.get("previous_message_id")
-                    replied_message = await get_replied_message(
-                        previous_message_id, self.chamber
+            message_type = metadata.get("message_type")
+            media_type = metadata.get("media_type")
+
+            if message_type == "upload_chunk":
+                await self.handle_upload_chunk(metadata, media_data)
+                return
+
+            async def store_media(media_message_id, filename):
+                return await save_media_message(
+                    media_message_id, media_data, filename, media_type
+                )
+
+            previous_message_id = (
+                metadata.get("previous_message_id") if message_type == "reply" else None
+            )
+            await self.send_media_message(media_type, store_media, previous_message_id)
+
+    async def send_media_message(
+        self, media_type, store_media, previous_message_id=None
+    ):
+        """
+        Creates the media message (or media reply), stores its file through 'store_media'
+        and broadcasts a reference to it.
+        """
+        filename = await generate_random_filename(media_type)
+
+        if previous_message_id is None:
+            media_message_id, created, seq = await create_new_media_message(
+                media_type, self.user, self.chamber_id
+            )
+            media_reference = await store_media(media_message_id, filename)
+
+            await self.channel_layer.group_send(
+                self.chamber_group_name,
+                chamber_event(
+                    "chat.media",
+                    self.chamber_id,
+                    id=str(media_message_id),
+                    **media_reference,
+                    filename=filename,
+                    sender=self.username,
+                    timestamp=created,
+                    seq=seq,
+                ),
+            )
+        else:
+            """
+            For 'reply' messages.
+            """
+            previous_message_content = None
+            replied_message = await get_replied_message(
+                previous_message_id, self.chamber_id
+            )
+            if replied_message["message_type"] == "IMG":
+                previous_message_content = "IMAGE"
+            elif replied_message["message_type"] == "AUD":
+                previous_message_content = "AUDIO"
+            elif replied_message["message_type"] == "VID":
+                previous_message_content = "VIDEO"
+            else:
+                previous_message_content = replied_message["text_content"]
+
+            reply_id, created, seq = await create_new_reply(
+                self.user,
+                replied_message["sender"],
+                previous_message_content,
+                previous_message_id,
+                self.chamber_id,
+                media_type=media_type,
+            )
+            media_reference = await store_media(reply_id, filename)
+            await self.channel_layer.group_send(
+                self.chamber_group_name,
+                chamber_event(
+                    "chat.reply",
+                    self.chamber_id,
+                    reply_format="media",
+                    id=str(reply_id),
+                    **media_reference,
+                    filename=filename,
+                    previous_sender=replied_message["sender"],
+                    previous_message_content=previous_message_content,
+                    previous_message_id=previous_message_id,
+                    timestamp=created,
+                    seq=seq,
+                    sender=self.username,
+                ),
+            )
+
+    async def handle_upload_control(self, message_type, data):
+        """
+        Handles the chunked upload protocol:
+        'upload_begin' registers an upload and returns its id and chunk size,
+        'upload_offset' reports how much has been received (for resuming after a reconnect),
+        'upload_commit' creates the media message from the assembled file and broadcasts it.
+        """
+        try:
+            if message_type == "upload_begin":
+                upload = chunked_uploads.begin(
+                    self.user.id,
+                    self.chamber_id,
+                    data.get("media_type"),
+                    data.get("size"),
+                    metadata={"previous_message_id": data.get("previous_message_id")},
+                )
+                await self.send_upload_event("upload.ready", upload)
+                return
+
+            upload = chunked_uploads.get(
+                data.get("upload_id"), self.user.id, self.chamber_id
+            )
+            if message_type == "upload_offset":
+                await self.send_upload_event("upload.offset", upload)
+            elif message_type == "upload_commit":
+                if not upload.is_complete:
+                    raise UploadError(
+                        f"Upload is incomplete: {upload.offset} of {upload.size} bytes received."
                     )
-                    if replied_message["message_type"] == "IMG":
-                        previous_message_content = "IMAGE"
-                    elif replied_message["message_type"] == "AUD":
-                        previous_message_content = "AUDIO"
-                    elif replied_message["message_type"] == "VID":
-                        previous_message_content = "VIDEO"
-                    else:
-                        previous_message_content = replied_message["text_content"]
 
-                    reply_id, created = await create_new_reply(
-                        self.user,
-                        replied_message["sender"],
-                        previous_message_content,
-                        previous_message_id,
-                        self.chamber,
-                        media_type=media_type,
+                async def store_media(media_message_id, filename):
+                    return await save_uploaded_media_message(
+                        media_message_id, upload, filename
                     )
-                    await self.channel_layer.group_send(
-                        self.chamber_group_name,
-                        {
-                            "type": "chat.reply",
-                            "reply_format": "media",
-                            "id": str(reply_id),
-                            "content": message,
-                            "filename": filename,
-                            "previous_sender": replied_message["sender"],
-                            "previous_message_content": previous_message_content,
-                            "previous_message_id": previous_message_id,
-                            "time": format(created, "P"),
-                            "created": format(created, "M. d, Y"),
-                            "sender": self.username,
-                        },
+
+                try:
+                    await self.send_media_message(
+                        upload.media_type,
+                        store_media,
+                        upload.metadata.get("previous_message_id"),
                     )
-                    await update_media_message(reply_id, message, filename, media_type)
+                finally:
+                    chunked_uploads.discard(upload)
+        except UploadError as error:
+            await self.send_upload_error(data.get("upload_id"), error)
 
-    # Receive message from chamber group
-    async def chat_notification(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+    async def handle_upload_chunk(self, metadata, chunk_data):
+        try:
+            upload = chunked_uploads.get(
+                metadata.get("upload_id"), self.user.id, self.chamber_id
+            )
+            await sync_to_async(upload.append, thread_sensitive=False)(
+                metadata.get("chunk"), chunk_data
+            )
+            await self.send_upload_event("upload.ack", upload)
+        except UploadError as error:
+            await self.send_upload_error(metadata.get("upload_id"), error)
 
-    async def chat_active(self, event):
-        text_data = json.dumps(event)
-        await self.send(text_data)
+    async def send_upload_event(self, event_type, upload):
+        await self.send_payload({"type": event_type, **upload.state()})
 
-    async def chat_message(self, event):  # Handler for chat.message
-        text_data = json.dumps(event)
-        await self.send(text_data)
+    async def send_upload_error(self, upload_id, error):
+        await self.send_payload(
+            {"type": "upload.error", "upload_id": upload_id, "content": str(error)}
+        )
 
-    async def chat_reply(self, event):  # Handler for chat.reply
-        text_data = json.dumps(event)
-        await self.send(text_data)
 
-    async def chat_typing(self, event):  # Handler for chat.typing
-        text_data = json.dumps(event)
-        await self.send(text_data)
+class UserConsumer(ChamberEventConsumer):
+    """
+    One websocket per user for live events from many chambers. The user is
+    authenticated once at connect; chambers are then added and removed with
+    'subscribe' / 'unsubscribe' control messages:
 
-    async def chat_media(self, event):  # Handler for chat.audio
-        text_data = json.dumps(event)
-        await self.send(text_data)
+        {"message_type": "subscribe", "chamber_ids": [...], "last_seq": {chamber id: seq}}
+        {"message_type": "unsubscribe", "chamber_ids": [...]}
+
+    Each is answered with 'chat.subscribed' / 'chat.unsubscribed'. Membership comes
+    from the in-memory chamber index, and every event payload carries its 'chamber_id'.
+    Messages are still posted through the chamber's own endpoint.
+    """
+
+    tag_events = True
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.chamber_ids = set()
+
+    async def handshake(self):
+        headers = dict(self.scope["headers"])
+        user = await confirm_authorization(headers)
+        if user is None:
+            await self.close(code=4001)
+            return
+        if not await self.admit(user):
+            return
+        self.user = user
+        self.username = user.username
+
+        self.codec, subprotocol = negotiate_codec(self.scope.get("subprotocols", []))
+        presence.connect(self.user.id)
+        await self.accept(subprotocol)
+        self.outbound = OutboundQueue(self.write_frame, self.close)
+
+    async def disconnect(self, close_code):
+        if self.user is None:
+            return
+        if self.outbound is not None:
+            self.outbound.stop()
+            self.outbound = None
+        for chamber_id in list(self.chamber_ids):
+            await self.unsubscribe(chamber_id)
+        presence.disconnect(self.user.id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        codec = json_codec if text_data else self.codec
+        if not text_data and not (bytes_data and self.codec.accepts(bytes_data)):
+            return
+        try:
+            data = codec.decode(text_data or bytes_data)
+        except CodecError:
+            return
+        message_type = data.get("message_type")
+        chamber_ids = data.get("chamber_ids")
+        if message_type in ("subscribe", "unsubscribe") and not isinstance(
+            chamber_ids, list
+        ):
+            return
+
+        if message_type == "subscribe":
+            last_seq = data.get("last_seq")
+            await self.handle_subscribe(
+                chamber_ids, last_seq if isinstance(last_seq, dict) else {}
+            )
+        elif message_type == "unsubscribe":
+            unsubscribed = []
+            for chamber_id in chamber_ids:
+                chamber_id = chamber_index.normalize(chamber_id)
+                if chamber_id in self.chamber_ids:
+                    await self.unsubscribe(chamber_id)
+                    unsubscribed.append(chamber_id)
+            await self.send_payload(
+                {"type": "chat.unsubscribed", "chamber_ids": unsubscribed}
+            )
+        elif message_type == "batch_frames":
+            if data.get("enabled", True):
+                self.outbound.enable_batching(self.codec.encode_batch)
+            else:
+                self.outbound.disable_batching()
+
+    async def handle_subscribe(self, chamber_ids, last_seq):
+        subscribed, rejected = [], []
+        max_chambers = settings.USER_SOCKET["MAX_CHAMBERS"]
+        for requested_id in chamber_ids:
+            chamber_id = chamber_index.normalize(requested_id)
+            if chamber_id in self.chamber_ids:
+                subscribed.append(chamber_id)
+                continue
+            if (
+                chamber_id is None
+                or len(self.chamber_ids) >= max_chambers
+                or not await check_user_in_chamber(self.user.id, chamber_id)
+            ):
+                rejected.append(requested_id)
+                continue
+            await self.channel_layer.group_add(chamber_id, self.channel_name)
+            self.chamber_ids.add(chamber_id)
+            chamber_activity.join(chamber_id, self.user.id, self.channel_layer)
+            subscribed.append(chamber_id)
+
+        await self.send_payload(
+            {"type": "chat.subscribed", "chamber_ids": subscribed, "rejected": rejected}
+        )
+        for chamber_id in subscribed:
+            seq = last_seq.get(chamber_id)
+            if isinstance(seq, int) and seq >= 0:
+                await self.replay_missed_events(chamber_id, seq)
+
+    async def unsubscribe(self, chamber_id):
+        self.chamber_ids.discard(chamber_id)
+        self.visible_typists.pop(chamber_id, None)
+        await self.channel_layer.group_discard(chamber_id, self.channel_name)
+        chamber_activity.leave(chamber_id, self.user.id, self.channel_layer)
+        if not chamber_activity.count(chamber_id):
+            recent_events.discard(chamber_id)
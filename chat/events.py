@@ -0,0 +1,168 @@
+from django.conf import settings
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+from .codecs import json_codec
+
+
+# Identifies this process in events that carry its share of a chamber-wide value
+PROCESS_ID = uuid4().hex
+
+
+class EncodedEvents:
+    """
+    Per-process memo of chamber event encodings keyed by event id, so each codec encodes
+    a broadcast once however many local connections receive it.
+    Events built by another process are rebuilt from their JSON text and the
+    event's ISO 'timestamp', so every process encodes them the same way.
+    """
+
+    def __init__(self):
+        self._events = (
+            OrderedDict()
+        )  # event id -> {"payload": ..., subprotocol: encoded}
+        # Replays build events in worker threads while the event loop encodes
+        self._lock = Lock()
+
+    def add(self, event_id, payload, text):
+        return self._store(
+            event_id, {"payload": payload, json_codec.subprotocol: text}, replace=True
+        )
+
+    def _store(self, event_id, entry, replace=False):
+        with self._lock:
+            if replace or event_id not in self._events:
+                self._events[event_id] = entry
+            entry = self._events[event_id]
+            while len(self._events) > settings.WEBSOCKET_CODECS["MEMO_SIZE"]:
+                self._events.popitem(last=False)
+        return entry
+
+    def encode(self, codec, event, tagged=False):
+        """
+        'tagged' adds the event's chamber id to the payload, for connections that
+        receive events from several chambers.
+        """
+        with self._lock:
+            entry = self._events.get(event["event_id"])
+        if entry is None:
+            entry = self._store(
+                event["event_id"],
+                {"payload": self.rebuild(event), json_codec.subprotocol: event["text"]},
+            )
+
+        key = f"{codec.subprotocol}+chamber_id" if tagged else codec.subprotocol
+        encoded = entry.get(key)
+        if encoded is None:
+            payload = entry["payload"]
+            if tagged:
+                payload = {**payload, "chamber_id": event["chamber_id"]}
+            # Two threads may encode the same event; either result is kept
+            encoded = entry[key] = codec.encode(payload)
+        return encoded
+
+    @staticmethod
+    def rebuild(event):
+        """
+        Returns the codec-neutral payload of an event built by another process: the
+        JSON text with the rendered 'created' and 'time' swapped back for 'timestamp'.
+        """
+        payload = json_codec.decode(event["text"])
+        if event.get("timestamp") is None:
+            return payload
+        timestamp = datetime.fromisoformat(event["timestamp"])
+        rebuilt = {}
+        for key, value in payload.items():
+            if key == "created":
+                rebuilt["timestamp"] = timestamp
+            elif key != "time":
+                rebuilt[key] = value
+        return rebuilt
+
+
+encoded_events = EncodedEvents()
+
+
+def chamber_event(event_type, chamber_id, **content):
+    """
+    Builds a chamber group event whose wire payload is encoded once, at 'group_send'
+    time, instead of once per recipient. The JSON encoding travels with the event;
+    other codecs encode it at most once per process (see 'EncodedEvents').
+    The payload keeps 'type', which clients dispatch on; the channel layer event
+    itself carries nothing but the handler type, the chamber id, the event id, the
+    encoded text, the ISO timestamp (which the text only holds formatted) and, for
+    messages, the sequence number (used by 'chat.replay').
+    """
+    payload = {"type": event_type, **content}
+    event_id = uuid4().hex
+    text = json_codec.encode(payload)
+    encoded_events.add(event_id, payload, text)
+    event = {
+        "type": event_type,
+        "chamber_id": str(chamber_id),
+        "event_id": event_id,
+        "text": text,
+    }
+    if content.get("timestamp") is not None:
+        event["timestamp"] = content["timestamp"].isoformat()
+    if content.get("seq") is not None:
+        event["seq"] = content["seq"]
+    return event
+
+
+class RemoteShares:
+    """
+    Other processes' shares of a chamber-wide value (connected members, typists), from
+    the snapshots they broadcast to the chamber group. Each process broadcasts only what
+    it holds itself; receivers combine the snapshots with their own share.
+    Snapshots not refreshed within a TTL belong to processes that are gone.
+    """
+
+    def __init__(self):
+        self._shares = {}  # chamber id -> {process id: [snapshot, received at]}
+
+    def update(self, chamber_id, process_id, snapshot):
+        """
+        Records a process's snapshot (an empty one withdraws its share). Returns
+        whether the process was not known to hold a share of the chamber yet.
+        """
+        if process_id == PROCESS_ID:
+            return False  # This process's own share is always current
+        shares = self._shares.setdefault(chamber_id, {})
+        known = process_id in shares
+        if snapshot:
+            shares[process_id] = [snapshot, monotonic()]
+        else:
+            shares.pop(process_id, None)
+        if not shares:
+            del self._shares[chamber_id]
+        return bool(snapshot) and not known
+
+    def snapshots(self, chamber_id, ttl):
+        shares = self._shares.get(chamber_id, {})
+        now = monotonic()
+        expired = [
+            process_id
+            for process_id, (_, received) in shares.items()
+            if now - received > ttl
+        ]
+        for process_id in expired:
+            del shares[process_id]
+        if not shares:
+            self._shares.pop(chamber_id, None)
+        return [snapshot for snapshot, _ in shares.values()]
+
+    def expire(self, ttl):
+        for chamber_id in list(self._shares):
+            self.snapshots(chamber_id, ttl)
+
+    def discard(self, chamber_id):
+        """
+        Forgets a chamber this process no longer receives events for.
+        """
+        self._shares.pop(chamber_id, None)
+
+    def __len__(self):
+        return sum(len(shares) for shares in self._shares.values())
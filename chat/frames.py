@@ -0,0 +1,59 @@
+from struct import Struct
+import json
+
+
+FRAME_MAGIC = b"WSPR"
+FRAME_VERSION = 1
+# Magic, version, metadata length, payload length (network byte order)
+FRAME_HEADER = Struct("!4sBII")
+LEGACY_DELIMITER = b"<delimiter>"
+
+
+class FrameError(Exception):
+    pass
+
+
+def build_frame(metadata, payload):
+    """
+    Builds a versioned binary frame: fixed header, JSON metadata, then the raw payload.
+    """
+    json_data = json.dumps(metadata).encode("utf-8")
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(json_data), len(payload))
+    return b"".join([header, json_data, payload])
+
+
+def parse_frame(bytes_data):
+    """
+    Splits a binary frame into its decoded JSON metadata and a memoryview of the payload.
+    The payload is sliced by offset, so it is never scanned or copied.
+    Frames without the magic prefix are parsed in the legacy
+    'JSON metadata + <delimiter> + payload' format.
+    """
+    view = memoryview(bytes_data)
+    if view[: len(FRAME_MAGIC)] == FRAME_MAGIC:
+        if len(view) < FRAME_HEADER.size:
+            raise FrameError("Frame is shorter than its header.")
+        _, version, metadata_length, payload_length = FRAME_HEADER.unpack_from(view)
+        if version != FRAME_VERSION:
+            raise FrameError(f"Unsupported frame version {version}.")
+
+        metadata_end = FRAME_HEADER.size + metadata_length
+        if metadata_end + payload_length != len(view):
+            raise FrameError("Frame length does not match its header.")
+
+        json_data = view[FRAME_HEADER.size : metadata_end]
+        payload = view[metadata_end:]
+    else:
+        # The delimiter directly follows the (small) metadata, so the search stops there
+        metadata_end = bytes_data.find(LEGACY_DELIMITER)
+        if metadata_end == -1:
+            raise FrameError("Frame has no header or delimiter.")
+
+        json_data = view[:metadata_end]
+        payload = view[metadata_end + len(LEGACY_DELIMITER) :]
+
+    try:
+        metadata = json.loads(json_data.tobytes())
+    except ValueError:
+        raise FrameError("Frame metadata is not valid JSON.")
+    return metadata, payload
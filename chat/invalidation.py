@@ -0,0 +1,151 @@
+from django.db import transaction
+from channels.layers import get_channel_layer, InMemoryChannelLayer
+from functools import partial
+from threading import Event, Lock, Thread
+from time import monotonic
+from .events import PROCESS_ID
+import asyncio
+
+
+class CacheInvalidations:
+    """
+    Shares invalidations of the per-process caches (chamber membership, principals)
+    with the other processes of a deployment, through the GROUP control group of the
+    channel layer. Each process receives them on one channel, from a thread with its
+    own event loop, so they reach the caches whether those are used from the event
+    loop or from worker threads.
+
+    Caches only keep entries while 'coherent()': always with the in-memory layer, which
+    no other process shares, and otherwise only while this process is listening.
+    Invalidations sent while a broker link was down are lost, so the caches are
+    cleared when the link is reopened and when the listener stops.
+    """
+
+    GROUP = "chat.invalidations"
+    CONNECT_TIMEOUT = 1  # Seconds the first lookup waits for the listener to start
+    RETRY_DELAY = 5  # Seconds before a listener that failed is started again
+    CHECK_INTERVAL = 1  # How often the listener looks for reopened links
+
+    def __init__(self):
+        self._handlers = {}  # kind -> function called with the invalidation's args
+        self._clears = []  # functions dropping every entry of a cache
+        self._lock = Lock()
+        self._layer = None  # layer the listener receives from
+        self._loop = None
+        self._thread = None
+        self._listening = Event()
+        self._retry_at = float("-inf")
+        self.sent = 0
+        self.received = 0
+
+    def register(self, kind, handler, clear=None):
+        self._handlers[kind] = handler
+        if clear is not None:
+            self._clears.append(clear)
+
+    def coherent(self):
+        """
+        Whether caches may keep entries: changes made by other processes reach them.
+        """
+        layer = get_channel_layer()
+        if layer is None or isinstance(layer, InMemoryChannelLayer):
+            return True
+        return self._listen(layer)
+
+    def publish(self, kind, *args):
+        """
+        Sends an invalidation to the other processes once the current transaction
+        commits, so none of them reloads the data before the change is visible.
+        'args' must be JSON serializable.
+        """
+        transaction.on_commit(partial(self._send, kind, list(args)))
+
+    def _send(self, kind, args):
+        layer = get_channel_layer()
+        if layer is None or isinstance(layer, InMemoryChannelLayer):
+            return
+        if not self._listen(layer):
+            return  # Without the broker, no process is caching
+        self.sent += 1
+        asyncio.run_coroutine_threadsafe(
+            layer.group_send(
+                self.GROUP,
+                {
+                    "type": "cache.invalidate",
+                    "process": PROCESS_ID,
+                    "kind": kind,
+                    "args": args,
+                },
+            ),
+            self._loop,
+        )
+
+    def _listen(self, layer):
+        with self._lock:
+            if self._layer is layer and self._thread.is_alive():
+                return self._listening.is_set()
+            if self._layer is layer and monotonic() < self._retry_at:
+                return False
+            self._layer = layer
+            self._listening = listening = Event()
+            self._retry_at = monotonic() + self.RETRY_DELAY
+            self._thread = Thread(
+                target=asyncio.run,
+                args=(self._run(layer, listening),),
+                name="cache-invalidations",
+                daemon=True,
+            )
+            self._thread.start()
+        return listening.wait(self.CONNECT_TIMEOUT)
+
+    def stop(self):
+        with self._lock:
+            thread, self._layer = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    async def _run(self, layer, listening):
+        try:
+            channel = await layer.new_channel()
+            await layer.group_add(self.GROUP, channel)
+            reconnects = getattr(layer, "reconnects", 0)
+            self._loop = asyncio.get_running_loop()
+            listening.set()
+            receiver = asyncio.ensure_future(self._receive(layer, channel))
+            while self._layer is layer and not receiver.done():
+                await asyncio.wait({receiver}, timeout=self.CHECK_INTERVAL)
+                if getattr(layer, "reconnects", 0) != reconnects:
+                    reconnects = layer.reconnects
+                    self.clear()
+            if receiver.done():
+                receiver.result()
+            receiver.cancel()
+        except OSError:
+            pass  # The broker is unreachable; started again after RETRY_DELAY
+        finally:
+            listening.clear()
+            self.clear()
+
+    async def _receive(self, layer, channel):
+        while True:
+            message = await layer.receive(channel)
+            self.received += 1
+            if message.get("process") == PROCESS_ID:
+                continue  # Already applied where it was made
+            handler = self._handlers.get(message.get("kind"))
+            if handler is not None:
+                handler(*message.get("args", ()))
+
+    def clear(self):
+        for clear in self._clears:
+            clear()
+
+    def stats(self):
+        return {
+            "listening": self._listening.is_set(),
+            "sent": self.sent,
+            "received": self.received,
+        }
+
+
+cache_invalidations = CacheInvalidations()
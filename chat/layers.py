@@ -0,0 +1,291 @@
+from channels.layers import BaseChannelLayer
+from time import time
+from uuid import uuid4
+import asyncio
+from .broker import (
+    BrokerError,
+    broker_link_secret,
+    open_broker_connection,
+    read_frame,
+    write_frame,
+)
+
+
+class BrokerConnectionLost(ConnectionError):
+    pass
+
+
+class BrokerConnection:
+    """
+    One connection to the broker, owned by one event loop, with the process-specific
+    channels created on that loop. Operations queued during one loop iteration are
+    written as a single frame.
+
+    A lost link is reopened with the same client id (so channel names stay valid),
+    with backoff, up to RECONNECT_ATTEMPTS times; group memberships and unacknowledged
+    requests are sent again, and operations queued meanwhile (at most
+    MAX_QUEUED_OPERATIONS) follow. Receivers only fail once reconnecting gives up.
+    """
+
+    RECONNECT_ATTEMPTS = 20
+    RECONNECT_DELAY = (
+        0.1  # Doubled after each failed attempt, up to MAX_RECONNECT_DELAY
+    )
+    MAX_RECONNECT_DELAY = 5
+    MAX_QUEUED_OPERATIONS = 10000
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.client_id = uuid4().hex
+        self.channels = {}  # channel -> asyncio.Queue of (expires, message)
+        self.memberships = set()  # (group, channel) added through this connection
+        self.closed = False
+        self._writer = None
+        self._reader_task = None
+        self._operations = []
+        self._acks = {}  # ack id -> future
+        self._requests = {}  # ack id -> operation awaiting its ack
+        self.opened = asyncio.get_running_loop().create_task(self._open())
+
+    async def _open(self):
+        reader, writer = await open_broker_connection(self.layer.address)
+        # Memberships and requests the broker may have lost with a previous link
+        resubscribe = [
+            ["group_add", group, channel, uuid4().hex]
+            for group, channel in self.memberships
+        ]
+        write_frame(
+            writer,
+            [
+                ["hello", self.client_id, broker_link_secret()],
+                *resubscribe,
+                *self._requests.values(),
+            ],
+        )
+        self._writer = writer
+        self._write_operations()
+        self._reader_task = asyncio.get_running_loop().create_task(
+            self._read_deliveries(reader)
+        )
+
+    def queue(self, operation):
+        if self.closed:
+            raise BrokerConnectionLost("Connection to the channel broker was lost.")
+        if len(self._operations) >= self.MAX_QUEUED_OPERATIONS:
+            self.layer.dropped += 1  # Reconnecting; the oldest operations go first
+            self._operations.pop(0)
+        self._operations.append(operation)
+        if len(self._operations) == 1:
+            asyncio.get_running_loop().call_soon(self._write_operations)
+
+    def _write_operations(self):
+        if self._writer is None or self.closed:
+            return  # Written once the connection is reopened
+        operations, self._operations = self._operations, []
+        if operations:
+            write_frame(self._writer, operations)
+
+    async def request(self, operation):
+        ack_id = uuid4().hex
+        future = self._acks[ack_id] = asyncio.get_running_loop().create_future()
+        self._requests[ack_id] = [*operation, ack_id]
+        if self._writer is not None:
+            self.queue(self._requests[ack_id])
+        elif self.closed:
+            raise BrokerConnectionLost("Connection to the channel broker was lost.")
+        await future
+
+    async def _read_deliveries(self, reader):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                for item in frame:
+                    if item[0] == "deliver":
+                        self._deliver(item[1], item[2])
+                    elif item[0] == "ack":
+                        self._requests.pop(item[1], None)
+                        future = self._acks.pop(item[1], None)
+                        if future is not None and not future.done():
+                            future.set_result(None)
+        except BrokerError:
+            pass  # A corrupt link is reopened like a lost one
+        except asyncio.CancelledError:
+            self.close()  # The event loop is shutting down
+            raise
+        finally:
+            if not self.closed:
+                self._writer.close()
+                self._writer = None
+                asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_DELAY
+        for _ in range(self.RECONNECT_ATTEMPTS):
+            await asyncio.sleep(delay)
+            if self.closed:
+                return
+            try:
+                await self._open()
+            except OSError:
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                continue
+            self.layer.reconnects += 1
+            return
+        self.close(lost=True)
+
+    def _deliver(self, channels, message):
+        expires = time() + self.layer.expiry
+        for channel in channels:
+            queue = self.channels.get(channel)
+            if queue is None:
+                continue  # The channel's consumer is gone
+            if queue.qsize() >= self.layer.get_capacity(channel):
+                self.layer.dropped += 1
+                continue
+            # Each receiver gets its own copy, as with the in-memory layer
+            queue.put_nowait((expires, dict(message)))
+
+    def close(self, lost=False):
+        if self.closed:
+            return
+        self.closed = True
+        self.layer.forget(self)
+        for future in self._acks.values():
+            if not future.done():
+                future.set_exception(
+                    BrokerConnectionLost("Connection to the channel broker was lost.")
+                )
+        if lost:
+            # Wake receivers so their consumers fail instead of waiting forever
+            for queue in self.channels.values():
+                queue.put_nowait((None, None))
+        if self._reader_task is not None and not lost:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer shared by several processes (and machines) through the broker run by
+    'python manage.py runbroker' (see 'chat.broker'). Each event loop gets its own
+    connection; messages for this process's channels are queued locally, bounded by
+    'capacity' (extra messages are dropped and counted) and discarded after 'expiry'.
+    Only process-specific channels (the ones consumers use) can receive messages.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        address="unix:///tmp/whisper-broker.sock",
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs,
+    ):
+        super().__init__(
+            expiry=expiry, capacity=capacity, channel_capacity=channel_capacity
+        )
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.address = address
+        self._connections = {}  # event loop -> connection
+        self.dropped = 0
+        self.reconnects = 0
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None:
+            for closed_loop in [loop for loop in self._connections if loop.is_closed()]:
+                del self._connections[closed_loop]
+            connection = self._connections[loop] = BrokerConnection(self)
+        try:
+            await asyncio.shield(connection.opened)
+        except OSError:
+            self.forget(connection)
+            raise
+        return connection
+
+    def forget(self, connection):
+        for loop, known in list(self._connections.items()):
+            if known is connection:
+                del self._connections[loop]
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        connection = await self._connection()
+        connection.queue(["send", channel, message])
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        connection = await self._connection()
+        queue = connection.channels.get(channel)
+        if queue is None:
+            if connection.client_id not in channel:
+                raise NotImplementedError(
+                    "The broker layer only receives on channels from new_channel()."
+                )
+            queue = connection.channels[channel] = asyncio.Queue()
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires is None:
+                    raise BrokerConnectionLost(
+                        "Connection to the channel broker was lost."
+                    )
+                if expires >= time():
+                    return message
+        except asyncio.CancelledError:
+            # The consumer is stopping; its channel goes with it unless messages wait
+            if queue.empty():
+                connection.channels.pop(channel, None)
+            raise
+
+    async def new_channel(self, prefix="specific"):
+        connection = await self._connection()
+        channel = f"{prefix}.{connection.client_id}!{uuid4().hex[:12]}"
+        connection.channels[channel] = asyncio.Queue()
+        return channel
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        connection = await self._connection()
+        connection.memberships.add((group, channel))
+        await connection.request(["group_add", group, channel])
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        connection = await self._connection()
+        connection.memberships.discard((group, channel))
+        connection.queue(["group_discard", group, channel])
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        connection = await self._connection()
+        connection.queue(["group_send", group, message])
+
+    async def flush(self):
+        for connection in list(self._connections.values()):
+            connection.close()
+        self._connections = {}
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self):
+        return {
+            "connections": len(self._connections),
+            "channels": sum(
+                len(connection.channels) for connection in self._connections.values()
+            ),
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+        }
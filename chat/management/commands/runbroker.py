@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+import asyncio
+from chat.broker import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = "Runs the channel broker shared by workers using the broker channel layer."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--address",
+            default=settings.CHANNEL_BROKER_ADDRESS,
+            help="unix:///path/to.sock or tcp://host:port",
+        )
+        parser.add_argument(
+            "--group-expiry",
+            type=int,
+            default=86400,
+            help="Seconds after which a group membership is dropped.",
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(options["address"], options["group_expiry"]))
+
+    async def serve(self, address, group_expiry):
+        broker = ChannelBroker(group_expiry=group_expiry)
+        server = await broker.start(address)
+        self.stdout.write(f"channel broker listening on {address}")
+        async with server:
+            await server.serve_forever()
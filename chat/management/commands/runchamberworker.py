@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+import asyncio
+from chat.affinity import ChamberAffinityRouter, ChamberWorker
+
+
+class Command(BaseCommand):
+    help = "Runs a chamber worker serving the websockets handed over by front doors."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--address",
+            required=True,
+            help="unix:///path/to.sock or tcp://host:port, as listed in CHAMBER_WORKERS",
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(options["address"]))
+
+    async def serve(self, address):
+        from portal.asgi import application
+
+        if isinstance(application, ChamberAffinityRouter):
+            application = application.application  # Serve chambers here, not forward
+        server = await ChamberWorker(application).start(address)
+        self.stdout.write(f"chamber worker listening on {address}")
+        async with server:
+            await server.serve_forever()
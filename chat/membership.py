@@ -0,0 +1,186 @@
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from uuid import UUID
+from .invalidation import cache_invalidations
+
+
+class ChamberEntry:
+    """
+    Cached chamber metadata and member ids.
+    """
+
+    __slots__ = ("id", "chambername", "creator_id", "created", "members", "loaded")
+
+    def __init__(self, chamber_id, chambername, creator_id, created, members):
+        self.id = chamber_id
+        self.chambername = chambername
+        self.creator_id = creator_id
+        self.created = created
+        self.members = members
+        self.loaded = monotonic()
+
+    def __str__(self):
+        return self.chambername
+
+    def has_member(self, user_id):
+        return user_id in self.members
+
+
+class ChamberMembershipIndex:
+    """
+    Per-process index of chamber id -> chamber metadata and member ids.
+    Chambers are loaded lazily on first use and kept coherent through the
+    'm2m_changed' and chamber save/delete signals (see 'chat.signals'), so the
+    websocket handshake does no database round trips once a chamber is warm.
+    The index holds at most MAX_CHAMBERS chambers, evicting the least recently used.
+    Other processes' changes arrive through 'chat.invalidation', and chambers are only
+    cached while they can; TTL bounds staleness should one be lost anyway.
+    A load that a signal invalidated while it was reading the database returns its
+    result without caching it.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._loading = {}  # key -> [loads in flight, invalidations since they began]
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(chamber_id):
+        try:
+            return str(UUID(str(chamber_id)))
+        except ValueError:
+            return None
+
+    def peek(self, chamber_id):
+        """
+        Returns the cached entry without touching the database, or None.
+        """
+        key = self.normalize(chamber_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if monotonic() - entry.loaded > settings.CHAMBER_MEMBERSHIP_INDEX["TTL"]:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get(self, chamber_id):
+        entry = self.peek(chamber_id)
+        if entry is None:
+            entry = self.load(chamber_id)
+        return entry
+
+    async def aget(self, chamber_id):
+        entry = self.peek(chamber_id)
+        if entry is None:
+            entry = await sync_to_async(self.load)(chamber_id)
+        return entry
+
+    def load(self, chamber_id):
+        from .models import Chamber
+
+        key = self.normalize(chamber_id)
+        if key is None:
+            return None
+        coherent = cache_invalidations.coherent()
+        with self._lock:
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+        entry = None
+        try:
+            chamber = (
+                Chamber.objects.filter(id=key)
+                .values("chambername", "creator_id", "created")
+                .first()
+            )
+            if chamber is not None:
+                members = set(
+                    Chamber.users.through.objects.filter(chamber_id=key).values_list(
+                        "user_id", flat=True
+                    )
+                )
+                entry = ChamberEntry(key, members=members, **chamber)
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[key]
+                if entry is not None:
+                    self.misses += 1
+                    # Changed while it was read: returned, but the next lookup reloads
+                    if loading[1] == generation and coherent:
+                        self._cache(key, entry)
+        return entry
+
+    def _cache(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > settings.CHAMBER_MEMBERSHIP_INDEX["MAX_CHAMBERS"]:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _invalidate(self, key=None):
+        # Must hold the lock; without a key, every load in flight is invalidated
+        for loading_key, loading in self._loading.items():
+            if key is None or loading_key == key:
+                loading[1] += 1
+
+    def add_members(self, chamber_id, user_ids):
+        key = self.normalize(chamber_id)
+        with self._lock:
+            self._invalidate(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.members.update(user_ids)
+
+    def remove_members(self, chamber_id, user_ids):
+        key = self.normalize(chamber_id)
+        with self._lock:
+            self._invalidate(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.members.difference_update(user_ids)
+
+    def remove_user(self, user_id):
+        with self._lock:
+            self._invalidate()
+            for entry in self._entries.values():
+                entry.members.discard(user_id)
+
+    def discard(self, chamber_id):
+        key = self.normalize(chamber_id)
+        with self._lock:
+            self._invalidate(key)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._invalidate()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chambers": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+chamber_index = ChamberMembershipIndex()
+# Changes made by other processes (published from 'chat.signals')
+cache_invalidations.register("chamber", chamber_index.discard, chamber_index.clear)
+cache_invalidations.register(
+    "chamber_member", lambda user_id: chamber_index.remove_user(UUID(user_id))
+)
@@ -11,9 +11,15 @@ from django.db.models import (
     ImageField,
     FileField,
     BooleanField,
+    PositiveBigIntegerField,
+    UniqueConstraint,
+    Index,
+    F,
 )
+from django.db.transaction import atomic
 from uuid import uuid4
 from user.utils import GenerateUUID
+from .utils import uuid7
 
 
 User = get_user_model()
@@ -25,6 +31,10 @@ class Chamber(Model):
     users = ManyToManyField(User)
     creator = ForeignKey(User, related_name="created_chambers", on_delete=CASCADE)
     created = DateTimeField(auto_now_add=True, db_index=True)
+    # Also touched when members are added or removed (see 'chat.signals')
+    updated = DateTimeField(auto_now=True, db_index=True)
+    # Sequence number of the chamber's latest message
+    last_seq = PositiveBigIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ["-created"]
@@ -41,7 +51,9 @@ class Chamber(Model):
 class Message(Model):
     from .utils import MessageType
 
-    id = UUIDField(primary_key=True, editable=False, default=uuid4)
+    # Time-ordered, so new rows are appended to the id indexes; history is still
+    # ordered by 'created' since older rows have uuid4 ids
+    id = UUIDField(primary_key=True, editable=False, default=uuid7)
     message_type = CharField(
         max_length=4, choices=MessageType.choices, default=MessageType.TEXT
     )
@@ -49,6 +61,8 @@ class Message(Model):
     image_content = ImageField(upload_to="images/", blank=True)
     audio_content = FileField(upload_to="audios/", blank=True)
     video_content = FileField(upload_to="videos/", blank=True)
+    # Bytes in the media file, recorded when it is stored so replays need no storage calls
+    media_size = PositiveBigIntegerField(blank=True, null=True, editable=False)
     is_reply = BooleanField(default=False)
     previous_message_content = TextField(blank=True, null=True)
     previous_message_id = UUIDField(blank=True, null=True)
@@ -57,9 +71,61 @@ class Message(Model):
     chamber = ForeignKey(Chamber, related_name="messages", on_delete=CASCADE)
     created = DateTimeField(auto_now_add=True, db_index=True)
     updated = DateTimeField(auto_now=True)
+    # Per-chamber, monotonically increasing; assigned at insert
+    seq = PositiveBigIntegerField(blank=True, null=True, editable=False)
 
     class Meta:
         ordering = ["-created"]
+        constraints = [
+            UniqueConstraint(fields=["chamber", "seq"], name="unique_chamber_seq")
+        ]
+        indexes = [
+            # Chamber history pages (see 'ChamberMessagePagination')
+            Index(fields=["chamber", "created", "id"], name="chamber_history_idx"),
+            # Latest change in a chamber, for conditional history requests
+            Index(fields=["chamber", "updated"], name="chamber_updated_idx"),
+        ]
 
     def __str__(self):
         return f"{self.get_message_type_display()} message from {self.sender}"
+
+    def save(self, *args, **kwargs) -> None:
+        if self._state.adding and self.seq is None:
+            with atomic():
+                self.seq = allocate_sequence(self.chamber_id)
+                return super().save(*args, **kwargs)
+        return super().save(*args, **kwargs)
+
+
+class PresenceLease(Model):
+    """
+    A process's lease on a user's online status, renewed while the user is connected
+    to that process (see 'chat.presence').
+    """
+
+    user = ForeignKey(User, related_name="presence_leases", on_delete=CASCADE)
+    process = CharField(max_length=32)
+    expires = DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["user", "process"], name="unique_presence_lease")
+        ]
+
+    def __str__(self):
+        return f"{self.user}'s presence lease from process {self.process}"
+
+
+def allocate_sequence(chamber_id, count=1):
+    """
+    Reserves 'count' sequence numbers in the chamber and returns the first one,
+    or None if the chamber does not exist. Must run inside a transaction, which
+    holds the chamber row (the database, on SQLite) until it commits.
+    """
+    Chamber.objects.filter(id=chamber_id).update(last_seq=F("last_seq") + count)
+    last_seq = (
+        Chamber.objects.filter(id=chamber_id).values_list("last_seq", flat=True).first()
+    )
+    if last_seq is None:
+        return None
+    return last_seq - count + 1
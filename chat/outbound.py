@@ -0,0 +1,167 @@
+from django.conf import settings
+from collections import deque
+import asyncio
+
+
+class OutboundCounters:
+    def __init__(self):
+        self.queues = set()
+        self.dropped = 0
+        self.coalesced = 0
+        self.overflow_closes = 0
+        self.failed_sends = 0
+
+    def stats(self):
+        return {
+            "connections": len(self.queues),
+            "queued": sum(len(queue) for queue in self.queues),
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "overflow_closes": self.overflow_closes,
+            "failed_sends": self.failed_sends,
+        }
+
+
+outbound_counters = OutboundCounters()
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection queue of encoded frames, drained by its own sender task,
+    so group handlers never wait on a slow client.
+    Ephemeral events (OUTBOUND_QUEUE['EPHEMERAL_EVENTS'], e.g. typing and active counts)
+    are coalesced: a newer one for the same chamber replaces the one still queued
+    (a user socket carries several chambers). Once MAX_SIZE frames are
+    queued, ephemeral events are dropped first; if only messages are left, 'put' returns
+    False and the connection is expected to close with the resync code, since the client
+    can no longer be sent a complete history.
+
+    With batching enabled (opt-in per client), frames queued within BATCH_WINDOW seconds,
+    up to BATCH_MAX_EVENTS, are combined into a single array frame.
+
+    If sending a frame fails (e.g. the transport is closing), the queue is closed: the
+    pending frames are dropped, 'put' returns False and 'close' is awaited.
+    """
+
+    def __init__(self, send, close=None):
+        self._send = send
+        self._close = close
+        self._items = deque()  # [(event type, chamber id), encoded frame]
+        self._latest = {}  # ephemeral (event type, chamber id) -> its queued item
+        self._ready = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._combine = None
+        self._task = asyncio.get_running_loop().create_task(self._run_sender())
+        self.overflowed = False
+        self.closed = False  # After an overflow or a failed send
+        outbound_counters.queues.add(self)
+
+    def __len__(self):
+        return len(self._items)
+
+    def enable_batching(self, combine):
+        """
+        'combine' joins a list of encoded frames into one frame.
+        """
+        self._combine = combine
+
+    def disable_batching(self):
+        self._combine = None
+
+    def put(self, event_type, data, chamber_id=None):
+        if self.closed:
+            return False
+        queue_settings = settings.OUTBOUND_QUEUE
+        ephemeral = event_type in queue_settings["EPHEMERAL_EVENTS"]
+        key = (event_type, chamber_id)
+
+        queued = self._latest.get(key)
+        if queued is not None:
+            queued[1] = data
+            outbound_counters.coalesced += 1
+            return True
+
+        if len(self._items) >= queue_settings["MAX_SIZE"]:
+            if ephemeral:
+                outbound_counters.dropped += 1
+                return True
+            if not self._drop_ephemeral():
+                self.overflowed = True
+                self._discard()
+                outbound_counters.overflow_closes += 1
+                return False
+
+        item = [key, data]
+        self._items.append(item)
+        if ephemeral:
+            self._latest[key] = item
+        self._ready.set()
+        if len(self._items) >= queue_settings["BATCH_MAX_EVENTS"]:
+            self._batch_full.set()
+        return True
+
+    def _drop_ephemeral(self):
+        for key, item in self._latest.items():
+            for index, queued in enumerate(self._items):
+                if queued is item:
+                    del self._items[index]
+                    break
+            del self._latest[key]
+            outbound_counters.dropped += 1
+            return True
+        return False
+
+    def _discard(self):
+        self.closed = True
+        self._items.clear()
+        self._latest.clear()
+
+    async def _run_sender(self):
+        try:
+            await self._drain()
+        except Exception:
+            # Nothing more can reach the client; the consumer's 'disconnect' stops us
+            self._discard()
+            outbound_counters.failed_sends += 1
+            if self._close is not None:
+                try:
+                    await self._close()
+                except Exception:
+                    pass  # The transport is already gone
+
+    async def _drain(self):
+        while True:
+            await self._ready.wait()
+            queue_settings = settings.OUTBOUND_QUEUE
+            if self._combine is not None:
+                # Let the rest of a burst arrive, unless a full batch is already queued
+                try:
+                    await asyncio.wait_for(
+                        self._batch_full.wait(), queue_settings["BATCH_WINDOW"]
+                    )
+                except TimeoutError:
+                    pass
+
+            while self._items:
+                if self._combine is None:
+                    await self._send(self._pop())
+                    continue
+                frames = [
+                    self._pop()
+                    for _ in range(
+                        min(len(self._items), queue_settings["BATCH_MAX_EVENTS"])
+                    )
+                ]
+                await self._send(self._combine(frames))
+            self._ready.clear()
+            self._batch_full.clear()
+
+    def _pop(self):
+        item = self._items.popleft()
+        if self._latest.get(item[0]) is item:
+            del self._latest[item[0]]
+        return item[1]
+
+    def stop(self):
+        self._task.cancel()
+        outbound_counters.queues.discard(self)
@@ -0,0 +1,372 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from datetime import timedelta
+from .events import chamber_event, RemoteShares, PROCESS_ID
+from time import monotonic
+import asyncio
+
+
+User = get_user_model()
+
+
+class PresenceService:
+    """
+    Tracks online users per process without a 'user.save()' per connect/disconnect.
+
+    - Connections are reference-counted per user, so closing one of several tabs
+      does not mark the user offline.
+    - A user whose last connection closes is only written offline after OFFLINE_GRACE
+      seconds, so rapid disconnect/reconnect flaps cost no writes at all.
+    - Pending changes are flushed every FLUSH_INTERVAL seconds as batched updates of
+      the 'is_online' and 'online_until' columns only ('updated'/'last_login' are untouched).
+    - 'online_until' is a lease renewed in one batch for every connected user. Any worker
+      sweeps expired leases offline, so users of a crashed worker do not stay online forever.
+    - Each process also holds its own 'PresenceLease' per connected user, and only writes
+      a user offline when no other process holds a live lease, so a user connected to
+      several workers stays online until they leave the last one.
+    - A failed flush is retried on the next interval; the flusher keeps running.
+    """
+
+    def __init__(self):
+        self._connections = {}  # user id -> open connections in this process
+        self._online = set()  # user ids written online by this process
+        self._disconnected = {}  # user id -> when its last connection closed
+        self._last_renewal = None
+        self._task = None
+        self._loop = None
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.writes = 0
+
+    def connect(self, user_id):
+        self._connections[user_id] = self._connections.get(user_id, 0) + 1
+        self._disconnected.pop(user_id, None)
+        self._ensure_flusher()
+
+    def disconnect(self, user_id):
+        count = self._connections.get(user_id, 0) - 1
+        if count > 0:
+            self._connections[user_id] = count
+        else:
+            self._connections.pop(user_id, None)
+            self._disconnected[user_id] = monotonic()
+            self._ensure_flusher()
+
+    def is_connected(self, user_id):
+        return user_id in self._connections
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        while self._connections or self._disconnected:
+            await asyncio.sleep(settings.PRESENCE["FLUSH_INTERVAL"])
+            try:
+                await self.flush()
+            except Exception:
+                pass  # Counted in 'failed_flushes' and retried on the next interval
+
+    async def flush(self, force=False):
+        """
+        Writes aggregate presence changes. 'force' skips the offline grace period.
+        """
+        presence_settings = settings.PRESENCE
+        now = monotonic()
+
+        disconnected = {
+            user_id: since
+            for user_id, since in self._disconnected.items()
+            if force or now - since >= presence_settings["OFFLINE_GRACE"]
+        }
+        for user_id in disconnected:
+            del self._disconnected[user_id]
+        went_offline = [user_id for user_id in disconnected if user_id in self._online]
+        self._online.difference_update(went_offline)
+
+        last_renewal = self._last_renewal
+        renew = (
+            last_renewal is None
+            or now - last_renewal >= presence_settings["LEASE_TTL"] / 2
+        )
+        if renew:
+            self._last_renewal = now
+            went_online = list(self._connections)
+        else:
+            went_online = [
+                user_id for user_id in self._connections if user_id not in self._online
+            ]
+        added = [user_id for user_id in went_online if user_id not in self._online]
+        self._online.update(went_online)
+
+        if went_online or went_offline or renew:
+            self.flushes += 1
+            try:
+                self.writes += await sync_to_async(self._write)(
+                    went_online, went_offline, sweep=renew
+                )
+            except Exception:
+                # Restore the pending changes, so the next flush retries them
+                self.failed_flushes += 1
+                self._online.difference_update(added)
+                self._online.update(went_offline)
+                for user_id in went_offline:
+                    if user_id not in self._connections:
+                        self._disconnected.setdefault(user_id, disconnected[user_id])
+                if renew:
+                    self._last_renewal = last_renewal
+                raise
+
+    def _write(self, went_online, went_offline, sweep=False):
+        from .models import PresenceLease
+
+        writes = 0
+        now = timezone.now()
+        if went_online:
+            expires = now + timedelta(seconds=settings.PRESENCE["LEASE_TTL"])
+            PresenceLease.objects.bulk_create(
+                [
+                    PresenceLease(user_id=user_id, process=PROCESS_ID, expires=expires)
+                    for user_id in went_online
+                ],
+                update_conflicts=True,
+                unique_fields=["user", "process"],
+                update_fields=["expires"],
+            )
+            User.objects.filter(id__in=went_online).update(
+                is_online=True, online_until=expires
+            )
+            writes += 2
+        if went_offline:
+            PresenceLease.objects.filter(
+                user_id__in=went_offline, process=PROCESS_ID
+            ).delete()
+            # Users still connected to another worker stay online
+            User.objects.filter(id__in=went_offline).exclude(
+                id__in=PresenceLease.objects.filter(expires__gt=now).values("user_id")
+            ).update(is_online=False, online_until=None)
+            writes += 2
+        if sweep:
+            # Leases that were not renewed belong to workers that are gone
+            PresenceLease.objects.filter(expires__lt=now).delete()
+            User.objects.filter(
+                Q(online_until__lt=now) | Q(online_until__isnull=True),
+                is_online=True,
+            ).update(is_online=False, online_until=None)
+            writes += 2
+        return writes
+
+    def stats(self):
+        return {
+            "connected_users": len(self._connections),
+            "connections": sum(self._connections.values()),
+            "pending_offline": len(self._disconnected),
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "writes": self.writes,
+        }
+
+
+class ChamberActivity:
+    """
+    Per-chamber count of connected members, maintained incrementally as consumers
+    join and leave, with debounced 'chat.active' broadcasts: the first change in a quiet
+    chamber is broadcast right away, and further changes within ACTIVE_INTERVAL seconds
+    are folded into a single trailing broadcast.
+
+    Processes exchange the members they hold through the ACTIVITY_GROUP control group,
+    which has one channel per process, and refresh them every ACTIVE_TTL / 2 seconds.
+    Each process counts the union of its own members and the other processes'
+    snapshots (see 'RemoteShares'), and sends its own connections only that count.
+    A process that sees a new share of a chamber it holds members of sends its own,
+    so newcomers catch up.
+    """
+
+    ACTIVITY_GROUP = "chat.activity"
+
+    def __init__(self):
+        self._members = {}  # chamber id -> {user id: open connections}
+        self._remote = RemoteShares()  # chamber id -> other processes' members
+        self._last_broadcast = {}  # chamber id -> when members were last sent
+        self._pending = {}  # chamber id -> scheduled broadcast task
+        self._delivered = {}  # chamber id -> count last sent to local connections
+        self._channel_layer = None
+        self._task = None
+        self._loop = None
+        self._listener_layer = None
+        self.broadcasts = 0
+        self.coalesced = 0
+
+    def count(self, chamber_id):
+        """
+        Members connected to this process.
+        """
+        return len(self._members.get(str(chamber_id), ()))
+
+    def total(self, chamber_id):
+        """
+        Members connected to any process.
+        """
+        chamber_id = str(chamber_id)
+        members = {str(user_id) for user_id in self._members.get(chamber_id, ())}
+        for snapshot in self._remote.snapshots(
+            chamber_id, settings.PRESENCE["ACTIVE_TTL"]
+        ):
+            members.update(snapshot)
+        return len(members)
+
+    def join(self, chamber_id, user_id, channel_layer):
+        members = self._members.setdefault(str(chamber_id), {})
+        members[user_id] = members.get(user_id, 0) + 1
+        self._channel_layer = channel_layer
+        if members[user_id] == 1:
+            # The new connection is sent the count, even if it did not change
+            self._delivered.pop(str(chamber_id), None)
+            self._schedule_broadcast(str(chamber_id))
+        self._ensure_listener()
+
+    def leave(self, chamber_id, user_id, channel_layer):
+        chamber_id = str(chamber_id)
+        members = self._members.get(chamber_id, {})
+        count = members.get(user_id, 0) - 1
+        if count > 0:
+            members[user_id] = count
+            return
+
+        members.pop(user_id, None)
+        if not members:
+            self._members.pop(chamber_id, None)
+        self._channel_layer = channel_layer
+        self._schedule_broadcast(chamber_id)
+
+    async def receive(self, snapshot):
+        """
+        Records another process's members, and sends local connections the new
+        chamber-wide count when it changed.
+        """
+        chamber_id = snapshot["chamber_id"]
+        if snapshot["process"] == PROCESS_ID or chamber_id not in self._members:
+            return  # Only chambers with local connections are counted
+
+        if self._remote.update(
+            chamber_id, snapshot["process"], set(snapshot["members"])
+        ):
+            self._schedule_broadcast(chamber_id, refresh=True)
+        await self._deliver(chamber_id, self._channel_layer)
+
+    def _schedule_broadcast(self, chamber_id, refresh=False):
+        """
+        'refresh' broadcasts resend unchanged members right away.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(chamber_id)
+        if pending is not None and pending.get_loop() is loop and not pending.done():
+            # The scheduled broadcast will carry the latest members
+            self.coalesced += 1
+            return
+
+        elapsed = monotonic() - self._last_broadcast.get(chamber_id, float("-inf"))
+        delay = 0 if refresh else max(0, settings.PRESENCE["ACTIVE_INTERVAL"] - elapsed)
+        self._pending[chamber_id] = loop.create_task(
+            self._broadcast(chamber_id, self._channel_layer, delay)
+        )
+
+    async def _broadcast(self, chamber_id, channel_layer, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        self._pending.pop(chamber_id, None)
+        members = [str(user_id) for user_id in self._members.get(chamber_id, ())]
+        if members:
+            self._last_broadcast[chamber_id] = monotonic()
+        else:
+            # Without local connections, the chamber is no longer counted here
+            self._last_broadcast.pop(chamber_id, None)
+            self._delivered.pop(chamber_id, None)
+            self._remote.discard(chamber_id)
+
+        self.broadcasts += 1
+        await channel_layer.group_send(
+            self.ACTIVITY_GROUP,
+            {
+                "type": "chat.activity",
+                "chamber_id": chamber_id,
+                "process": PROCESS_ID,
+                "members": members,
+            },
+        )
+        if members:
+            await self._deliver(chamber_id, channel_layer)
+
+    async def _deliver(self, chamber_id, channel_layer):
+        count = self.total(chamber_id)
+        if self._delivered.get(chamber_id) == count:
+            return
+        self._delivered[chamber_id] = count
+        # Every process sends the count to the chamber group, and consumers only pass
+        # on their own process's (see 'ChamberEventConsumer.chat_active')
+        await channel_layer.group_send(
+            chamber_id,
+            {
+                **chamber_event("chat.active", chamber_id, content=count),
+                "process": PROCESS_ID,
+            },
+        )
+
+    def _ensure_listener(self):
+        loop = asyncio.get_running_loop()
+        task = self._task
+        if (
+            self._loop is not loop
+            or task is None
+            or task.done()
+            or self._listener_layer is not self._channel_layer
+        ):
+            if task is not None and task.get_loop() is loop:
+                task.cancel()
+            self._loop = loop
+            self._listener_layer = self._channel_layer
+            self._task = loop.create_task(self._run_listener(self._channel_layer))
+
+    async def _run_listener(self, channel_layer):
+        """
+        Receives the other processes' snapshots while this process holds members,
+        and refreshes its own every ACTIVE_TTL / 2 seconds.
+        """
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(self.ACTIVITY_GROUP, channel)
+        refresh_at = monotonic() + settings.PRESENCE["ACTIVE_TTL"] / 2
+        while self._members:
+            try:
+                snapshot = await asyncio.wait_for(
+                    channel_layer.receive(channel), max(0, refresh_at - monotonic())
+                )
+            except asyncio.TimeoutError:
+                refresh_at = monotonic() + settings.PRESENCE["ACTIVE_TTL"] / 2
+                # Expired snapshots change the count too
+                for chamber_id in list(self._members):
+                    self._schedule_broadcast(chamber_id, refresh=True)
+                continue
+            await self.receive(snapshot)
+        await channel_layer.group_discard(self.ACTIVITY_GROUP, channel)
+        if self._members and self._task is asyncio.current_task():
+            # Members joined while the listener was stopping
+            self._task = asyncio.get_running_loop().create_task(
+                self._run_listener(channel_layer)
+            )
+
+    def stats(self):
+        return {
+            "chambers": len(self._members),
+            "remote_shares": len(self._remote),
+            "broadcasts": self.broadcasts,
+            "coalesced": self.coalesced,
+        }
+
+
+presence = PresenceService()
+chamber_activity = ChamberActivity()
@@ -0,0 +1,150 @@
+from django.conf import settings
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from time import monotonic
+import sys
+
+
+class ReplayBuffer:
+    """
+    The most recent message events of one chamber, ordered by sequence number.
+    """
+
+    __slots__ = ("seqs", "events", "size", "last_activity")
+
+    def __init__(self):
+        self.seqs = []
+        self.events = []
+        self.size = 0  # Approximate bytes held by the buffered events
+        self.last_activity = monotonic()
+
+    @staticmethod
+    def event_size(event):
+        return sys.getsizeof(event) + sys.getsizeof(event["text"])
+
+    def add(self, seq, event, max_events, max_bytes):
+        """
+        Returns the change in buffered bytes.
+        """
+        self.last_activity = monotonic()
+        index = bisect_left(self.seqs, seq)
+        if index < len(self.seqs) and self.seqs[index] == seq:
+            return 0  # Already recorded by another local connection
+
+        before = self.size
+        self.seqs.insert(index, seq)
+        self.events.insert(index, event)
+        self.size += self.event_size(event)
+        while len(self.seqs) > 1 and (
+            len(self.seqs) > max_events or self.size > max_bytes
+        ):
+            self.seqs.pop(0)
+            self.size -= self.event_size(self.events.pop(0))
+        return self.size - before
+
+    def since(self, after_seq):
+        """
+        Returns the events after 'after_seq', or None if some of them are not buffered.
+        """
+        if after_seq + 1 < self.seqs[0]:
+            return None
+        index = bisect_right(self.seqs, after_seq)
+        missed = self.seqs[index:]
+        if missed and missed[-1] - after_seq != len(missed):
+            return None
+        return self.events[index:]
+
+
+class RecentEvents:
+    """
+    Per-process ring buffers of recent message events for chambers with local
+    connections, so a reconnecting client is replayed what it missed from memory.
+
+    Events are recorded as this process's consumers receive them, so a buffer is only
+    complete while the chamber has local connections; it is dropped when the last one
+    leaves. Buffers hold at most MAX_EVENTS events and MAX_BYTES bytes each, buffers
+    without new events for IDLE_TTL seconds are evicted, and the least recently active
+    buffers are evicted once all of them hold more than MAX_TOTAL_BYTES.
+    """
+
+    def __init__(self):
+        self._buffers = (
+            OrderedDict()
+        )  # chamber id -> buffer, least recently active first
+        self._lock = Lock()
+        self._last_sweep = monotonic()
+        self.size = 0
+        self.memory_hits = 0
+        self.memory_misses = 0
+        self.evictions = 0
+
+    def record(self, chamber_id, event):
+        seq = event.get("seq")
+        if seq is None:
+            return
+        replay_settings = settings.REPLAY
+        with self._lock:
+            buffer = self._buffers.get(chamber_id)
+            if buffer is None:
+                buffer = self._buffers[chamber_id] = ReplayBuffer()
+            self._buffers.move_to_end(chamber_id)
+            self.size += buffer.add(
+                seq, event, replay_settings["MAX_EVENTS"], replay_settings["MAX_BYTES"]
+            )
+            self._evict(replay_settings)
+
+    def since(self, chamber_id, after_seq):
+        with self._lock:
+            buffer = self._buffers.get(chamber_id)
+            events = None if buffer is None else buffer.since(after_seq)
+            if events is None:
+                self.memory_misses += 1
+            else:
+                self.memory_hits += 1
+            return events
+
+    def discard(self, chamber_id):
+        with self._lock:
+            buffer = self._buffers.pop(chamber_id, None)
+            if buffer is not None:
+                self.size -= buffer.size
+
+    def _evict(self, replay_settings):
+        now = monotonic()
+        if now - self._last_sweep >= replay_settings["IDLE_TTL"] / 4:
+            self._last_sweep = now
+            idle = [
+                chamber_id
+                for chamber_id, buffer in self._buffers.items()
+                if now - buffer.last_activity > replay_settings["IDLE_TTL"]
+            ]
+            for chamber_id in idle:
+                self.size -= self._buffers.pop(chamber_id).size
+                self.evictions += 1
+
+        while len(self._buffers) > 1 and self.size > replay_settings["MAX_TOTAL_BYTES"]:
+            _, buffer = self._buffers.popitem(last=False)
+            self.size -= buffer.size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            largest = sorted(
+                self._buffers.items(), key=lambda item: item[1].size, reverse=True
+            )[:10]
+            return {
+                "chambers": len(self._buffers),
+                "events": sum(len(buffer.seqs) for buffer in self._buffers.values()),
+                "bytes": self.size,
+                "largest_buffers": {
+                    chamber_id: {"events": len(buffer.seqs), "bytes": buffer.size}
+                    for chamber_id, buffer in largest
+                },
+                "memory_hits": self.memory_hits,
+                "memory_misses": self.memory_misses,
+                "evictions": self.evictions,
+            }
+
+
+recent_events = RecentEvents()
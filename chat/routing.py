@@ -1,7 +1,8 @@
 from django.urls import path
-from .consumers import ChamberConsumer
+from .consumers import ChamberConsumer, UserConsumer
 
 
 websocket_urlpatterns = [
     path("ws/chamber/<str:chamber_id>/", ChamberConsumer.as_asgi()),
+    path("ws/user/", UserConsumer.as_asgi()),
 ]
\ No newline at end of file
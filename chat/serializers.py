@@ -1,5 +1,12 @@
 from django.contrib.auth import get_user_model
-from rest_framework.serializers import ModelSerializer, SerializerMethodField, ListField
+from django.core.files.storage import default_storage
+from django.utils.encoding import filepath_to_uri
+from rest_framework.serializers import (
+    ModelSerializer,
+    SerializerMethodField,
+    ListField,
+    DateTimeField,
+)
 from rest_framework.exceptions import ValidationError
 from .models import Chamber, Message
 from uuid import UUID
@@ -67,11 +74,96 @@ class MessageSerializer(ModelSerializer):
             "sender",
             "chamber",
             "created",
+            "seq",
         ]
-        read_only_fields = ["id", "sender", "chamber", "created"]
+        read_only_fields = ["id", "sender", "chamber", "created", "seq"]
 
     def get_sender(self, obj):
-        return str(obj.sender.id)
+        return str(obj.sender_id)
 
     def get_chamber(self, obj):
-        return str(obj.chamber.id)
+        return str(obj.chamber_id)
+
+
+class MessageHistorySerializer:
+    """
+    Read-only fast path for message history pages: rows are read with 'values()'
+    and mapped straight to the 'MessageSerializer' representation, without model
+    instances or per-field DRF machinery. Media URLs are joined to the storage's
+    base URL once per page instead of asking the storage for each file.
+    With 'include_sender', each row also carries the sender's username and avatar
+    URL, read through a single join.
+    """
+
+    fields = [
+        "id",
+        "message_type",
+        "text_content",
+        "image_content",
+        "audio_content",
+        "video_content",
+        "is_reply",
+        "previous_message_content",
+        "previous_message_id",
+        "previous_sender",
+        "sender_id",
+        "chamber_id",
+        "created",
+        "seq",
+    ]
+    sender_fields = ["sender__username", "sender__profile__avatar"]
+
+    def __init__(self, include_sender=False):
+        self.include_sender = include_sender
+        self._created = DateTimeField()
+
+    def values(self, queryset):
+        """
+        Projects 'queryset' onto the columns the representation needs.
+        Its rows can be paginated like model instances (see 'ChamberHTMLView').
+        """
+        if self.include_sender:
+            return queryset.values(*self.fields, *self.sender_fields)
+        return queryset.values(*self.fields)
+
+    def represent(self, rows):
+        media_url = self._media_url()
+        to_datetime = self._created.to_representation
+        messages = []
+        for row in rows:
+            message = {
+                "id": str(row["id"]),
+                "message_type": row["message_type"],
+                "text_content": row["text_content"],
+                "image_content": media_url(row["image_content"]),
+                "audio_content": media_url(row["audio_content"]),
+                "video_content": media_url(row["video_content"]),
+                "is_reply": row["is_reply"],
+                "previous_message_content": row["previous_message_content"],
+                "previous_message_id": (
+                    str(row["previous_message_id"])
+                    if row["previous_message_id"]
+                    else None
+                ),
+                "previous_sender": row["previous_sender"],
+                "sender": str(row["sender_id"]),
+                "chamber": str(row["chamber_id"]),
+                "created": to_datetime(row["created"]),
+                "seq": row["seq"],
+            }
+            if self.include_sender:
+                message["sender_username"] = row["sender__username"]
+                message["sender_avatar"] = media_url(row["sender__profile__avatar"])
+            messages.append(message)
+        return messages
+
+    def serialize(self, queryset):
+        return self.represent(self.values(queryset))
+
+    @staticmethod
+    def _media_url():
+        base_url = getattr(default_storage, "base_url", None)
+        if base_url is None:
+            # Storages that sign or route each file
+            return lambda name: default_storage.url(name) if name else None
+        return lambda name: base_url + filepath_to_uri(name) if name else None
@@ -1,11 +1,26 @@
 from django.dispatch import receiver
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.contrib.auth import get_user_model
+from django.utils import timezone
 from .models import Chamber
 from .utils import retrieve_user_name
+from .membership import chamber_index
+from .invalidation import cache_invalidations
+from .events import chamber_event
 from channels.layers import get_channel_layer
+from user.authentication import principal_cache
+from uuid import UUID
 
 
-channel_layer = get_channel_layer()
+User = get_user_model()
+
+# Principals cached by any process follow user changes made by the others
+principal_cache.coherent = cache_invalidations.coherent
+cache_invalidations.register(
+    "principal",
+    lambda user_id: principal_cache.invalidate_user(UUID(user_id)),
+    principal_cache.clear,
+)
 
 
 @receiver(m2m_changed, sender=Chamber.users.through)
@@ -16,10 +31,104 @@ async def notify_new_chamber_user_websocket(sender, instance, action, pk_set, **
     if action == "post_add":
         for user_id in pk_set:
             username = await retrieve_user_name(user_id)
-            await channel_layer.group_send(
+            # Looked up per call, since the layer is rebuilt when CHANNEL_LAYERS changes
+            await get_channel_layer().group_send(
                 str(instance.id),
-                {
-                    "type": "chat.notification",
-                    "content": f"{username} was added to the chat.",
-                },
+                chamber_event(
+                    "chat.notification",
+                    instance.id,
+                    content=f"{username} was added to the chat.",
+                ),
             )
+
+
+@receiver(m2m_changed, sender=Chamber.users.through)
+def update_chamber_membership_index(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    """
+    Keeps the in-memory membership index coherent with chamber membership changes,
+    whether they are made from the chamber side or the user side of the relation.
+    """
+    if action == "post_add":
+        if reverse:
+            for chamber_id in pk_set:
+                chamber_index.add_members(chamber_id, [instance.pk])
+        else:
+            chamber_index.add_members(instance.pk, pk_set)
+    elif action == "post_remove":
+        if reverse:
+            for chamber_id in pk_set:
+                chamber_index.remove_members(chamber_id, [instance.pk])
+        else:
+            chamber_index.remove_members(instance.pk, pk_set)
+    elif action == "post_clear":
+        if reverse:
+            chamber_index.remove_user(instance.pk)
+        else:
+            chamber_index.discard(instance.pk)
+
+
+@receiver(m2m_changed, sender=Chamber.users.through)
+def publish_chamber_membership_change(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    """
+    Tells the other processes to drop the chambers whose members changed from their
+    membership index (see 'chat.invalidation').
+    """
+    if action in ("post_add", "post_remove"):
+        for chamber_id in pk_set if reverse else [instance.pk]:
+            cache_invalidations.publish("chamber", str(chamber_id))
+    elif action == "post_clear":
+        if reverse:
+            cache_invalidations.publish("chamber_member", str(instance.pk))
+        else:
+            cache_invalidations.publish("chamber", str(instance.pk))
+
+
+@receiver([post_save, post_delete], sender=Chamber)
+def discard_chamber_membership_index(sender, instance, **kwargs):
+    """
+    Drops a chamber's cached metadata when the chamber is changed or deleted.
+    """
+    chamber_index.discard(instance.pk)
+    cache_invalidations.publish("chamber", str(instance.pk))
+
+
+@receiver(m2m_changed, sender=Chamber.users.through)
+def touch_chamber_on_membership_change(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    """
+    Bumps 'updated' on chambers whose members change, since the chamber list
+    includes them and is validated by it (see 'chamber_list_etag').
+    """
+    if action in ("post_add", "post_remove"):
+        chambers = Chamber.objects.filter(pk__in=pk_set if reverse else [instance.pk])
+    elif action == "pre_clear" and reverse:
+        # The user's chambers are only known before the clear
+        chambers = Chamber.objects.filter(users=instance)
+    elif action == "post_clear" and not reverse:
+        chambers = Chamber.objects.filter(pk=instance.pk)
+    else:
+        return
+    chambers.update(updated=timezone.now())
+
+
+@receiver(pre_delete, sender=User)
+def touch_chambers_on_user_delete(sender, instance, **kwargs):
+    """
+    Deleting a user drops their memberships and messages without 'm2m_changed',
+    so their chambers are bumped here.
+    """
+    Chamber.objects.filter(users=instance).update(updated=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=User)
+def publish_user_change(sender, instance, **kwargs):
+    """
+    Tells the other processes to drop the user's cached principals, so a deactivated
+    user or a changed password takes effect everywhere (see 'user.signals').
+    """
+    cache_invalidations.publish("principal", str(instance.pk))
@@ -1,13 +1,27 @@
 from django.urls import path, reverse
+from django.test import override_settings, SimpleTestCase
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APITransactionTestCase
 from channels.testing import WebsocketCommunicator
 from channels.routing import URLRouter
-from .consumers import ChamberConsumer
-from .models import Chamber
+from channels.layers import get_channel_layer
+from .consumers import ChamberConsumer, UserConsumer
+from .routing import websocket_urlpatterns
+from .models import Chamber, Message, PresenceLease
 from user.models import User, JWTAccessToken
+from user.authentication import principal_cache
 from time import sleep
+from threading import Thread
+from uuid import uuid4
+from datetime import datetime, timedelta, timezone
+import asyncio
 import json
+import os
+import tempfile
+from unittest.mock import patch
 from .utils import (
     send_text_message,
     send_reply_text_message,
@@ -15,8 +29,44 @@ from .utils import (
     send_audio_message,
     send_reply_image_message,
     send_reply_audio_message,
+    send_upload_chunk,
+    create_new_message,
+    build_message_event,
+    confirm_authorization,
+    TimeOrderedUUID,
 )
-from asgiref.sync import sync_to_async
+from .frames import build_frame, parse_frame, FrameError, LEGACY_DELIMITER
+from .membership import chamber_index, ChamberEntry
+from .invalidation import cache_invalidations
+from .uploads import chunked_uploads, UploadRegistry, UploadError
+from .presence import presence, chamber_activity
+from .typing import typing_aggregator
+from .writer import message_writer
+from .codecs import compact_codec, json_codec, CodecError
+from .outbound import OutboundQueue, outbound_counters
+from .replay import RecentEvents, recent_events
+from .events import chamber_event, encoded_events, EncodedEvents, PROCESS_ID
+from .serializers import MessageSerializer, MessageHistorySerializer
+from .broker import (
+    ChannelBroker,
+    BrokerError,
+    broker_link_secret,
+    read_frame,
+    write_frame,
+)
+from .layers import BrokerChannelLayer
+from .admission import AdmissionController
+from .affinity import (
+    HashRing,
+    ChamberAffinityRouter,
+    ChamberWorker,
+    FrameQueue,
+    WorkerConnection,
+    read_relay_frame,
+    decode_asgi,
+)
+from .broker import open_broker_connection
+from asgiref.sync import async_to_sync, sync_to_async
 
 
 class ChamberListViewTestCase(APITestCase):
@@ -42,6 +92,18 @@ class ChamberListViewTestCase(APITestCase):
         self.assertEqual(type(response.data[0]), dict)
         self.assertEqual(response.status_code, 200)
 
+    def test_retrieve_chamber_list_not_modified_success(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        etag = self.client.get(self.url, headers=headers)["ETag"]
+        response = self.client.get(self.url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Membership changes are part of the list
+        self.chamber.users.add(self.user)
+        response = self.client.get(self.url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
     def test_create_chamber_success(self):
         response = self.client.post(
             self.url,
@@ -71,163 +133,2238 @@ class ChamberListViewTestCase(APITestCase):
         sleep(1)
 
 
-class ChamberConsumerTestCase(APITransactionTestCase):
-    async def asyncSetUp(self):
-        self.user = await self.create_user(
-            email="admin@gmail.com",
-            username="admin",
-            password="Adm1!n123",
-            is_email_verified=True,
+class ChamberHTMLViewTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
         )
-        self.token = await self.get_token(self.user)
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = self.client.post(
+            reverse("user:login"),
+            data={"email": self.user.email, "password": "Adm1!n123"},
+        ).data["access"]
+        self.chamber = Chamber.objects.create(chambername="test", creator=self.user)
+        self.url = reverse("chat:chamber-home", kwargs={"chamber_id": self.chamber.id})
 
-        self.user2 = await self.create_user(
-            email="admin@gmail2.com",
-            username="admin2",
-            password="Adm1!n123",
-            is_email_verified=True,
+    def add_messages(self, count, created=None):
+        messages = Message.objects.bulk_create(
+            Message(text_content=f"message {i}", sender=self.user, chamber=self.chamber)
+            for i in range(count)
         )
-        self.token2 = await self.get_token(self.user2)
+        if created is not None:
+            Message.objects.filter(id__in=[message.id for message in messages]).update(
+                created=created
+            )
 
-        self.chamber = await self.create_chamber(chambername="test", creator=self.user)
+    def get_page(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                url,
+                headers={
+                    "Authorization": f"Bearer {self.token}",
+                    "Accept": "application/json",
+                },
+            )
+        self.assertEqual(response.status_code, 200)
+        return response, queries
 
-        self.application = URLRouter(
-            [
-                path("testws/chamber/<str:chamber_id>/", ChamberConsumer.as_asgi()),
-            ]
+    def test_retrieve_chamber_history_constant_queries_success(self):
+        self.add_messages(5)
+        self.get_page(self.url)  # Loads the chamber into the membership index
+        _, small_queries = self.get_page(self.url)
+
+        self.add_messages(500)
+        response, large_queries = self.get_page(self.url)
+        self.assertEqual(len(response.data["results"]), 10)
+        self.assertEqual(len(large_queries), len(small_queries))
+        # Only one page (plus one row to detect the next page) is read
+        message_queries = [
+            query["sql"]
+            for query in large_queries
+            if query["sql"].startswith('SELECT "chat_message"')
+        ]
+        self.assertEqual(len(message_queries), 1)
+        self.assertIn("LIMIT 11", message_queries[0])
+
+    def test_retrieve_chamber_history_ties_success(self):
+        # Messages created in the same instant are paged without gaps or repeats
+        self.add_messages(25, created=datetime(2026, 10, 18, tzinfo=timezone.utc))
+        seen = []
+        url = self.url
+        while url:
+            response, _ = self.get_page(url)
+            seen += [message["id"] for message in response.data["results"]]
+            url = response.data["previous_messages"]
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_retrieve_chamber_history_legacy_ids_success(self):
+        # Rows from before ids were time-ordered have random ids, and still come
+        # before every newer message
+        legacy = Message.objects.bulk_create(
+            Message(
+                id=uuid4(),
+                text_content=f"legacy {i}",
+                sender=self.user,
+                chamber=self.chamber,
+            )
+            for i in range(15)
+        )
+        Message.objects.filter(id__in=[message.id for message in legacy]).update(
+            created=datetime(2024, 1, 1, tzinfo=timezone.utc)
+        )
+        self.add_messages(5)
+        response, _ = self.get_page(self.url)
+        self.assertEqual(
+            [message["text_content"] for message in response.data["results"][:5]],
+            [f"message {i}" for i in range(5)][::-1],
         )
 
-        self.url = f"/testws/chamber/{self.chamber.id}/"
+        seen = []
+        url = self.url
+        while url:
+            response, _ = self.get_page(url)
+            seen += [message["id"] for message in response.data["results"]]
+            url = response.data["previous_messages"]
+        self.assertEqual(len(set(seen)), 20)
 
-    @sync_to_async
-    def create_user(self, email, username, password, is_email_verified=False):
+        # Windows around a legacy message hold its neighbours in history order
+        ids = [
+            str(message_id)
+            for message_id in Message.objects.order_by("created", "id").values_list(
+                "id", flat=True
+            )
+        ]
+        response, _ = self.get_page(f"{self.url}?around={ids[14]}&page_size=3")
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]], ids[11:18][::-1]
+        )
+
+    def test_retrieve_chamber_history_page_size_success(self):
+        self.add_messages(120)
+        response, _ = self.get_page(f"{self.url}?page_size=25")
+        self.assertEqual(len(response.data["results"]), 25)
+        response, _ = self.get_page(f"{self.url}?page_size=1000")
+        self.assertEqual(len(response.data["results"]), 100)
+
+    def test_retrieve_chamber_history_around_message_success(self):
+        self.add_messages(50)
+        ids = [
+            str(message_id)
+            for message_id in Message.objects.order_by("created", "id").values_list(
+                "id", flat=True
+            )
+        ]
+        self.get_page(self.url)  # Loads the chamber into the membership index
+
+        response, queries = self.get_page(f"{self.url}?around={ids[25]}&page_size=5")
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]], ids[20:31][::-1]
+        )
+        message_queries = [
+            query["sql"]
+            for query in queries
+            if query["sql"].startswith('SELECT "chat_message"')
+        ]
+        self.assertEqual(len(message_queries), 1)
+
+        # The cursors continue on either side of the window
+        older, _ = self.get_page(response.data["previous_messages"])
+        self.assertEqual(
+            [message["id"] for message in older.data["results"]], ids[15:20][::-1]
+        )
+        newer, _ = self.get_page(response.data["next_messages"])
+        self.assertEqual(
+            [message["id"] for message in newer.data["results"]], ids[31:36][::-1]
+        )
+
+    def test_retrieve_chamber_history_around_message_edges_success(self):
+        self.add_messages(3)
+        ids = [
+            str(message_id)
+            for message_id in Message.objects.order_by("created", "id").values_list(
+                "id", flat=True
+            )
+        ]
+        response, _ = self.get_page(f"{self.url}?around={ids[0]}")
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]], ids[::-1]
+        )
+        self.assertIsNone(response.data["previous_messages"])
+        self.assertIsNone(response.data["next_messages"])
+
+    def test_retrieve_chamber_history_around_message_failure_not_found(self):
+        response = self.client.get(
+            f"{self.url}?around={uuid4()}",
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_retrieve_chamber_history_not_modified_success(self):
+        self.add_messages(15)
+        response, _ = self.get_page(self.url)
+        etag = response["ETag"]
+        response = self.client.get(
+            self.url,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "Accept": "application/json",
+                "If-None-Match": etag,
+            },
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # Each page has its own validator, and a new message changes them
+        response, _ = self.get_page(f"{self.url}?page_size=5")
+        self.assertNotEqual(response["ETag"], etag)
+        self.add_messages(1)
+        response = self.client.get(
+            self.url,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "Accept": "application/json",
+                "If-None-Match": etag,
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # So does deleting a message other than the latest one
+        response, _ = self.get_page(self.url)
+        etag = response["ETag"]
+        Message.objects.order_by("created", "id").first().delete()
+        response = self.client.get(
+            self.url,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "Accept": "application/json",
+                "If-None-Match": etag,
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_retrieve_chamber_history_failure_not_found(self):
+        response = self.client.get(
+            reverse("chat:chamber-home", kwargs={"chamber_id": uuid4()}),
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageHistorySerializerTestCase(APITestCase):
+    def test_message_history_serializer_success(self):
         user = User.objects.create_user(
-            email=email,
-            username=username,
-            password=password,
-            is_email_verified=is_email_verified,
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
         )
-        JWTAccessToken.objects.create(user=user)
-        return user
+        chamber = Chamber.objects.create(chambername="test", creator=user)
+        text = Message.objects.create(
+            text_content="hello", sender=user, chamber=chamber
+        )
+        Message.objects.create(
+            message_type="IMG",
+            image_content="images/media 1.png",
+            is_reply=True,
+            previous_message_id=text.id,
+            previous_message_content="hello",
+            previous_sender=user.username,
+            sender=user,
+            chamber=chamber,
+        )
+        messages = Message.objects.filter(chamber=chamber).order_by("created")
 
-    @sync_to_async
-    def get_token(self, user):
-        return self.client.post(
+        # Same representation as 'MessageSerializer', in one query
+        with self.assertNumQueries(1):
+            rows = MessageHistorySerializer().serialize(messages)
+        self.assertEqual(rows, MessageSerializer(messages, many=True).data)
+        self.assertEqual(rows[1]["image_content"], "/media/images/media%201.png")
+
+        rows = MessageHistorySerializer(include_sender=True).serialize(messages)
+        self.assertEqual(rows[0]["sender_username"], str(user.username))
+        self.assertIsNone(rows[0]["sender_avatar"])
+
+
+class ChamberMessagesSinceViewTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
+        )
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = self.client.post(
             reverse("user:login"),
-            data={"email": user.email, "password": "Adm1!n123"},
+            data={"email": self.user.email, "password": "Adm1!n123"},
         ).data["access"]
 
-    @sync_to_async
-    def create_chamber(self, chambername, creator):
-        return Chamber.objects.create(chambername=chambername, creator=creator)
+        self.chamber = Chamber.objects.create(chambername="test", creator=self.user)
+        for i in range(3):
+            Message.objects.create(
+                text_content=f"message {i}", sender=self.user, chamber=self.chamber
+            )
 
-    @sync_to_async
-    def add_user_to_chamber(self, user):
-        self.chamber.users.add(user)
+        self.url = reverse(
+            "chat:chamber-messages-since", kwargs={"chamber_id": self.chamber.id}
+        )
 
-    async def test_chamber_consumer_connect_disconnect_success(self):
-        await self.asyncSetUp()
-        await self.add_user_to_chamber(self.user)
-        communicator = WebsocketCommunicator(
-            self.application,
+    def test_retrieve_messages_since_success(self):
+        self.chamber.users.add(self.user)
+        response = self.client.get(
             self.url,
+            {"after_seq": 1},
             headers={"Authorization": f"Bearer {self.token}"},
         )
-        connected, subprotocol = await communicator.connect()
-        self.assertEqual(connected, True)
-        user = await User.objects.aget(id=self.user.id)
-        self.assertEqual(user.is_online, True)
-
-        # Test adding new user to chamber
-        await self.add_user_to_chamber(self.user2)
-        message = await communicator.receive_from()
+        self.assertEqual(response.status_code, 200)
         self.assertEqual(
-            message,
-            '{"type": "chat.active", "content": 1}',
+            [message["seq"] for message in response.data["results"]], [2, 3]
+        )
+        self.assertEqual(response.data["results"][0]["text_content"], "message 1")
+        self.assertFalse(response.data["has_more"])
+        self.chamber.refresh_from_db()
+        self.assertEqual(self.chamber.last_seq, 3)
+
+    def test_retrieve_messages_since_id_success(self):
+        self.chamber.users.add(self.user)
+        first = Message.objects.filter(chamber=self.chamber, seq=1).get()
+        response = self.client.get(
+            self.url,
+            {"after_id": str(first.id)},
+            headers={"Authorization": f"Bearer {self.token}"},
         )
-        message = await communicator.receive_from()
         self.assertEqual(
-            message,
-            '{"type": "chat.notification", "content": "admin2 was added to the chat."}',
+            [message["seq"] for message in response.data["results"]], [2, 3]
         )
 
-        # Test sending number of active users
-        communicator2 = WebsocketCommunicator(
-            self.application,
+    def test_retrieve_messages_since_legacy_id_success(self):
+        # Messages after a legacy (random) id are found by creation time
+        self.chamber.users.add(self.user)
+        legacy = Message.objects.create(
+            id=uuid4(), text_content="legacy", sender=self.user, chamber=self.chamber
+        )
+        Message.objects.filter(id=legacy.id).update(
+            created=datetime(2024, 1, 1, tzinfo=timezone.utc)
+        )
+        response = self.client.get(
             self.url,
-            headers={"Authorization": f"Bearer {self.token2}"},
+            {"after_id": str(legacy.id)},
+            headers={"Authorization": f"Bearer {self.token}"},
         )
-        connected, subprotocol = await communicator2.connect()
-        message = await communicator.receive_from()
         self.assertEqual(
-            message,
-            '{"type": "chat.active", "content": 2}',
+            [message["seq"] for message in response.data["results"]], [1, 2, 3]
         )
 
-        # Test sending text message
-        await send_text_message(communicator)
-        message = await communicator.receive_from()
-        dict_message = json.loads(message)
-        self.assertEqual(dict_message["type"], "chat.message")
-        self.assertEqual(dict_message["sender"], "admin")
+        response = self.client.get(
+            self.url,
+            {"after_id": str(uuid4())},
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        self.assertEqual(response.status_code, 404)
 
-        # Test send text reply message
-        await send_reply_text_message(
-            communicator, previous_message_id=dict_message["id"]
+    def test_retrieve_messages_since_failure_not_member(self):
+        response = self.client.get(
+            self.url, headers={"Authorization": f"Bearer {self.token}"}
         )
-        message = await communicator.receive_from()
-        reply_dict_message = json.loads(message)
-        self.assertEqual(reply_dict_message["type"], "chat.reply")
-        self.assertEqual(reply_dict_message["sender"], "admin")
-        self.assertEqual(
-            reply_dict_message["previous_message_content"], dict_message["content"]
+        self.assertEqual("You are not a member of this chamber.", response.data)
+
+
+class MessageEventTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
         )
-        self.assertEqual(reply_dict_message["previous_message_id"], dict_message["id"])
+        self.chamber = Chamber.objects.create(chambername="test", creator=self.user)
 
-        # Test send image
-        await send_image_message(communicator)
-        message = await communicator.receive_from()
-        image_dict_message = json.loads(message)
-        self.assertEqual(image_dict_message["type"], "chat.media")
-        self.assertEqual(image_dict_message["filename"].endswith("png"), True)
+    def test_media_event_size_success(self):
+        message = Message.objects.create(
+            message_type=Message.MessageType.AUDIO,
+            audio_content="audios/missing.wav",
+            media_size=2048,
+            sender=self.user,
+            chamber=self.chamber,
+        )
+        message = Message.objects.select_related("sender").get(id=message.id)
+        # The recorded size is used without asking the storage
+        with patch("django.core.files.storage.FileSystemStorage.size") as size:
+            event = build_message_event(message)
+        size.assert_not_called()
+        payload = json.loads(event["text"])
+        self.assertEqual(payload["size"], 2048)
+        self.assertEqual(payload["filename"], "missing.wav")
 
-        # Test send audio
-        await send_audio_message(communicator)
-        message = await communicator.receive_from()
-        audio_dict_message = json.loads(message)
-        self.assertEqual(audio_dict_message["type"], "chat.media")
-        self.assertEqual(audio_dict_message["filename"].endswith("wav"), True)
+    def test_media_event_size_failure_missing_file(self):
+        message = Message.objects.create(
+            message_type=Message.MessageType.AUDIO,
+            audio_content="audios/missing.wav",
+            sender=self.user,
+            chamber=self.chamber,
+        )
+        message = Message.objects.select_related("sender").get(id=message.id)
+        payload = json.loads(build_message_event(message)["text"])
+        self.assertNotIn("size", payload)
+        self.assertEqual(payload["type"], "chat.media")
 
-        # Test send image reply message
-        await send_reply_image_message(
-            communicator, previous_message_id=audio_dict_message["id"]
+
+class TimeOrderedUUIDTestCase(SimpleTestCase):
+    def test_time_ordered_uuid_success(self):
+        uuid7 = TimeOrderedUUID()
+        ids = [uuid7() for _ in range(10000)]
+        self.assertEqual(ids[0].version, 7)
+        # Strictly increasing, also as stored by SQLite (hex strings)
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual([id.hex for id in ids], sorted(id.hex for id in ids))
+
+    def test_time_ordered_uuid_counter_overflow(self):
+        uuid7 = TimeOrderedUUID()
+        uuid7._last_ms = 2**47  # Ahead of the clock, as after a step back
+        uuid7._counter = 0xFFE
+        ids = [uuid7() for _ in range(3)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([id.int >> 80 for id in ids], [2**47, 2**47 + 1, 2**47 + 1])
+
+
+class RuntimeStatsViewTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
         )
-        message = await communicator.receive_from()
-        image_reply_dict_message = json.loads(message)
-        self.assertEqual(image_reply_dict_message["type"], "chat.reply")
-        self.assertEqual(image_reply_dict_message["sender"], "admin")
-        self.assertEqual(image_reply_dict_message["previous_message_content"], "AUDIO")
-        self.assertEqual(
-            image_reply_dict_message["previous_message_id"], audio_dict_message["id"]
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = self.client.post(
+            reverse("user:login"),
+            data={"email": self.user.email, "password": "Adm1!n123"},
+        ).data["access"]
+
+        self.url = reverse("chat:runtime-stats")
+
+    def test_retrieve_runtime_stats_success(self):
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(
+            self.url, headers={"Authorization": f"Bearer {self.token}"}
         )
+        self.assertEqual(response.status_code, 200)
+        for key in ["queue_depth", "running", "queue_wait_seconds", "run_time_seconds"]:
+            self.assertIn(key, response.data["media_pool"])
 
-        # Test send audio reply message
-        await send_reply_audio_message(
-            communicator, previous_message_id=image_reply_dict_message["id"]
+    def test_retrieve_runtime_stats_failure_not_admin(self):
+        response = self.client.get(
+            self.url, headers={"Authorization": f"Bearer {self.token}"}
         )
-        message = await communicator.receive_from()
-        audio_reply_dict_message = json.loads(message)
-        self.assertEqual(audio_reply_dict_message["type"], "chat.reply")
-        self.assertEqual(audio_reply_dict_message["sender"], "admin")
-        self.assertEqual(audio_reply_dict_message["previous_message_content"], "IMAGE")
         self.assertEqual(
-            audio_reply_dict_message["previous_message_id"],
-            image_reply_dict_message["id"],
+            "You do not have permission to perform this action.", response.data
         )
 
-        await communicator.disconnect()
-        user = await User.objects.aget(id=self.user.id)
-        self.assertEqual(user.is_online, False)
+
+class ChamberMembershipIndexTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
+        )
+        self.user2 = User.objects.create_user(
+            email="admin2@gmail.com", password="Adm1!n123", is_email_verified=True
+        )
+        self.chamber = Chamber.objects.create(chambername="test", creator=self.user)
+        self.chamber.users.add(self.user)
+        chamber_index.clear()
+
+    def test_membership_index_success(self):
+        with self.assertNumQueries(2):
+            chamber = chamber_index.get(self.chamber.id)
+        with self.assertNumQueries(0):
+            chamber = chamber_index.get(str(self.chamber.id))
+        self.assertEqual(chamber.chambername, "test")
+        self.assertTrue(chamber.has_member(self.user.id))
+
+        # Membership changes from either side of the relation are reflected
+        self.chamber.users.add(self.user2)
+        self.assertTrue(chamber_index.peek(self.chamber.id).has_member(self.user2.id))
+        self.user2.chamber_set.remove(self.chamber)
+        self.assertFalse(chamber_index.peek(self.chamber.id).has_member(self.user2.id))
+
+        self.chamber.delete()
+        self.assertIsNone(chamber_index.get(self.chamber.id))
+
+    def test_membership_index_lru_eviction(self):
+        chamber2 = Chamber.objects.create(chambername="test2", creator=self.user)
+        with override_settings(
+            CHAMBER_MEMBERSHIP_INDEX={
+                **settings.CHAMBER_MEMBERSHIP_INDEX,
+                "MAX_CHAMBERS": 1,
+            }
+        ):
+            chamber_index.get(self.chamber.id)
+            chamber_index.get(chamber2.id)
+            self.assertIsNone(chamber_index.peek(self.chamber.id))
+            self.assertIsNotNone(chamber_index.peek(chamber2.id))
+
+    def test_membership_index_change_during_load(self):
+        # A member added after the load read the members, before it was cached
+        def read_then_change(*args, **kwargs):
+            entry = ChamberEntry(*args, **kwargs)
+            self.chamber.users.add(self.user2)
+            return entry
+
+        with patch("chat.membership.ChamberEntry", side_effect=read_then_change):
+            chamber = chamber_index.get(self.chamber.id)
+        self.assertFalse(chamber.has_member(self.user2.id))
+        self.assertIsNone(chamber_index.peek(self.chamber.id))
+        self.assertTrue(chamber_index.get(self.chamber.id).has_member(self.user2.id))
+
+    def test_membership_index_failure_invalid(self):
+        self.assertIsNone(chamber_index.get("invalid-id"))
+
+
+class CacheInvalidationsTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
+        )
+        self.user2 = User.objects.create_user(
+            email="admin2@gmail.com", password="Adm1!n123", is_email_verified=True
+        )
+        JWTAccessToken.objects.create(user=self.user)
+        self.token = self.client.post(
+            reverse("user:login"),
+            data={"email": self.user.email, "password": "Adm1!n123"},
+        ).data["access"]
+        self.chamber = Chamber.objects.create(chambername="test", creator=self.user)
+        self.chamber.users.add(self.user)
+        chamber_index.clear()
+        principal_cache.clear()
+
+        # The broker runs on its own event loop, as it would in its own process
+        self.address = f"unix://{tempfile.mkdtemp()}/broker.sock"
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            ChannelBroker().start(self.address), self.loop
+        ).result()
+
+    def broker_layers(self, address=None):
+        return override_settings(
+            CHANNEL_LAYERS={
+                "default": {
+                    "BACKEND": "chat.layers.BrokerChannelLayer",
+                    "CONFIG": {"address": address or self.address},
+                }
+            }
+        )
+
+    def publish_from_other_process(self, kind, *args):
+        async def publish():
+            other = BrokerChannelLayer(self.address)
+            await other.group_send(
+                cache_invalidations.GROUP,
+                {
+                    "type": "cache.invalidate",
+                    "process": "other",
+                    "kind": kind,
+                    "args": list(args),
+                },
+            )
+            await asyncio.sleep(0.1)
+            await other.close()
+
+        asyncio.run_coroutine_threadsafe(publish(), self.loop).result()
+
+    def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return True
+            sleep(0.02)
+        return False
+
+    def test_membership_index_other_process_changes(self):
+        chamber_id = str(self.chamber.id)
+        with self.broker_layers():
+            chamber_index.get(chamber_id)
+            self.assertIsNotNone(chamber_index.peek(chamber_id))
+            self.publish_from_other_process("chamber", chamber_id)
+            self.assertTrue(
+                self.wait_for(lambda: chamber_index.peek(chamber_id) is None)
+            )
+
+            # This process's changes are sent once committed
+            received = cache_invalidations.received
+            with self.captureOnCommitCallbacks(execute=True):
+                self.chamber.users.add(self.user2)
+            self.assertTrue(
+                self.wait_for(lambda: cache_invalidations.received == received + 1)
+            )
+            cache_invalidations.stop()
+
+        # Without the broker, no other process's changes would be heard
+        with self.broker_layers(f"unix://{tempfile.mkdtemp()}/none.sock"):
+            self.assertIsNotNone(chamber_index.get(chamber_id))
+            self.assertIsNone(chamber_index.peek(chamber_id))
+
+    def test_principal_cache_other_process_changes(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        with self.broker_layers():
+            user = async_to_sync(confirm_authorization)(headers)
+            self.assertEqual(user, self.user)
+            self.assertEqual(principal_cache.stats()["entries"], 1)
+
+            # Another process deactivates the user
+            User.objects.filter(id=self.user.id).update(is_active=False)
+            self.publish_from_other_process("principal", str(self.user.id))
+            self.assertTrue(
+                self.wait_for(lambda: principal_cache.stats()["entries"] == 0)
+            )
+            self.assertIsNone(async_to_sync(confirm_authorization)(headers))
+            cache_invalidations.stop()
+
+        User.objects.filter(id=self.user.id).update(is_active=True)
+        with self.broker_layers(f"unix://{tempfile.mkdtemp()}/none.sock"):
+            self.assertEqual(async_to_sync(confirm_authorization)(headers), self.user)
+            self.assertEqual(principal_cache.stats()["entries"], 0)
+
+    def tearDown(self):
+        cache_invalidations.stop()
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class FrameParsingTestCase(SimpleTestCase):
+    def test_parse_frame_success(self):
+        payload = b"\x89PNG" + LEGACY_DELIMITER + b"\x00" * 64
+        metadata, media_data = parse_frame(
+            build_frame({"message_type": "image", "media_type": "image"}, payload)
+        )
+        self.assertEqual(metadata["media_type"], "image")
+        self.assertIsInstance(media_data, memoryview)
+        self.assertEqual(media_data.tobytes(), payload)
+
+    def test_parse_legacy_frame_success(self):
+        metadata, media_data = parse_frame(
+            b'{"message_type": "audio"}' + LEGACY_DELIMITER + b"RIFF"
+        )
+        self.assertEqual(metadata["message_type"], "audio")
+        self.assertEqual(media_data.tobytes(), b"RIFF")
+
+    def test_parse_frame_failure(self):
+        frame = build_frame({"message_type": "image"}, b"data")
+        with self.assertRaises(FrameError):
+            parse_frame(frame[:-1])
+        with self.assertRaises(FrameError):
+            parse_frame(frame[:4] + b"\x09" + frame[5:])
+        with self.assertRaises(FrameError):
+            parse_frame(b"no metadata here")
+
+
+class CompactCodecTestCase(SimpleTestCase):
+    def test_compact_codec_round_trip_success(self):
+        created = datetime(2026, 10, 18, 9, 41, 7, 250000, tzinfo=timezone.utc)
+        payload = {
+            "type": "chat.reply",
+            "reply_format": "text",
+            "id": str(uuid4()),
+            "content": "Ça va?",
+            "previous_message_id": "not-a-uuid",
+            "size": -42,
+            "typists": ["admin", "admin2"],
+            "timestamp": created,
+            "unknown_key": {"nested": None, "flag": True},
+        }
+        encoded = compact_codec.encode(payload)
+        self.assertTrue(compact_codec.accepts(encoded))
+        self.assertEqual(compact_codec.decode(encoded), payload)
+        self.assertLess(len(encoded), len(json_codec.encode(payload)))
+
+        batch = compact_codec.encode_batch([encoded, compact_codec.encode({"a": 1})])
+        self.assertEqual(compact_codec.decode_batch(batch), [payload, {"a": 1}])
+
+    def test_compact_codec_negative_timestamp_success(self):
+        # Before 1970, so a negative number of milliseconds
+        landing = datetime(1969, 7, 20, 20, 17, 40, 500000, tzinfo=timezone.utc)
+        payload = {
+            "timestamp": landing,
+            "created": datetime.min.replace(tzinfo=timezone.utc),
+        }
+        self.assertEqual(compact_codec.decode(compact_codec.encode(payload)), payload)
+
+    def test_compact_codec_big_int_success(self):
+        for value in [
+            (1 << 63) - 1,
+            -(1 << 63),
+            1 << 63,
+            -(1 << 63) - 1,
+            10**40,
+            -(10**40),
+        ]:
+            payload = {"size": value, "content": [value]}
+            self.assertEqual(
+                compact_codec.decode(compact_codec.encode(payload)), payload
+            )
+
+    def test_compact_codec_failure_invalid(self):
+        encoded = compact_codec.encode({"type": "chat.message", "content": "hello"})
+        big_int = bytes((compact_codec.BIG_INT, 3)) + b"1e3"
+        for data in [
+            encoded[:-1],
+            encoded + b"\x00",
+            b"{}",
+            b"\xc7\x01\x02\x0f",
+            b"\xc7\x01\x0b" + big_int,
+        ]:
+            with self.assertRaises(CodecError):
+                compact_codec.decode(data)
+
+    def test_compact_codec_failure_nested_too_deeply(self):
+        nested = compact_codec.encode({"content": [[[["admin"]]]]})
+        self.assertEqual(compact_codec.decode(nested), {"content": [[[["admin"]]]]})
+        # A client frame of nested lists deep enough to exhaust the recursion limit
+        depth = 100_000
+        data = b"\xc7\x01\x03" + bytes((compact_codec.LIST, 1)) * depth + b"\x00"
+        for data in [compact_codec.encode({"content": [[[[["admin"]]]]]}), data]:
+            with self.assertRaises(CodecError):
+                compact_codec.decode(data)
+
+    def test_remote_event_encoding_success(self):
+        # An event built by another process (through a JSON channel layer) encodes
+        # to the same compact frame as the local one
+        created = datetime(2026, 10, 18, 9, 41, 7, 250000, tzinfo=timezone.utc)
+        event = chamber_event(
+            "chat.message",
+            uuid4(),
+            id=str(uuid4()),
+            content="hello",
+            sender="admin",
+            timestamp=created,
+            seq=7,
+        )
+        remote = json.loads(json.dumps(event))
+        for tagged in [False, True]:
+            self.assertEqual(
+                EncodedEvents().encode(compact_codec, remote, tagged=tagged),
+                encoded_events.encode(compact_codec, event, tagged=tagged),
+            )
+        self.assertEqual(
+            compact_codec.decode(EncodedEvents().encode(compact_codec, remote))[
+                "timestamp"
+            ],
+            created,
+        )
+
+
+@override_settings(OUTBOUND_QUEUE={**settings.OUTBOUND_QUEUE, "MAX_SIZE": 3})
+class OutboundQueueTestCase(SimpleTestCase):
+    async def test_outbound_queue_failure_slow_client(self):
+        sent = []
+        unblocked = asyncio.Event()
+
+        async def send(data):
+            await unblocked.wait()
+            sent.append(data)
+
+        queue = OutboundQueue(send)
+        dropped = outbound_counters.dropped
+        coalesced = outbound_counters.coalesced
+        self.assertTrue(queue.put("chat.message", "m1"))
+        await asyncio.sleep(0)  # 'm1' is now being sent
+
+        self.assertTrue(queue.put("chat.typing", "t1"))
+        self.assertTrue(queue.put("chat.typing", "t2"))
+        self.assertTrue(queue.put("chat.message", "m2"))
+        self.assertTrue(queue.put("chat.active", "a1"))
+        self.assertEqual(outbound_counters.coalesced, coalesced + 1)
+
+        # A full queue drops ephemeral events before messages
+        self.assertTrue(queue.put("chat.message", "m3"))
+        self.assertTrue(queue.put("chat.message", "m4"))
+        self.assertEqual(outbound_counters.dropped, dropped + 2)
+        self.assertFalse(queue.put("chat.message", "m5"))
+        self.assertTrue(queue.overflowed)
+        queue.stop()
+
+    async def test_outbound_queue_failure_send_error(self):
+        closed = asyncio.Event()
+
+        async def send(data):
+            raise RuntimeError("The transport is closing")
+
+        async def close():
+            closed.set()
+
+        queue = OutboundQueue(send, close)
+        failed_sends = outbound_counters.failed_sends
+        self.assertTrue(queue.put("chat.message", "m1"))
+        self.assertTrue(queue.put("chat.message", "m2"))
+        await asyncio.wait_for(closed.wait(), 1)
+
+        # Pending frames are dropped, and nothing more is queued
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue), 0)
+        self.assertFalse(queue.put("chat.message", "m3"))
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(outbound_counters.failed_sends, failed_sends + 1)
+        queue.stop()
+
+    async def test_outbound_queue_success(self):
+        sent = []
+
+        async def send(data):
+            sent.append(data)
+
+        queue = OutboundQueue(send)
+        queue.put("chat.message", "m1")
+        queue.put("chat.typing", "t1")
+        queue.put("chat.typing", "t2")
+        queue.put("chat.message", "m2")
+        await asyncio.sleep(0)
+        self.assertEqual(sent, ["m1", "t2", "m2"])
+        queue.stop()
+
+    @override_settings(
+        OUTBOUND_QUEUE={
+            **settings.OUTBOUND_QUEUE,
+            "MAX_SIZE": 100,
+            "BATCH_WINDOW": 0.05,
+            "BATCH_MAX_EVENTS": 4,
+        }
+    )
+    async def test_outbound_queue_batching_success(self):
+        sent = []
+
+        async def send(data):
+            sent.append(data)
+
+        queue = OutboundQueue(send)
+        queue.enable_batching(json_codec.encode_batch)
+        queue.put("chat.message", '{"id": 1}')
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent, [])  # Waiting for the rest of the burst
+
+        for i in range(2, 7):
+            queue.put("chat.message", f'{{"id": {i}}}')
+        await asyncio.sleep(0.1)
+        self.assertEqual(
+            [[item["id"] for item in json.loads(frame)] for frame in sent],
+            [[1, 2, 3, 4], [5, 6]],
+        )
+        queue.stop()
+
+
+@override_settings(
+    CHUNKED_UPLOADS={
+        **settings.CHUNKED_UPLOADS,
+        "EXPIRY": 0.05,
+        "SWEEP_INTERVAL": 0.05,
+    }
+)
+class UploadRegistryTestCase(SimpleTestCase):
+    async def test_upload_registry_expired_success(self):
+        uploads = UploadRegistry()
+        upload = uploads.begin("user", "chamber", "audio", 100)
+        self.assertTrue(os.path.exists(upload.path))
+
+        # Removed without another upload being started
+        await asyncio.sleep(0.2)
+        self.assertFalse(os.path.exists(upload.path))
+        with self.assertRaises(UploadError):
+            uploads.get(upload.upload_id, "user", "chamber")
+
+    async def test_upload_registry_failure_invalid_size(self):
+        uploads = UploadRegistry()
+        for size in [True, 0, "100", 1.5]:
+            with self.assertRaises(UploadError):
+                uploads.begin("user", "chamber", "audio", size)
+
+
+@override_settings(REPLAY={**settings.REPLAY, "MAX_EVENTS": 3})
+class RecentEventsTestCase(SimpleTestCase):
+    def test_recent_events_success(self):
+        recent_events = RecentEvents()
+        for seq in [1, 2, 3, 2]:
+            recent_events.record("chamber", {"seq": seq, "text": f"event {seq}"})
+        self.assertEqual(
+            [event["seq"] for event in recent_events.since("chamber", 1)], [2, 3]
+        )
+        self.assertEqual(recent_events.since("chamber", 3), [])
+        self.assertEqual(recent_events.stats()["events"], 3)
+
+        # The oldest events are dropped beyond MAX_EVENTS
+        recent_events.record("chamber", {"seq": 4, "text": "event 4"})
+        self.assertIsNone(recent_events.since("chamber", 0))
+        self.assertEqual(len(recent_events.since("chamber", 1)), 3)
+
+        recent_events.discard("chamber")
+        self.assertEqual(recent_events.stats()["bytes"], 0)
+
+    def test_recent_events_failure_gap(self):
+        recent_events = RecentEvents()
+        recent_events.record("chamber", {"seq": 1, "text": "event 1"})
+        recent_events.record("chamber", {"seq": 3, "text": "event 3"})
+        self.assertIsNone(recent_events.since("chamber", 0))
+        self.assertIsNone(recent_events.since("other chamber", 0))
+
+
+class RelayFrameTestCase(SimpleTestCase):
+    class Writer:
+        def __init__(self):
+            self.data = b""
+
+        def writelines(self, chunks):
+            self.data += b"".join(chunks)
+
+        def is_closing(self):
+            return False
+
+        def close(self):
+            pass
+
+    async def relay_frame(self, *operations):
+        writer = self.Writer()
+        frames = FrameQueue(writer)
+        for operation in operations:
+            frames.put(*operation)
+        await asyncio.sleep(0)
+        return writer.data
+
+    async def test_relay_frame_raw_bytes_success(self):
+        writer = self.Writer()
+        frames = FrameQueue(writer)
+        media = bytes(range(256)) * 4096
+        frames.put("receive", "c1", {"type": "websocket.receive", "bytes": media})
+        frames.put("close", "c2")
+        await asyncio.sleep(0)
+
+        # Bytes travel raw, after the JSON operations
+        self.assertLess(len(writer.data), len(media) + 200)
+        reader = asyncio.StreamReader()
+        reader.feed_data(writer.data)
+        reader.feed_eof()
+        operations, blobs = await read_relay_frame(reader)
+        self.assertEqual(
+            [decode_asgi(operation, blobs) for operation in operations],
+            [
+                ["receive", "c1", {"type": "websocket.receive", "bytes": media}],
+                ["close", "c2", None],
+            ],
+        )
+        self.assertIsNone(await read_relay_frame(reader))
+
+    async def test_relay_frame_failure_oversized(self):
+        writer = self.Writer()
+        frames = FrameQueue(writer)
+        with patch("chat.affinity.MAX_FRAME_SIZE", 1024):
+            # Operations too large for a frame are refused one connection at a time
+            self.assertFalse(
+                frames.put(
+                    "receive", "c1", {"type": "websocket.receive", "bytes": b"x" * 2048}
+                )
+            )
+            self.assertTrue(frames.put("close", "c2"))
+            await asyncio.sleep(0)
+            frame = writer.data
+
+            # An oversized or corrupt frame is skipped, and the next one still read
+            reader = asyncio.StreamReader()
+            reader.feed_data(
+                (4096).to_bytes(4, "big") + (0).to_bytes(4, "big") + b"x" * 4096
+            )
+            reader.feed_data((3).to_bytes(4, "big") + (0).to_bytes(4, "big") + b"[[[")
+            reader.feed_data(frame)
+            reader.feed_eof()
+            for _ in range(2):
+                with self.assertRaises(BrokerError):
+                    await read_relay_frame(reader)
+            operations, _ = await read_relay_frame(reader)
+            self.assertEqual(operations, [["close", "c2", None]])
+
+    async def test_worker_link_failure_wrong_secret(self):
+        opened = []
+
+        async def application(scope, receive, send):
+            opened.append(scope)
+
+        address = f"unix://{tempfile.mkdtemp()}/worker.sock"
+        worker = ChamberWorker(application)
+        server = await worker.start(address)
+        reader, writer = await open_broker_connection(address)
+        writer.write(
+            await self.relay_frame(
+                ("hello", None, {"secret": "guessed"}),
+                ("open", "c1", {"type": "websocket", "path": "/"}),
+            )
+        )
+        self.assertIsNone(await read_relay_frame(reader))  # Closed by the worker
+        self.assertEqual(worker.rejected_links, 1)
+        self.assertEqual(opened, [])
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    @override_settings(OUTBOUND_QUEUE={**settings.OUTBOUND_QUEUE, "MAX_SIZE": 3})
+    async def test_worker_connection_failure_slow_client(self):
+        reader = asyncio.StreamReader()
+        connection = WorkerConnection("worker", reader, self.Writer(), lambda _: None)
+        outbox = connection.open("c1", {"type": "websocket"})
+        overflow_closes = outbound_counters.overflow_closes
+        reader.feed_data(
+            await self.relay_frame(
+                *[
+                    ("send", "c1", {"type": "websocket.send", "text": str(i)})
+                    for i in range(5)
+                ]
+            )
+        )
+        await asyncio.sleep(0.01)
+
+        # Nobody drained the outbox: the client is closed with the resync code
+        self.assertEqual(
+            [outbox.get_nowait() for _ in range(outbox.qsize())],
+            [
+                {
+                    "type": "websocket.close",
+                    "code": settings.OUTBOUND_QUEUE["RESYNC_CLOSE_CODE"],
+                },
+                None,
+            ],
+        )
+        self.assertEqual(outbound_counters.overflow_closes, overflow_closes + 1)
+        reader.feed_eof()
+        await asyncio.sleep(0)
+
+
+class HashRingTestCase(SimpleTestCase):
+    def test_hash_ring_success(self):
+        ring = HashRing(["worker-1", "worker-2", "worker-3"])
+        chambers = [str(uuid4()) for i in range(3000)]
+        owners = {chamber: ring.node_for(chamber) for chamber in chambers}
+        for worker in ["worker-1", "worker-2", "worker-3"]:
+            self.assertGreater(list(owners.values()).count(worker), 600)
+
+        # Only the chambers of the removed worker move, and they come back with it
+        ring.remove("worker-2")
+        for chamber in chambers:
+            if owners[chamber] != "worker-2":
+                self.assertEqual(ring.node_for(chamber), owners[chamber])
+            else:
+                self.assertNotEqual(ring.node_for(chamber), "worker-2")
+        ring.add("worker-2")
+        self.assertEqual(
+            {chamber: ring.node_for(chamber) for chamber in chambers}, owners
+        )
+
+
+@override_settings(
+    ADMISSION={
+        **settings.ADMISSION,
+        "MAX_IN_FLIGHT": 2,
+        "MAX_QUEUED": 1,
+        "QUEUE_TIMEOUT": 0.1,
+    }
+)
+class AdmissionControllerTestCase(SimpleTestCase):
+    async def test_admission_controller_success(self):
+        admission = AdmissionController()
+        self.assertIsNone(await admission.acquire())
+        self.assertIsNone(await admission.acquire())
+
+        # The third handshake waits for a slot, the fourth finds the queue full
+        queued = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        self.assertEqual(await admission.acquire(), "queue_full")
+        admission.release()
+        self.assertIsNone(await queued)
+        self.assertEqual(admission.stats()["in_flight"], 2)
+
+        self.assertEqual(await admission.acquire(), "timeout")
+        admission.release()
+        admission.release()
+        self.assertEqual(admission.stats()["in_flight"], 0)
+        self.assertEqual(admission.queued, 2)
+        self.assertEqual(admission.admitted, 3)
+
+    async def test_admission_controller_cancelled_handshake(self):
+        admission = AdmissionController()
+        await admission.acquire()
+        await admission.acquire()
+
+        # A queued handshake cancelled right after being handed a slot passes it on
+        queued = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        admission.release()
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        self.assertEqual(admission.stats()["in_flight"], 1)
+
+        # A handshake cancelled while waiting holds no slot
+        await admission.acquire()
+        queued = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        admission.release()
+        admission.release()
+        self.assertEqual(admission.stats()["in_flight"], 0)
+
+    @override_settings(
+        ADMISSION={
+            **settings.ADMISSION,
+            "MAX_CONNECTIONS": 3,
+            "MAX_USER_CONNECTIONS": 2,
+        }
+    )
+    async def test_admission_controller_failure_connection_limits(self):
+        admission = AdmissionController()
+        await admission.acquire()  # Binds the controller to this event loop
+        self.assertTrue(admission.open_connection(1))
+        self.assertTrue(admission.open_connection(1))
+        self.assertFalse(admission.open_connection(1))
+        self.assertTrue(admission.open_connection(2))
+        self.assertFalse(admission.open_connection(3))
+        self.assertEqual(await admission.acquire(), "worker_full")
+
+        admission.close_connection(1)
+        self.assertTrue(admission.open_connection(3))
+        self.assertEqual(admission.rejected["user_full"], 1)
+        self.assertEqual(admission.rejected["worker_full"], 2)
+
+
+class BrokerChannelLayerTestCase(SimpleTestCase):
+    async def test_broker_channel_layer_success(self):
+        address = f"unix://{tempfile.mkdtemp()}/broker.sock"
+        broker = ChannelBroker()
+        server = await broker.start(address)
+        # Two layers stand in for two worker processes
+        first, second = BrokerChannelLayer(address), BrokerChannelLayer(address)
+        channels = [
+            await first.new_channel(),
+            await first.new_channel(),
+            await second.new_channel(),
+        ]
+        for channel in channels:
+            await first.group_add("chamber", channel)
+
+        await second.group_send("chamber", {"type": "chat.message", "text": "hi"})
+        for layer, channel in zip([first, first, second], channels):
+            message = await asyncio.wait_for(layer.receive(channel), 1)
+            self.assertEqual(message["text"], "hi")
+        # One delivery frame per worker, not per channel
+        self.assertEqual(broker.deliveries, 2 + 3)  # Plus the group_add acks
+
+        await first.close()
+        await asyncio.sleep(0.05)
+        await second.group_send("chamber", {"type": "chat.message", "text": "bye"})
+        message = await asyncio.wait_for(second.receive(channels[2]), 1)
+        self.assertEqual(message["text"], "bye")
+        self.assertEqual(broker.stats()["clients"], 1)
+
+        await second.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_broker_channel_layer_reconnect_success(self):
+        address = f"unix://{tempfile.mkdtemp()}/broker.sock"
+        broker = ChannelBroker()
+        server = await broker.start(address)
+        first, second = BrokerChannelLayer(address), BrokerChannelLayer(address)
+        channel = await first.new_channel()
+        await first.group_add("chamber", channel)
+        await second.group_send("chamber", {"type": "chat.message", "text": "hi"})
+        self.assertEqual(
+            (await asyncio.wait_for(first.receive(channel), 1))["text"], "hi"
+        )
+
+        # The broker drops the link, and with it the memberships
+        connection = next(iter(first._connections.values()))
+        broker._clients[connection.client_id].transport.abort()
+        await asyncio.sleep(0.05)
+        self.assertEqual(broker.stats()["groups"], 0)
+
+        # The layer reconnects with the same client id and adds its channel again
+        receiver = asyncio.ensure_future(first.receive(channel))
+        for _ in range(50):
+            if broker.stats()["groups"]:
+                break
+            await asyncio.sleep(0.05)
+        await second.group_send("chamber", {"type": "chat.message", "text": "back"})
+        self.assertEqual((await asyncio.wait_for(receiver, 1))["text"], "back")
+        self.assertEqual(first.stats()["reconnects"], 1)
+
+        await first.close()
+        await second.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_broker_failure_rejected_links(self):
+        address = f"unix://{tempfile.mkdtemp()}/broker.sock"
+        broker = ChannelBroker()
+        server = await broker.start(address)
+        layer = BrokerChannelLayer(address)
+        channel = await layer.new_channel()
+        await layer.group_add("chamber", channel)
+        client_id = next(iter(layer._connections.values())).client_id
+
+        # A wrong secret, a missing hello and a connected client's id are refused
+        for hello in [
+            ["hello", uuid4().hex, "guessed"],
+            ["group_add", "chamber", f"specific.{uuid4().hex}!x", "ack"],
+            ["hello", client_id, broker_link_secret()],
+        ]:
+            reader, writer = await open_broker_connection(address)
+            write_frame(writer, [hello, ["group_discard", "chamber", channel]])
+            self.assertIsNone(await asyncio.wait_for(read_frame(reader), 1))
+            writer.close()
+        self.assertEqual(broker.stats()["rejected_links"], 3)
+
+        await layer.group_send("chamber", {"type": "chat.message", "text": "hi"})
+        message = await asyncio.wait_for(layer.receive(channel), 1)
+        self.assertEqual(message["text"], "hi")
+        await layer.close()
+        server.close()
+        await server.wait_closed()
+
+
+class MessageWriterTestCase(APITransactionTestCase):
+    @sync_to_async
+    def create_chamber(self):
+        self.user = User.objects.create_user(
+            email="admin@gmail.com", password="Adm1!n123", is_email_verified=True
+        )
+        return Chamber.objects.create(chambername="test", creator=self.user)
+
+    async def test_message_writer_group_commit_success(self):
+        chamber = await self.create_chamber()
+        batches = message_writer.batches
+        results = await asyncio.gather(
+            *(
+                create_new_message(f"message {i}", self.user, chamber.id)
+                for i in range(20)
+            )
+        )
+        self.assertEqual(message_writer.batches, batches + 1)
+        self.assertEqual(len({message_id for message_id, _, _ in results}), 20)
+        self.assertEqual(sorted(seq for _, _, seq in results), list(range(1, 21)))
+        self.assertEqual(await Message.objects.filter(chamber=chamber).acount(), 20)
+
+    async def test_message_writer_group_commit_failure_isolated(self):
+        chamber = await self.create_chamber()
+        results = await asyncio.gather(
+            create_new_message("valid", self.user, chamber.id),
+            create_new_message("invalid", self.user, uuid4()),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[0], tuple)
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertEqual(await Message.objects.filter(chamber=chamber).acount(), 1)
+
+
+@override_settings(PRESENCE={**settings.PRESENCE, "ACTIVE_INTERVAL": 0.2})
+class ChamberConsumerTestCase(APITransactionTestCase):
+    async def asyncSetUp(self):
+        self.user = await self.create_user(
+            email="admin@gmail.com",
+            username="admin",
+            password="Adm1!n123",
+            is_email_verified=True,
+        )
+        self.token = await self.get_token(self.user)
+
+        self.user2 = await self.create_user(
+            email="admin@gmail2.com",
+            username="admin2",
+            password="Adm1!n123",
+            is_email_verified=True,
+        )
+        self.token2 = await self.get_token(self.user2)
+
+        self.chamber = await self.create_chamber(chambername="test", creator=self.user)
+
+        self.application = URLRouter(
+            [
+                path("testws/chamber/<str:chamber_id>/", ChamberConsumer.as_asgi()),
+            ]
+        )
+
+        self.url = f"/testws/chamber/{self.chamber.id}/"
+
+    @sync_to_async
+    def create_user(self, email, username, password, is_email_verified=False):
+        user = User.objects.create_user(
+            email=email,
+            username=username,
+            password=password,
+            is_email_verified=is_email_verified,
+        )
+        JWTAccessToken.objects.create(user=user)
+        return user
+
+    @sync_to_async
+    def get_token(self, user):
+        return self.client.post(
+            reverse("user:login"),
+            data={"email": user.email, "password": "Adm1!n123"},
+        ).data["access"]
+
+    @sync_to_async
+    def create_chamber(self, chambername, creator):
+        return Chamber.objects.create(chambername=chambername, creator=creator)
+
+    @sync_to_async
+    def add_user_to_chamber(self, user):
+        self.chamber.users.add(user)
+
+    async def test_chamber_consumer_connect_disconnect_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(connected, True)
+        await presence.flush()
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, True)
+
+        # Test adding new user to chamber
+        await self.add_user_to_chamber(self.user2)
+        message = await communicator.receive_from()
+        self.assertEqual(
+            message,
+            '{"type": "chat.active", "content": 1}',
+        )
+        message = await communicator.receive_from()
+        self.assertEqual(
+            message,
+            '{"type": "chat.notification", "content": "admin2 was added to the chat."}',
+        )
+
+        # Test sending number of active users
+        communicator2 = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token2}"},
+        )
+        connected, subprotocol = await communicator2.connect()
+        message = await communicator.receive_from()
+        self.assertEqual(
+            message,
+            '{"type": "chat.active", "content": 2}',
+        )
+
+        # Test sending text message
+        await send_text_message(communicator)
+        message = await communicator.receive_from()
+        dict_message = json.loads(message)
+        self.assertEqual(dict_message["type"], "chat.message")
+        self.assertEqual(dict_message["sender"], "admin")
+
+        # Test send text reply message
+        await send_reply_text_message(
+            communicator, previous_message_id=dict_message["id"]
+        )
+        message = await communicator.receive_from()
+        reply_dict_message = json.loads(message)
+        self.assertEqual(reply_dict_message["type"], "chat.reply")
+        self.assertEqual(reply_dict_message["sender"], "admin")
+        self.assertEqual(
+            reply_dict_message["previous_message_content"], dict_message["content"]
+        )
+        self.assertEqual(reply_dict_message["previous_message_id"], dict_message["id"])
+
+        # Test send image
+        await send_image_message(communicator)
+        message = await communicator.receive_from()
+        image_dict_message = json.loads(message)
+        self.assertEqual(image_dict_message["type"], "chat.media")
+        self.assertEqual(image_dict_message["filename"].endswith("png"), True)
+        self.assertNotIn("content", image_dict_message)
+        self.assertEqual(image_dict_message["content_type"], "image/png")
+        self.assertEqual(image_dict_message["url"].endswith(".png"), True)
+        self.assertGreater(image_dict_message["size"], 0)
+
+        # Test send audio
+        await send_audio_message(communicator)
+        message = await communicator.receive_from()
+        audio_dict_message = json.loads(message)
+        self.assertEqual(audio_dict_message["type"], "chat.media")
+        self.assertEqual(audio_dict_message["filename"].endswith("wav"), True)
+
+        # Test send image reply message
+        await send_reply_image_message(
+            communicator, previous_message_id=audio_dict_message["id"]
+        )
+        message = await communicator.receive_from()
+        image_reply_dict_message = json.loads(message)
+        self.assertEqual(image_reply_dict_message["type"], "chat.reply")
+        self.assertEqual(image_reply_dict_message["sender"], "admin")
+        self.assertEqual(image_reply_dict_message["previous_message_content"], "AUDIO")
+        self.assertEqual(
+            image_reply_dict_message["previous_message_id"], audio_dict_message["id"]
+        )
+
+        # Test send audio reply message
+        await send_reply_audio_message(
+            communicator, previous_message_id=image_reply_dict_message["id"]
+        )
+        message = await communicator.receive_from()
+        audio_reply_dict_message = json.loads(message)
+        self.assertEqual(audio_reply_dict_message["type"], "chat.reply")
+        self.assertEqual(audio_reply_dict_message["sender"], "admin")
+        self.assertEqual(audio_reply_dict_message["previous_message_content"], "IMAGE")
+        self.assertEqual(
+            audio_reply_dict_message["previous_message_id"],
+            image_reply_dict_message["id"],
+        )
+
+        await communicator.disconnect()
+        await presence.flush(force=True)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, False)
+
+    async def test_chamber_consumer_presence_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicators = []
+        for i in range(2):
+            communicator = WebsocketCommunicator(
+                self.application,
+                self.url,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+            await communicator.connect()
+            communicators.append(communicator)
+        await presence.flush()
+        writes = presence.writes
+
+        # Closing one of two tabs keeps the user online
+        await communicators[0].disconnect()
+        await presence.flush(force=True)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, True)
+
+        # A reconnect within the grace period writes nothing
+        await communicators[1].disconnect()
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await presence.flush()
+        self.assertEqual(presence.writes, writes)
+
+        await communicator.disconnect()
+        await presence.flush(force=True)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, False)
+        self.assertIsNone(user.online_until)
+
+    async def test_chamber_consumer_presence_across_processes_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        # The user is also connected to another worker
+        lease = await PresenceLease.objects.acreate(
+            user=self.user,
+            process="other",
+            expires=datetime.now(timezone.utc) + timedelta(seconds=60),
+        )
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await presence.flush()
+        await communicator.disconnect()
+        await presence.flush(force=True)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, True)
+        self.assertFalse(
+            await PresenceLease.objects.filter(process=PROCESS_ID).aexists()
+        )
+
+        await lease.adelete()
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await presence.flush()
+        await communicator.disconnect()
+        await presence.flush(force=True)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, False)
+
+    async def test_chamber_consumer_presence_failed_flush_retried(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await presence.flush()
+        await communicator.disconnect()
+
+        failed_flushes = presence.failed_flushes
+        with patch.object(presence, "_write", side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                await presence.flush(force=True)
+        self.assertEqual(presence.failed_flushes, failed_flushes + 1)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, True)
+
+        await presence.flush(force=True)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertEqual(user.is_online, False)
+
+    async def test_chamber_consumer_active_count_debounced(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        await self.add_user_to_chamber(self.user2)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "chat.active", "content": 1})
+
+        # Connections within the interval are folded into one broadcast
+        communicators = []
+        for i in range(3):
+            communicator2 = WebsocketCommunicator(
+                self.application,
+                self.url,
+                headers={"Authorization": f"Bearer {self.token2}"},
+            )
+            await communicator2.connect()
+            communicators.append(communicator2)
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "chat.active", "content": 2})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.5))
+
+        for communicator2 in communicators:
+            await communicator2.disconnect()
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "chat.active", "content": 1})
+        await communicator.disconnect()
+
+    async def test_chamber_consumer_active_count_across_processes_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "chat.active", "content": 1})
+
+        # Another process's members are counted once, and the new process is sent
+        # this process's members in return
+        chamber_id = str(self.chamber.id)
+        channel_layer = get_channel_layer()
+        other_process = await channel_layer.new_channel()
+        await channel_layer.group_add(chamber_activity.ACTIVITY_GROUP, other_process)
+        chamber_channel = await channel_layer.new_channel()
+        await channel_layer.group_add(chamber_id, chamber_channel)
+
+        def remote_activity(members):
+            return {
+                "type": "chat.activity",
+                "chamber_id": chamber_id,
+                "process": "other",
+                "members": members,
+            }
+
+        members = [str(self.user.id), str(self.user2.id)]
+        await channel_layer.group_send(
+            chamber_activity.ACTIVITY_GROUP, remote_activity(members)
+        )
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "chat.active", "content": 2})
+        self.assertEqual(
+            (await channel_layer.receive(other_process))["process"], "other"
+        )
+        reply = await channel_layer.receive(other_process)
+        self.assertEqual(reply["process"], PROCESS_ID)
+        self.assertEqual(reply["members"], [str(self.user.id)])
+
+        # The chamber group only carries the count, never the members
+        event = await channel_layer.receive(chamber_channel)
+        self.assertEqual(event["type"], "chat.active")
+        self.assertNotIn("members", event)
+        self.assertEqual(json.loads(event["text"])["content"], 2)
+
+        # Unchanged refreshes are not sent to clients
+        await channel_layer.group_send(
+            chamber_activity.ACTIVITY_GROUP, remote_activity(members)
+        )
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+
+        await channel_layer.group_send(
+            chamber_activity.ACTIVITY_GROUP, remote_activity([])
+        )
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {"type": "chat.active", "content": 1})
+        await channel_layer.group_discard(
+            chamber_activity.ACTIVITY_GROUP, other_process
+        )
+        await channel_layer.group_discard(chamber_id, chamber_channel)
+        await communicator.disconnect()
+
+    async def test_chamber_consumer_compact_protocol_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        await self.add_user_to_chamber(self.user2)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+            subprotocols=["unknown.v1", compact_codec.subprotocol],
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, compact_codec.subprotocol)
+        message = compact_codec.decode(await communicator.receive_from())
+        self.assertEqual(message, {"type": "chat.active", "content": 1})
+
+        # JSON clients in the same chamber keep receiving JSON
+        communicator2 = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token2}"},
+        )
+        await communicator2.connect()
+        await communicator.receive_from()  # chat.active
+        await communicator2.receive_from()  # chat.active
+
+        await communicator.send_to(
+            bytes_data=compact_codec.encode(
+                {"message": "hello", "message_type": "message"}
+            )
+        )
+        message = compact_codec.decode(await communicator.receive_from())
+        self.assertEqual(message["type"], "chat.message")
+        self.assertEqual(message["content"], "hello")
+        self.assertIsInstance(message["timestamp"], datetime)
+        self.assertNotIn("created", message)
+        message2 = await communicator2.receive_json_from()
+        self.assertEqual(message2["id"], message["id"])
+        self.assertIn("created", message2)
+
+        await communicator2.disconnect()
+        await communicator.disconnect()
+
+    async def test_chamber_consumer_batch_frames_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+
+        await communicator.send_json_to({"message_type": "batch_frames"})
+        for i in range(3):
+            await communicator.send_json_to(
+                {"message": f"message {i}", "message_type": "message"}
+            )
+        messages = []
+        while len(messages) < 3:
+            frame = await communicator.receive_json_from()
+            self.assertIsInstance(frame, list)
+            messages.extend(frame)
+        self.assertEqual(
+            [message["content"] for message in messages],
+            ["message 0", "message 1", "message 2"],
+        )
+        await communicator.disconnect()
+
+    async def test_chamber_consumer_replay_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        await self.add_user_to_chamber(self.user2)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+        await communicator.send_json_to(
+            {"message": "before", "message_type": "message"}
+        )
+        last_seq = (await communicator.receive_json_from())["seq"]
+
+        # Missed while disconnected, then replayed from memory
+        for content in ["missed 1", "missed 2"]:
+            await communicator.send_json_to(
+                {"message": content, "message_type": "message"}
+            )
+            await communicator.receive_from()
+        memory_hits = recent_events.memory_hits
+        communicator2 = WebsocketCommunicator(
+            self.application,
+            f"{self.url}?last_seq={last_seq}",
+            headers={"Authorization": f"Bearer {self.token2}"},
+        )
+        await communicator2.connect()
+        replayed = [await communicator2.receive_json_from() for i in range(2)]
+        self.assertEqual(
+            [message["content"] for message in replayed], ["missed 1", "missed 2"]
+        )
+        self.assertEqual(
+            [message["seq"] for message in replayed], [last_seq + 1, last_seq + 2]
+        )
+        self.assertEqual(recent_events.memory_hits, memory_hits + 1)
+        await communicator2.disconnect()
+        await communicator.disconnect()
+
+        # Without local connections the buffer is gone, so replay reads the database
+        memory_misses = recent_events.memory_misses
+        communicator2 = WebsocketCommunicator(
+            self.application,
+            f"{self.url}?last_seq={last_seq}",
+            headers={"Authorization": f"Bearer {self.token2}"},
+        )
+        await communicator2.connect()
+        replayed = [await communicator2.receive_json_from() for i in range(2)]
+        self.assertEqual(
+            [message["content"] for message in replayed], ["missed 1", "missed 2"]
+        )
+        self.assertEqual(recent_events.memory_misses, memory_misses + 1)
+        await communicator2.disconnect()
+
+    async def test_chamber_consumer_affinity_router_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        address = f"unix://{tempfile.mkdtemp()}/worker.sock"
+        worker = ChamberWorker(URLRouter(websocket_urlpatterns))
+        server = await worker.start(address)
+        router = ChamberAffinityRouter(self.application, workers=[address])
+
+        communicator = WebsocketCommunicator(
+            router,
+            f"/ws/chamber/{self.chamber.id}/",
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(worker.connections, 1)
+        await communicator.receive_from()  # chat.active
+        await communicator.send_json_to(
+            {"message": "via the worker", "message_type": "message"}
+        )
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["content"], "via the worker")
+
+        # Moving the chamber closes the client so it reconnects to the new owner
+        router.remove_worker(address)
+        output = await communicator.receive_output()
+        self.assertEqual(output["type"], "websocket.close")
+        self.assertEqual(
+            output["code"], settings.CHAMBER_AFFINITY["REBALANCE_CLOSE_CODE"]
+        )
+        await communicator.disconnect()
+        await asyncio.sleep(0.05)
+        self.assertEqual(worker.connections, 0)
+        router.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_chamber_consumer_broker_layer_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        await self.add_user_to_chamber(self.user2)
+        address = f"unix://{tempfile.mkdtemp()}/broker.sock"
+        server = await ChannelBroker().start(address)
+        with override_settings(
+            CHANNEL_LAYERS={
+                "default": {
+                    "BACKEND": "chat.layers.BrokerChannelLayer",
+                    "CONFIG": {"address": address},
+                }
+            }
+        ):
+            communicator = WebsocketCommunicator(
+                self.application,
+                self.url,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+            communicator2 = WebsocketCommunicator(
+                self.application,
+                self.url,
+                headers={"Authorization": f"Bearer {self.token2}"},
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator2.connect()
+            await communicator.send_json_to(
+                {"message": "through the broker", "message_type": "message"}
+            )
+            for receiver in [communicator, communicator2]:
+                while (message := await receiver.receive_json_from())[
+                    "type"
+                ] != "chat.message":
+                    pass
+                self.assertEqual(message["content"], "through the broker")
+            await communicator2.disconnect()
+            await communicator.disconnect()
+            await get_channel_layer().close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_user_consumer_subscribe_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        other_chamber = await self.create_chamber(
+            chambername="other", creator=self.user2
+        )
+        application = URLRouter([path("testws/user/", UserConsumer.as_asgi())])
+        communicator = WebsocketCommunicator(
+            application,
+            "/testws/user/",
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        chamber_id = str(self.chamber.id)
+        await communicator.send_json_to(
+            {
+                "message_type": "subscribe",
+                "chamber_ids": [chamber_id, str(other_chamber.id), "invalid"],
+            }
+        )
+        response = await communicator.receive_json_from()
+        self.assertEqual(response["type"], "chat.subscribed")
+        self.assertEqual(response["chamber_ids"], [chamber_id])
+        self.assertEqual(response["rejected"], [str(other_chamber.id), "invalid"])
+        active = await communicator.receive_json_from()
+        self.assertEqual(
+            active, {"type": "chat.active", "content": 1, "chamber_id": chamber_id}
+        )
+
+        # Events posted on the chamber endpoint arrive tagged with their chamber
+        chamber_communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await chamber_communicator.connect()  # Same user, so the count is unchanged
+        await chamber_communicator.send_json_to(
+            {"message": "tagged", "message_type": "message"}
+        )
+        message = await chamber_communicator.receive_json_from()
+        self.assertNotIn("chamber_id", message)
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["content"], "tagged")
+        self.assertEqual(message["chamber_id"], chamber_id)
+
+        # Missed messages are replayed on subscribe
+        await communicator.send_json_to(
+            {"message_type": "unsubscribe", "chamber_ids": [chamber_id]}
+        )
+        response = await communicator.receive_json_from()
+        self.assertEqual(
+            response, {"type": "chat.unsubscribed", "chamber_ids": [chamber_id]}
+        )
+        await communicator.send_json_to(
+            {
+                "message_type": "subscribe",
+                "chamber_ids": [chamber_id],
+                "last_seq": {chamber_id: message["seq"] - 1},
+            }
+        )
+        await communicator.receive_json_from()  # chat.subscribed
+        replayed = await communicator.receive_json_from()
+        self.assertEqual(replayed["id"], message["id"])
+        self.assertEqual(replayed["chamber_id"], chamber_id)
+
+        await chamber_communicator.disconnect()
+        await communicator.disconnect()
+
+    @override_settings(OUTBOUND_QUEUE={**settings.OUTBOUND_QUEUE, "BATCH_WINDOW": 0.2})
+    async def test_user_consumer_typing_coalesced_per_chamber_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        other_chamber = await self.create_chamber(
+            chambername="other", creator=self.user
+        )
+        await sync_to_async(other_chamber.users.add)(self.user)
+        chamber_ids = [str(self.chamber.id), str(other_chamber.id)]
+        application = URLRouter([path("testws/user/", UserConsumer.as_asgi())])
+        communicator = WebsocketCommunicator(
+            application,
+            "/testws/user/",
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.send_json_to(
+            {"message_type": "subscribe", "chamber_ids": chamber_ids}
+        )
+        self.assertEqual(
+            (await communicator.receive_json_from())["type"], "chat.subscribed"
+        )
+        while not await communicator.receive_nothing(0.3):
+            await communicator.receive_json_from()  # chat.active
+
+        # Both chambers' typing events are queued before the batch is sent
+        await communicator.send_json_to({"message_type": "batch_frames"})
+        await asyncio.sleep(0.05)
+        for chamber_id in chamber_ids:
+            await get_channel_layer().group_send(
+                chamber_id,
+                {
+                    "type": "chat.typing",
+                    "chamber_id": chamber_id,
+                    "event_id": uuid4().hex,
+                    "process": "other",
+                    "typists": ["admin2"],
+                },
+            )
+        batch = await communicator.receive_json_from()
+        self.assertEqual(
+            sorted(
+                event["chamber_id"] for event in batch if event["type"] == "chat.typing"
+            ),
+            sorted(chamber_ids),
+        )
+        await communicator.disconnect()
+
+    async def test_chamber_consumer_failure_user_connection_limit(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicators = [
+            WebsocketCommunicator(
+                self.application,
+                self.url,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+            for i in range(2)
+        ]
+        with override_settings(
+            ADMISSION={**settings.ADMISSION, "MAX_USER_CONNECTIONS": 1}
+        ):
+            connected, _ = await communicators[0].connect()
+            self.assertTrue(connected)
+            connected, _ = await communicators[1].connect()
+            self.assertTrue(connected)  # Accepted, so the close code gets through
+            output = await communicators[1].receive_output()
+            self.assertEqual(output["code"], settings.ADMISSION["RETRY_CLOSE_CODE"])
+            self.assertEqual(
+                output["reason"], f"retry-after={settings.ADMISSION['RETRY_AFTER']}"
+            )
+            await communicators[1].disconnect()
+            await communicators[0].disconnect()
+
+    async def test_chamber_consumer_failure_handshake_error(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        user_application = URLRouter([path("testws/user/", UserConsumer.as_asgi())])
+        for application, url in [
+            (self.application, self.url),
+            (user_application, "/testws/user/"),
+        ]:
+            admission = AdmissionController()
+            communicator = WebsocketCommunicator(
+                application, url, headers={"Authorization": f"Bearer {self.token}"}
+            )
+            with patch("chat.consumers.admission", admission), patch(
+                "chat.consumers.negotiate_codec", side_effect=RuntimeError("codec")
+            ):
+                with self.assertRaises(RuntimeError):
+                    await communicator.connect()
+            # The admitted connection is given back
+            self.assertEqual(admission.stats()["connections"], 0)
+            self.assertEqual(admission.stats()["in_flight"], 0)
+
+    @override_settings(OUTBOUND_QUEUE={**settings.OUTBOUND_QUEUE, "MAX_SIZE": 2})
+    async def test_chamber_consumer_failure_outbound_overflow(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        stalled = asyncio.Event()
+        closes = []
+        close = ChamberConsumer.close
+
+        async def stalled_write_frame(consumer, data):
+            await stalled.wait()
+
+        async def counted_close(consumer, code=None, reason=None):
+            closes.append(code)
+            await close(consumer, code=code, reason=reason)
+
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        with patch.object(ChamberConsumer, "write_frame", stalled_write_frame):
+            with patch.object(ChamberConsumer, "close", counted_close):
+                await communicator.connect()
+                await asyncio.sleep(0.05)
+                # The client reads nothing; messages beyond the queue close it once
+                for seq in range(1, 7):
+                    await get_channel_layer().group_send(
+                        str(self.chamber.id),
+                        chamber_event(
+                            "chat.message",
+                            self.chamber.id,
+                            id=str(uuid4()),
+                            content=f"message {seq}",
+                            seq=seq,
+                        ),
+                    )
+                output = await communicator.receive_output()
+                self.assertEqual(output["type"], "websocket.close")
+                self.assertEqual(
+                    output["code"], settings.OUTBOUND_QUEUE["RESYNC_CLOSE_CODE"]
+                )
+                self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+                self.assertEqual(closes, [settings.OUTBOUND_QUEUE["RESYNC_CLOSE_CODE"]])
+                await communicator.disconnect()
+
+    @override_settings(TYPING={"INTERVAL": 0.1, "RATE": 2, "TTL": 0.5})
+    async def test_chamber_consumer_typing_coalesced(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        await self.add_user_to_chamber(self.user2)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+        communicator2 = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token2}"},
+        )
+        await communicator2.connect()
+        await communicator.receive_from()  # chat.active
+        await communicator2.receive_from()  # chat.active
+
+        # Repeated signals are throttled into a single event, never sent to the typist
+        throttled = typing_aggregator.throttled
+        for i in range(5):
+            await communicator2.send_json_to(
+                {"message": "typing", "message_type": "typing"}
+            )
+        message = await communicator.receive_json_from()
+        self.assertEqual(
+            message,
+            {
+                "type": "chat.typing",
+                "typists": ["admin2"],
+                "content": "admin2 is typing...",
+            },
+        )
+        self.assertEqual(typing_aggregator.throttled, throttled + 4)
+        self.assertTrue(await communicator2.receive_nothing(timeout=0.3))
+
+        # Stale typists expire without a 'not_typing' signal
+        message = await communicator.receive_json_from()
+        self.assertEqual(
+            message, {"type": "chat.typing", "typists": [], "content": None}
+        )
+
+        await communicator2.disconnect()
+        await communicator.disconnect()
+
+    @override_settings(TYPING={**settings.TYPING, "INTERVAL": 0.2})
+    async def test_chamber_consumer_typing_across_processes_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        await self.add_user_to_chamber(self.user2)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+        communicator2 = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token2}"},
+        )
+        await communicator2.connect()
+        await communicator.receive_from()  # chat.active
+        await communicator2.receive_from()  # chat.active
+
+        chamber_id = str(self.chamber.id)
+        channel_layer = get_channel_layer()
+        other_process = await channel_layer.new_channel()
+        await channel_layer.group_add(chamber_id, other_process)
+
+        async def receive_typing(channel):
+            while True:
+                event = await channel_layer.receive(channel)
+                if event["type"] == "chat.typing":
+                    return event
+
+        def remote_typing(typists):
+            return {
+                "type": "chat.typing",
+                "chamber_id": chamber_id,
+                "event_id": uuid4().hex,
+                "process": "other",
+                "typists": typists,
+            }
+
+        await communicator2.send_json_to(
+            {"message": "typing", "message_type": "typing"}
+        )
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["typists"], ["admin2"])
+        shared = await receive_typing(other_process)
+        self.assertEqual(shared["process"], PROCESS_ID)
+        self.assertEqual(shared["typists"], ["admin2"])
+
+        # Typists of another process are merged with this process's own, and the
+        # other process is sent this process's typists in return
+        await channel_layer.group_send(chamber_id, remote_typing(["carol"]))
+        message = await communicator.receive_json_from()
+        self.assertEqual(
+            message,
+            {
+                "type": "chat.typing",
+                "typists": ["admin2", "carol"],
+                "content": "admin2 and carol are typing...",
+            },
+        )
+        message = await communicator2.receive_json_from()
+        self.assertEqual(message["typists"], ["carol"])
+        self.assertEqual((await receive_typing(other_process))["process"], "other")
+        shared = await receive_typing(other_process)
+        self.assertEqual(shared["process"], PROCESS_ID)
+        self.assertEqual(shared["typists"], ["admin2"])
+
+        await channel_layer.group_send(chamber_id, remote_typing([]))
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["typists"], ["admin2"])
+
+        await channel_layer.group_discard(chamber_id, other_process)
+        await communicator2.disconnect()
+        await communicator.disconnect()
+
+    @override_settings(CHUNKED_UPLOADS={**settings.CHUNKED_UPLOADS, "CHUNK_SIZE": 1024})
+    async def test_chamber_consumer_chunked_upload_success(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        audio_file = settings.BASE_DIR / "test-audio/audio.wav"
+        with open(audio_file, "rb") as file:
+            audio_data = file.read()
+        chunks = [audio_data[i : i + 1024] for i in range(0, len(audio_data), 1024)]
+
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+
+        await communicator.send_json_to(
+            {
+                "message_type": "upload_begin",
+                "media_type": "audio",
+                "size": len(audio_data),
+            }
+        )
+        ready = await communicator.receive_json_from()
+        self.assertEqual(ready["type"], "upload.ready")
+        self.assertEqual(ready["chunk_size"], 1024)
+        upload_id = ready["upload_id"]
+
+        # Send the first two chunks, then drop the connection
+        for index, chunk_data in enumerate(chunks[:2]):
+            await send_upload_chunk(communicator, upload_id, index, chunk_data)
+            ack = await communicator.receive_json_from()
+            self.assertEqual(ack["type"], "upload.ack")
+        await communicator.disconnect()
+
+        # Resume on a new connection from the reported offset
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+        await communicator.send_json_to(
+            {"message_type": "upload_offset", "upload_id": upload_id}
+        )
+        offset = await communicator.receive_json_from()
+        self.assertEqual(offset["offset"], 2048)
+        self.assertEqual(offset["next_chunk"], 2)
+
+        # Chunks must arrive in order
+        await send_upload_chunk(communicator, upload_id, 5, chunks[5])
+        error = await communicator.receive_json_from()
+        self.assertEqual(error["type"], "upload.error")
+
+        for index in range(offset["next_chunk"], len(chunks)):
+            await send_upload_chunk(communicator, upload_id, index, chunks[index])
+            ack = await communicator.receive_json_from()
+        self.assertEqual(ack["offset"], len(audio_data))
+
+        await communicator.send_json_to(
+            {"message_type": "upload_commit", "upload_id": upload_id}
+        )
+        media_message = await communicator.receive_json_from()
+        self.assertEqual(media_message["type"], "chat.media")
+        self.assertEqual(media_message["size"], len(audio_data))
+        self.assertEqual(media_message["content_type"], "audio/wav")
+
+        # Committed uploads cannot be reused
+        await communicator.send_json_to(
+            {"message_type": "upload_offset", "upload_id": upload_id}
+        )
+        error = await communicator.receive_json_from()
+        self.assertEqual(error["type"], "upload.error")
+        await communicator.disconnect()
+
+    @override_settings(
+        CHUNKED_UPLOADS={
+            **settings.CHUNKED_UPLOADS,
+            "MAX_USER_UPLOADS": 2,
+            "MAX_USER_UPLOAD_BYTES": 3000,
+        }
+    )
+    async def test_chamber_consumer_chunked_upload_failure_user_limits(self):
+        await self.asyncSetUp()
+        await self.add_user_to_chamber(self.user)
+        communicator = WebsocketCommunicator(
+            self.application,
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        await communicator.connect()
+        await communicator.receive_from()  # chat.active
+
+        # Over the byte budget, within it, then over the upload count
+        responses = []
+        for size in [2000, 1500, 1000, 1]:
+            await communicator.send_json_to(
+                {"message_type": "upload_begin", "media_type": "audio", "size": size}
+            )
+            responses.append(await communicator.receive_json_from())
+        self.assertEqual(
+            [response["type"] for response in responses],
+            ["upload.ready", "upload.error", "upload.ready", "upload.error"],
+        )
+        self.assertIn("3000 bytes", responses[1]["content"])
+        self.assertIn("Too many uploads", responses[3]["content"])
+
+        for response in responses:
+            if response["type"] == "upload.ready":
+                chunked_uploads.discard(
+                    chunked_uploads.get(
+                        response["upload_id"], self.user.id, str(self.chamber.id)
+                    )
+                )
+        await communicator.disconnect()
 
     def tearDown(self) -> None:
         sleep(1)
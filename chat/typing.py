@@ -0,0 +1,181 @@
+from django.conf import settings
+from time import monotonic
+from .events import chamber_event, RemoteShares, PROCESS_ID
+from uuid import uuid4
+import asyncio
+
+
+def describe_typists(usernames):
+    if not usernames:
+        return None
+    if len(usernames) == 1:
+        return f"{usernames[0]} is typing..."
+    if len(usernames) <= 3:
+        return f"{', '.join(usernames[:-1])} and {usernames[-1]} are typing..."
+    return f"{', '.join(usernames[:2])} and {len(usernames) - 2} others are typing..."
+
+
+class TypingAggregator:
+    """
+    Coalesces typing signals per chamber. Signals from a user are accepted at most once
+    every RATE seconds, typists expire TTL seconds after their last accepted signal, and
+    each chamber gets at most one 'chat.typing' event per INTERVAL listing everyone
+    currently typing (and only when that list changed).
+
+    Each process broadcasts only the typists connected to it, refreshed every TTL / 2
+    seconds while they keep typing; receivers merge them with their own and the other
+    processes' snapshots (see 'RemoteShares'), so clients see the chamber-wide list.
+    """
+
+    def __init__(self):
+        self._typists = {}  # chamber id -> {user id: [username, accepted at]}
+        self._changed = set()  # chambers whose typists changed since the last tick
+        self._last_sent = {}  # chamber id -> typists in the last event
+        self._last_broadcast = {}  # chamber id -> when its typists were last sent
+        self._remote = RemoteShares()  # chamber id -> other processes' typists
+        self._received = {}  # chamber id -> (last event id, merged local event)
+        self._channel_layer = None
+        self._task = None
+        self._loop = None
+        self.received = 0
+        self.throttled = 0
+        self.broadcasts = 0
+
+    def update(self, chamber_id, user_id, username, is_typing, channel_layer):
+        typing_settings = settings.TYPING
+        now = monotonic()
+        chamber_id = str(chamber_id)
+        self.received += 1
+        typists = self._typists.setdefault(chamber_id, {})
+        typist = typists.get(user_id)
+
+        if is_typing:
+            if typist is not None and now - typist[1] < typing_settings["RATE"]:
+                self.throttled += 1
+                return
+            typists[user_id] = [username, now]
+            if typist is None:
+                self._changed.add(chamber_id)
+        elif typist is not None:
+            del typists[user_id]
+            self._changed.add(chamber_id)
+
+        if not typists:
+            del self._typists[chamber_id]
+        self._channel_layer = channel_layer
+        self._ensure_ticker()
+
+    def _ensure_ticker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run_ticker())
+
+    def receive(self, event):
+        """
+        Returns the 'chat.typing' event for local connections, with everyone typing
+        in the chamber, for a broadcast from any process. Every local connection
+        receives the same broadcast, so the result is reused.
+        """
+        chamber_id = event["chamber_id"]
+        received = self._received.get(chamber_id)
+        if received is not None and received[0] == event["event_id"]:
+            return received[1]
+
+        if self._remote.update(chamber_id, event["process"], event["typists"]):
+            # A process that just started sharing gets this process's typists too
+            if chamber_id in self._last_sent:
+                self._changed.add(chamber_id)
+                self._last_broadcast.pop(chamber_id, None)
+                self._ensure_ticker()
+        typists = set(self._last_sent.get(chamber_id, ()))
+        for snapshot in self._remote.snapshots(chamber_id, settings.TYPING["TTL"]):
+            typists.update(snapshot)
+        typists = sorted(typists)
+        local_event = {
+            **chamber_event(
+                "chat.typing",
+                chamber_id,
+                typists=typists,
+                content=describe_typists(typists),
+            ),
+            # Lets consumers leave their own user out
+            "typists": typists,
+        }
+        self._received[chamber_id] = (event["event_id"], local_event)
+        return local_event
+
+    async def _run_ticker(self):
+        while self._typists or self._changed or len(self._remote):
+            await asyncio.sleep(settings.TYPING["INTERVAL"])
+            await self.tick()
+
+    async def tick(self):
+        ttl = settings.TYPING["TTL"]
+        now = monotonic()
+        for chamber_id, typists in list(self._typists.items()):
+            expired = [
+                user_id
+                for user_id, (_, accepted) in typists.items()
+                if now - accepted > ttl
+            ]
+            for user_id in expired:
+                del typists[user_id]
+            if expired:
+                self._changed.add(chamber_id)
+            if not typists:
+                del self._typists[chamber_id]
+
+        self._remote.expire(ttl)
+        for chamber_id in list(self._received):
+            if chamber_id not in self._last_sent and not self._remote.snapshots(
+                chamber_id, ttl
+            ):
+                del self._received[chamber_id]
+
+        # Other processes drop typists whose snapshot is not refreshed within TTL
+        changed, self._changed = self._changed, set()
+        for chamber_id, sent in self._last_broadcast.items():
+            if now - sent >= ttl / 2:
+                changed.add(chamber_id)
+        for chamber_id in changed:
+            usernames = sorted(
+                username for username, _ in self._typists.get(chamber_id, {}).values()
+            )
+            sent = self._last_broadcast.get(chamber_id)
+            if usernames == self._last_sent.get(chamber_id, []) and (
+                sent is not None and now - sent < ttl / 2
+            ):
+                continue
+            if usernames:
+                self._last_sent[chamber_id] = usernames
+                self._last_broadcast[chamber_id] = now
+            elif chamber_id not in self._last_sent:
+                continue  # Nothing to withdraw
+            else:
+                del self._last_sent[chamber_id]
+                del self._last_broadcast[chamber_id]
+
+            self.broadcasts += 1
+            await self._channel_layer.group_send(
+                str(chamber_id),
+                {
+                    "type": "chat.typing",
+                    "chamber_id": str(chamber_id),
+                    "event_id": uuid4().hex,
+                    "process": PROCESS_ID,
+                    "typists": usernames,
+                },
+            )
+
+    def stats(self):
+        return {
+            "chambers": len(self._typists),
+            "remote_shares": len(self._remote),
+            "received": self.received,
+            "throttled": self.throttled,
+            "broadcasts": self.broadcasts,
+        }
+
+
+typing_aggregator = TypingAggregator()
@@ -0,0 +1,191 @@
+from django.conf import settings
+from django.core.files import File
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+import asyncio
+import os
+import tempfile
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadedChunksFile(File):
+    """
+    Wraps the assembled temporary file so storage backends can move it into place
+    instead of reading it back into memory.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ChunkedUpload:
+    """
+    A resumable media upload. Chunks are appended in order to a temporary file on disk,
+    so memory use is bounded by the chunk size rather than the size of the file.
+    """
+
+    def __init__(self, user_id, chamber_id, media_type, size, metadata):
+        upload_settings = settings.CHUNKED_UPLOADS
+        self.upload_id = str(uuid4())
+        self.user_id = user_id
+        self.chamber_id = chamber_id
+        self.media_type = media_type
+        self.size = size
+        self.metadata = metadata
+        self.chunk_size = upload_settings["CHUNK_SIZE"]
+        self.offset = 0
+        self.next_chunk = 0
+        self.last_activity = monotonic()
+
+        temp_dir = upload_settings["TEMP_DIR"] or tempfile.gettempdir()
+        os.makedirs(temp_dir, exist_ok=True)
+        self.path = os.path.join(temp_dir, f"whisper-upload-{self.upload_id}.part")
+        open(self.path, "wb").close()
+
+    @property
+    def is_complete(self):
+        return self.offset == self.size
+
+    def state(self):
+        return {
+            "upload_id": self.upload_id,
+            "chunk_size": self.chunk_size,
+            "offset": self.offset,
+            "next_chunk": self.next_chunk,
+        }
+
+    def append(self, chunk_index, chunk_data):
+        """
+        Appends a numbered chunk. Chunks that were already written (re-sent after a reconnect)
+        are acknowledged without being written again.
+        """
+        self.last_activity = monotonic()
+        if not isinstance(chunk_index, int):
+            raise UploadError("Chunk number must be an integer.")
+        if chunk_index < self.next_chunk:
+            return False
+        if chunk_index > self.next_chunk:
+            raise UploadError(f"Expected chunk {self.next_chunk}, got {chunk_index}.")
+        if len(chunk_data) > self.chunk_size:
+            raise UploadError(f"Chunks cannot be larger than {self.chunk_size} bytes.")
+        if self.offset + len(chunk_data) > self.size:
+            raise UploadError("Upload exceeds its declared size.")
+
+        with open(self.path, "ab") as file:
+            file.write(chunk_data)
+        self.offset += len(chunk_data)
+        self.next_chunk += 1
+        return True
+
+    def open(self, filename):
+        return UploadedChunksFile(open(self.path, "rb"), name=filename)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRegistry:
+    """
+    Per-process registry of in-progress uploads. Uploads outlive the websocket connection
+    that started them, so a client can resume after reconnecting, and expire when idle.
+    A user may have at most MAX_USER_UPLOADS uploads in progress, declaring at most
+    MAX_USER_UPLOAD_BYTES between them; 'begin' rejects uploads beyond either.
+    While uploads are in progress, expired ones are removed every SWEEP_INTERVAL
+    seconds, so abandoned files do not wait for the next 'begin'.
+    """
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = Lock()
+        self._task = None
+        self._loop = None
+
+    def begin(self, user_id, chamber_id, media_type, size, metadata=None):
+        max_upload_size = settings.CHUNKED_UPLOADS["MAX_UPLOAD_SIZE"]
+        if media_type not in ("image", "audio", "video"):
+            raise UploadError("Invalid media type.")
+        if (
+            not isinstance(size, int)
+            or isinstance(size, bool)
+            or not 0 < size <= max_upload_size
+        ):
+            raise UploadError(
+                f"Upload size must be between 1 and {max_upload_size} bytes."
+            )
+
+        self.remove_expired()
+        with self._lock:
+            self._check_user_limits(user_id, size)
+            upload = ChunkedUpload(
+                user_id, chamber_id, media_type, size, metadata or {}
+            )
+            self._uploads[upload.upload_id] = upload
+        self._ensure_sweeper()
+        return upload
+
+    def _ensure_sweeper(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run_sweeper())
+
+    async def _run_sweeper(self):
+        while self._uploads:
+            await asyncio.sleep(settings.CHUNKED_UPLOADS["SWEEP_INTERVAL"])
+            self.remove_expired()
+
+    def _check_user_limits(self, user_id, size):
+        # Must hold the lock
+        upload_settings = settings.CHUNKED_UPLOADS
+        uploads = [
+            upload for upload in self._uploads.values() if upload.user_id == user_id
+        ]
+        if len(uploads) >= upload_settings["MAX_USER_UPLOADS"]:
+            raise UploadError(
+                f"Too many uploads in progress (at most "
+                f"{upload_settings['MAX_USER_UPLOADS']})."
+            )
+        if (
+            sum(upload.size for upload in uploads) + size
+            > upload_settings["MAX_USER_UPLOAD_BYTES"]
+        ):
+            raise UploadError(
+                f"Uploads in progress cannot exceed "
+                f"{upload_settings['MAX_USER_UPLOAD_BYTES']} bytes in total."
+            )
+
+    def get(self, upload_id, user_id, chamber_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if not upload or upload.user_id != user_id or upload.chamber_id != chamber_id:
+            raise UploadError("Upload does not exist or has expired.")
+        return upload
+
+    def discard(self, upload):
+        with self._lock:
+            self._uploads.pop(upload.upload_id, None)
+        upload.remove()
+
+    def remove_expired(self):
+        expiry = settings.CHUNKED_UPLOADS["EXPIRY"]
+        now = monotonic()
+        with self._lock:
+            expired = [
+                upload
+                for upload in self._uploads.values()
+                if now - upload.last_activity > expiry
+            ]
+            for upload in expired:
+                del self._uploads[upload.upload_id]
+        for upload in expired:
+            upload.remove()
+
+
+chunked_uploads = UploadRegistry()
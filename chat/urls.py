@@ -2,6 +2,8 @@ from django.urls import path
 from .views import (
     ChamberListView,
     ChamberHTMLView,
+    ChamberMessagesSinceView,
+    RuntimeStatsView,
 )
 
 
@@ -9,4 +11,10 @@ app_name = "chat"
 urlpatterns = [
     path("chamber-list/", ChamberListView.as_view(), name="chamber-list"),
     path("home/<str:chamber_id>/", ChamberHTMLView.as_view(), name="chamber-home"),
+    path(
+        "home/<str:chamber_id>/messages/",
+        ChamberMessagesSinceView.as_view(),
+        name="chamber-messages-since",
+    ),
+    path("runtime-stats/", RuntimeStatsView.as_view(), name="runtime-stats"),
 ]
@@ -2,15 +2,20 @@ from django.db.models import TextChoices
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db.transaction import atomic
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
 from rest_framework.exceptions import ValidationError
 import jwt
+from user.authentication import principal_cache
 from uuid import UUID
-from .models import Chamber
-from time import time
+from .frames import build_frame
+from .workers import media_pool
+from .membership import chamber_index
+from .writer import message_writer
+from time import time, time_ns
 from random import randint
-from base64 import b64decode
+from threading import Lock
 import json
+import os
 from asgiref.sync import sync_to_async
 
 
@@ -24,6 +29,58 @@ class MessageType(TextChoices):
     VIDEO = "VID", "Video"
 
 
+MEDIA_CONTENT_TYPES = {
+    "image": "image/png",
+    "audio": "audio/wav",
+    "video": "video/mp4",
+}
+
+
+class TimeOrderedUUID:
+    """
+    Generates time-ordered UUIDs (version 7, RFC 9562): a 48-bit Unix timestamp in
+    milliseconds, a 12-bit counter and 62 random bits.
+    Consecutive ids sort after each other, so inserts append to the end of the
+    primary key index instead of landing on random pages, and an id alone orders
+    messages. The counter keeps ids from one process strictly increasing within a
+    millisecond and if the clock steps back; when it overflows, the timestamp is
+    borrowed from the next millisecond.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._last_ms = 0
+        self._counter = 0
+
+    def __call__(self) -> UUID:
+        milliseconds = time_ns() // 1_000_000
+        with self._lock:
+            if milliseconds > self._last_ms:
+                self._last_ms = milliseconds
+                self._counter = 0
+            elif self._counter < 0xFFF:
+                self._counter += 1
+            else:
+                self._last_ms += 1
+                self._counter = 0
+            milliseconds, counter = self._last_ms, self._counter
+        random_bits = int.from_bytes(os.urandom(8)) & 0x3FFF_FFFF_FFFF_FFFF
+        return UUID(
+            int=milliseconds << 80
+            | 0x7 << 76
+            | counter << 64
+            | 0b10 << 62
+            | random_bits
+        )
+
+
+time_ordered_uuid = TimeOrderedUUID()
+
+
+def uuid7() -> UUID:
+    return time_ordered_uuid()
+
+
 def validate_uuid(uuid_string):
     try:
         UUID(uuid_string)
@@ -35,13 +92,14 @@ class ChamberDetail:
     def __init__(self, chamber_id):
         self.chamber_id = chamber_id
 
-    @sync_to_async
-    def retrieve_chamber_obj(self):
-        return Chamber.objects.filter(id=self.chamber_id).first()
+    async def retrieve_chamber_obj(self):
+        """
+        Returns the chamber's cached metadata from the membership index.
+        """
+        return await chamber_index.aget(self.chamber_id)
 
-    @sync_to_async
-    def retrieve_chamber_name(self):
-        return Chamber.objects.filter(id=self.chamber_id).first().chambername
+    async def retrieve_chamber_name(self):
+        return (await chamber_index.aget(self.chamber_id)).chambername
 
 
 @sync_to_async
@@ -53,14 +111,19 @@ def confirm_authorization(headers):
         jwt_token = headers[b"authorization"].decode("utf-8").split(" ")[1]
     if jwt_token:
         payload = jwt.decode(jwt_token, settings.SECRET_KEY, algorithms=["HS256"])
-        user_id = payload.get("user_id")
-        return User.objects.filter(id=user_id).first()
+        key = payload.get("jti", jwt_token)
+        user = principal_cache.get(key)
+        if user is None:
+            user_id = payload.get("user_id")
+            user = User.objects.filter(id=user_id, is_active=True).first()
+            if user:
+                principal_cache.set(key, user, payload.get("exp"))
+        return user
 
 
-@sync_to_async
-def check_user_in_chamber(user_id, chamber_id):
-    chamber = Chamber.objects.prefetch_related("users").filter(id=chamber_id).first()
-    return chamber.users.filter(id=user_id).exists()
+async def check_user_in_chamber(user_id, chamber_id):
+    chamber = await chamber_index.aget(chamber_id)
+    return chamber is not None and chamber.has_member(user_id)
 
 
 @sync_to_async
@@ -68,45 +131,31 @@ def retrieve_user_name(user_id):
     return User.objects.filter(id=user_id).first().username
 
 
-@sync_to_async
-def set_user_status(user, status="online"):
-    if status == "online":
-        user.is_online = True
-    elif status == "offline":
-        user.is_online = False
-
-    user.save()
-
-
-@sync_to_async
-def create_new_message(content, user, chamber):
+async def create_new_message(content, user, chamber_id):
     from .models import Message
 
-    new_message = Message.objects.create(
-        text_content=content, sender=user, chamber=chamber
-    )
-    return new_message.id, new_message.created
+    new_message = Message(text_content=content, sender=user, chamber_id=chamber_id)
+    return await message_writer.write(new_message)
 
 
 @sync_to_async
-def get_replied_message(message_id, chamber):
+def get_replied_message(message_id, chamber_id):
     """
     Retrieves the message that was replied to.
     """
     from .models import Message
     from .serializers import MessageSerializer
 
-    message = Message.objects.filter(id=message_id, chamber=chamber).first()
+    message = Message.objects.filter(id=message_id, chamber_id=chamber_id).first()
     return MessageSerializer(message).data
 
 
-@sync_to_async
-def create_new_reply(
+async def create_new_reply(
     user,
     previous_sender,
     previous_content,
     previous_message_id,
-    chamber,
+    chamber_id,
     content=None,
     media_type="text",
 ):
@@ -116,12 +165,12 @@ def create_new_reply(
     from .models import Message
 
     validate_uuid(previous_message_id)
-    new_reply = Message.objects.create(
+    new_reply = Message(
         sender=user,
         previous_sender=previous_sender,
         previous_message_content=previous_content,
         previous_message_id=previous_message_id,
-        chamber=chamber,
+        chamber_id=chamber_id,
         is_reply=True,
     )
     if media_type == "text":
@@ -134,8 +183,7 @@ def create_new_reply(
     elif media_type == "video":
         new_reply.message_type = Message.MessageType.VIDEO
 
-    new_reply.save()
-    return new_reply.id, new_reply.created
+    return await message_writer.write(new_reply)
 
 
 @sync_to_async
@@ -151,11 +199,10 @@ def generate_random_filename(media_type):
     return f"media_{timestamp}_{random_num}.{extension}"
 
 
-@sync_to_async
-def create_new_media_message(media_type, user, chamber):
+async def create_new_media_message(media_type, user, chamber_id):
     from .models import Message
 
-    new_message = Message.objects.create(sender=user, chamber=chamber)
+    new_message = Message(sender=user, chamber_id=chamber_id)
     if media_type == "image":
         new_message.message_type = Message.MessageType.IMAGE
     elif media_type == "audio":
@@ -163,40 +210,141 @@ def create_new_media_message(media_type, user, chamber):
     elif media_type == "video":
         new_message.message_type = Message.MessageType.VIDEO
 
-    new_message.save(update_fields=["message_type"])
-    return new_message.id, new_message.created
+    return await message_writer.write(new_message)
 
 
-@sync_to_async
-def update_media_message(media_id, content, filename, media_type):
+def attach_media_file(media_id, file_data, media_type):
     """
-    Saves the decoded audio data to temporary storage, and uploads from there to cloudinary.
-    The audio object is then updated with the cloud details and temporary file is removed at the end.
+    Writes the media file once to storage through the message's media field.
+    Returns the reference (url, size, content type) that is broadcast in place of the payload.
     """
     from .models import Message
 
-    media_data = b64decode(content)
-    file_data = SimpleUploadedFile(
-        name=filename,
-        content=media_data,
-    )
+    content_type = MEDIA_CONTENT_TYPES[media_type]
+    size = file_data.size
     media_message = Message.objects.filter(id=media_id).first()
     with atomic():
         if media_type == "image":
-            file_data.content_type = "image/png"
             media_message.message_type = Message.MessageType.IMAGE
             media_message.image_content = file_data
+            media_field = media_message.image_content
         elif media_type == "audio":
-            file_data.content_type = "audio/wav"
             media_message.message_type = Message.MessageType.AUDIO
             media_message.audio_content = file_data
+            media_field = media_message.audio_content
         elif media_type == "video":
-            file_data.content_type = "video/mp4"
             media_message.message_type = Message.MessageType.VIDEO
             media_message.video_content = file_data
+            media_field = media_message.video_content
 
+        media_message.media_size = size
         media_message.save()
 
+    return {
+        "url": media_field.url,
+        "size": size,
+        "content_type": content_type,
+    }
+
+
+def store_media_data(media_id, media_data, filename, media_type):
+    file_data = ContentFile(media_data, name=filename)
+    return attach_media_file(media_id, file_data, media_type)
+
+
+def store_uploaded_media(media_id, upload, filename):
+    """
+    Moves a completed chunked upload into storage without reading it into memory.
+    """
+    with upload.open(filename) as file_data:
+        return attach_media_file(media_id, file_data, upload.media_type)
+
+
+async def save_media_message(media_id, media_data, filename, media_type):
+    return await media_pool.run(
+        store_media_data, media_id, media_data, filename, media_type
+    )
+
+
+async def save_uploaded_media_message(media_id, upload, filename):
+    return await media_pool.run(store_uploaded_media, media_id, upload, filename)
+
+
+def build_message_event(message):
+    """
+    Builds the chamber event broadcast for a stored message, for replaying missed
+    messages from the database.
+    """
+    from .models import Message
+    from .events import chamber_event
+
+    media_type = {
+        Message.MessageType.IMAGE: "image",
+        Message.MessageType.AUDIO: "audio",
+        Message.MessageType.VIDEO: "video",
+    }.get(message.message_type)
+    content = {"id": str(message.id)}
+    if media_type is None:
+        content["content"] = message.text_content
+    else:
+        media_field = getattr(message, f"{media_type}_content")
+        if media_field:
+            content["url"] = media_field.url
+            size = message.media_size
+            if size is None:
+                # Stored before sizes were recorded; the file may also be gone
+                try:
+                    size = media_field.size
+                except OSError:
+                    size = None
+            if size is not None:
+                content["size"] = size
+            content.update(
+                content_type=MEDIA_CONTENT_TYPES[media_type],
+                filename=os.path.basename(media_field.name),
+            )
+    if message.is_reply:
+        event_type = "chat.reply"
+        content.update(
+            reply_format="text" if media_type is None else "media",
+            previous_sender=message.previous_sender,
+            previous_message_content=message.previous_message_content,
+            previous_message_id=(
+                str(message.previous_message_id)
+                if message.previous_message_id
+                else None
+            ),
+        )
+    else:
+        event_type = "chat.message" if media_type is None else "chat.media"
+
+    return chamber_event(
+        event_type,
+        message.chamber_id,
+        **content,
+        sender=message.sender.username,
+        timestamp=message.created,
+        seq=message.seq,
+    )
+
+
+@sync_to_async
+def get_missed_events(chamber_id, after_seq, limit):
+    """
+    Returns up to 'limit' events for the chamber's messages after 'after_seq',
+    and whether there are more.
+    """
+    from .models import Message
+
+    messages = list(
+        Message.objects.filter(chamber_id=chamber_id, seq__gt=after_seq)
+        .select_related("sender")
+        .order_by("seq")[: limit + 1]
+    )
+    return [build_message_event(message) for message in messages[:limit]], (
+        len(messages) > limit
+    )
+
 
 async def send_text_message(communicator):
     message_data = {
@@ -275,7 +423,10 @@ async def send_reply_audio_message(communicator, previous_message_id):
     await communicator.send_to(bytes_data=combined_data)
 
 
-@sync_to_async
-def get_active_users_count(chamber_id):
-    chamber = Chamber.objects.prefetch_related("users").filter(id=chamber_id).first()
-    return chamber.users.filter(is_online=True).count()
+async def send_upload_chunk(communicator, upload_id, chunk, chunk_data):
+    message_data = {
+        "message_type": "upload_chunk",
+        "upload_id": upload_id,
+        "chunk": chunk,
+    }
+    await communicator.send_to(bytes_data=build_frame(message_data, chunk_data))
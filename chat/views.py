@@ -1,24 +1,151 @@
 from django.shortcuts import render
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.exceptions import NotFound
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from user.authentication import CachedJWTAuthentication, principal_cache
+from user.utils import make_etag
 from rest_framework.pagination import CursorPagination
-from .serializers import ChamberSerializer, Chamber, MessageSerializer
+from rest_framework.utils.urls import remove_query_param
+from django.db.models import Q, Count, Max, OuterRef, Subquery
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from uuid import UUID
+from channels.layers import get_channel_layer
+from .serializers import (
+    ChamberSerializer,
+    Chamber,
+    MessageHistorySerializer,
+    Message,
+)
+from .workers import media_pool
+from .membership import chamber_index
+from .presence import presence, chamber_activity
+from .typing import typing_aggregator
+from .writer import message_writer
+from .outbound import outbound_counters
+from .replay import recent_events
+from .admission import admission
+from .invalidation import cache_invalidations
+from .utils import validate_uuid
 
 
 class ChamberMessagePagination(CursorPagination):
     page_size = 10
-    ordering = "-created"
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    # Messages from before ids were time-ordered have random uuid4 ids, so pages are
+    # ordered by creation time, with the id to break ties; both are read from the
+    # chamber history index
+    ordering = ("-created", "-id")
+
+    def paginate_around(self, queryset, request, message_id):
+        """
+        Returns the message 'message_id' with up to a page of messages on either
+        side of it, newest first, or None if 'queryset' does not contain it.
+        Both sides are read in one query, each as a range of the chamber history
+        index; the next and previous links then continue past the oldest and the
+        newest message returned.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = remove_query_param(request.build_absolute_uri(), "around")
+        self.ordering = self.get_ordering(request, queryset, None)
+        self.cursor = None
+
+        message_id = UUID(message_id)
+        created = Subquery(queryset.filter(id=message_id).values("created")[:1])
+        # The message itself, a page of older messages and one more to detect the
+        # next page; then a page of newer messages, plus one
+        older = queryset.exclude(created_after(created, message_id)).order_by(
+            "-created", "-id"
+        )
+        newer = queryset.filter(created_after(created, message_id)).order_by(
+            "created", "id"
+        )
+        rows = list(
+            queryset.filter(
+                Q(id__in=older.values("id")[: self.page_size + 2])
+                | Q(id__in=newer.values("id")[: self.page_size + 1])
+            ).order_by(*self.ordering)
+        )
+        index = next(
+            (index for index, row in enumerate(rows) if row["id"] == message_id), None
+        )
+        if index is None:
+            return None
+        newer, older = rows[:index], rows[index:]
+
+        self.has_next = len(older) > self.page_size + 1
+        self.has_previous = len(newer) > self.page_size
+        if self.has_next:
+            self.next_position = self._get_position_from_instance(
+                older[-1], self.ordering
+            )
+        if self.has_previous:
+            self.previous_position = self._get_position_from_instance(
+                newer[0], self.ordering
+            )
+        self.page = newer[-self.page_size :] + older[: self.page_size + 1]
+        return self.page
+
+
+def created_after(created, message_id):
+    """
+    Messages after the one created at 'created' with id 'message_id', in
+    history order.
+    """
+    return Q(created__gt=created) | Q(created=created, id__gt=message_id)
+
+
+def chamber_list_etag(request):
+    # Chambers are bumped when their members change (see 'chat.signals'), and the
+    # count catches deletions
+    chambers = Chamber.objects.aggregate(count=Count("id"), updated=Max("updated"))
+    return make_etag(chambers["count"], chambers["updated"])
+
+
+def chamber_history_etag(request, chamber_id):
+    # Only the JSON history, without sender details (avatars change elsewhere).
+    # The chamber's and its latest message's 'updated', each an index lookup, and the
+    # number of messages, since deleting one leaves both unchanged; the query string
+    # selects the page.
+    if request.headers.get("Accept") != "application/json":
+        return None
+    if request.query_params.get("include_sender") == "true":
+        return None
+    chamber_id = chamber_index.normalize(chamber_id)
+    if chamber_id is None:
+        return None
+    latest_message = (
+        Message.objects.filter(chamber_id=OuterRef("id"))
+        .order_by("-updated")
+        .values("updated")[:1]
+    )
+    message_count = (
+        Message.objects.filter(chamber_id=OuterRef("id"))
+        .order_by()
+        .values("chamber_id")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    updated = (
+        Chamber.objects.filter(id=chamber_id)
+        .values_list("updated", Subquery(latest_message), Subquery(message_count))
+        .first()
+    )
+    if updated is None:
+        return None
+    return make_etag(*updated, request.META.get("QUERY_STRING", ""))
 
 
 class ChamberListView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     serializer_class = ChamberSerializer
 
+    @method_decorator(condition(etag_func=chamber_list_etag))
     def get(self, request):
         chambers = Chamber.objects.all().order_by("-created")
         chambers_data = self.serializer_class(chambers, many=True).data
@@ -36,22 +163,36 @@ class ChamberListView(APIView):
 
 class ChamberHTMLView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
-    serializer_class = MessageSerializer
+    authentication_classes = [CachedJWTAuthentication]
+    serializer_class = MessageHistorySerializer
     pagination_class = ChamberMessagePagination
 
+    @method_decorator(condition(etag_func=chamber_history_etag))
     def get(self, request, chamber_id):
-        chamber = (
-            Chamber.objects.prefetch_related("messages").filter(id=chamber_id).first()
-        )
+        # Chamber metadata comes from the membership index, and only the requested
+        # page of messages is read from the database
+        chamber = chamber_index.get(chamber_id)
         if chamber:
-            messages = chamber.messages.order_by("-created")
+            messages = Message.objects.filter(chamber_id=chamber.id)
 
-            paginator = self.pagination_class()
-            paginated_messages = paginator.paginate_queryset(
-                messages, request, view=self
+            serializer = self.serializer_class(
+                include_sender=request.query_params.get("include_sender") == "true"
             )
-            messages_list = self.serializer_class(paginated_messages, many=True).data
+            paginator = self.pagination_class()
+            message_id = request.query_params.get("around")
+            if message_id is not None:
+                # Jump to a message (e.g. the original of a reply) in its context
+                validate_uuid(message_id)
+                paginated_messages = paginator.paginate_around(
+                    serializer.values(messages), request, message_id
+                )
+                if paginated_messages is None:
+                    raise NotFound("Message with this id does not exist.")
+            else:
+                paginated_messages = paginator.paginate_queryset(
+                    serializer.values(messages), request, view=self
+                )
+            messages_list = serializer.represent(paginated_messages)
 
             context = {
                 "chamber_id": chamber.id,
@@ -59,6 +200,7 @@ class ChamberHTMLView(APIView):
                 "messages": messages_list[::-1],
                 "username": request.user.username,
                 "previous_messages": paginator.get_next_link(),  # loads previous messages
+                "next_messages": paginator.get_previous_link(),  # loads newer messages
             }
 
             if request.headers.get("Accept") == "application/json":
@@ -66,9 +208,92 @@ class ChamberHTMLView(APIView):
                     {
                         "results": messages_list,
                         "previous_messages": context["previous_messages"],
+                        "next_messages": context["next_messages"],
                     }
                 )
 
             return render(request, "chamber.html", context)
         else:
             raise NotFound("Chamber with this id does not exist.")
+
+
+class ChamberMessagesSinceView(APIView):
+    """
+    Returns the chamber's messages with a sequence number above 'after_seq', oldest
+    first, so a reconnecting client can fetch exactly the messages it missed.
+    With 'after_id' instead, returns the messages after that message id.
+    """
+
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedJWTAuthentication]
+    serializer_class = MessageHistorySerializer
+    max_messages = 500
+
+    def get(self, request, chamber_id):
+        chamber = chamber_index.get(chamber_id)
+        if chamber is None:
+            raise NotFound("Chamber with this id does not exist.")
+        if not chamber.has_member(request.user.id):
+            raise PermissionDenied("You are not a member of this chamber.")
+        after_id = request.query_params.get("after_id")
+        if after_id is not None:
+            validate_uuid(after_id)
+            created = (
+                Message.objects.filter(chamber_id=chamber.id, id=after_id)
+                .values_list("created", flat=True)
+                .first()
+            )
+            if created is None:
+                raise NotFound("Message with this id does not exist.")
+            messages = Message.objects.filter(
+                created_after(created, after_id), chamber_id=chamber.id
+            ).order_by("created", "id")
+        else:
+            try:
+                after_seq = int(request.query_params.get("after_seq", 0))
+            except ValueError:
+                raise ValidationError({"after_seq": "A valid integer is required."})
+            messages = Message.objects.filter(
+                chamber_id=chamber.id, seq__gt=after_seq
+            ).order_by("seq")
+
+        serializer = self.serializer_class(
+            include_sender=request.query_params.get("include_sender") == "true"
+        )
+        messages = list(serializer.values(messages)[: self.max_messages + 1])
+        has_more = len(messages) > self.max_messages
+        messages_list = serializer.represent(messages[: self.max_messages])
+        return Response(
+            {"results": messages_list, "has_more": has_more},
+            status=status.HTTP_200_OK,
+        )
+
+
+class RuntimeStatsView(APIView):
+    """
+    Per-worker runtime counters, for sizing pools and queues.
+    """
+
+    permission_classes = [IsAdminUser]
+    authentication_classes = [CachedJWTAuthentication]
+
+    def get(self, request):
+        channel_layer = get_channel_layer()
+        return Response(
+            {
+                "media_pool": media_pool.stats(),
+                "principal_cache": principal_cache.stats(),
+                "chamber_index": chamber_index.stats(),
+                "presence": presence.stats(),
+                "chamber_activity": chamber_activity.stats(),
+                "typing": typing_aggregator.stats(),
+                "message_writer": message_writer.stats(),
+                "outbound": outbound_counters.stats(),
+                "replay": recent_events.stats(),
+                "admission": admission.stats(),
+                "cache_invalidations": cache_invalidations.stats(),
+                # Only the broker layer keeps counters
+                "channel_layer": getattr(channel_layer, "stats", dict)(),
+            },
+            status=status.HTTP_200_OK,
+        )
@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db import close_old_connections
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Lock
+from time import monotonic
+import asyncio
+
+
+class MediaWorkerPool:
+    """
+    Dedicated thread pool for media persistence (file writes and the related row update).
+    Jobs run outside the thread that serializes 'sync_to_async' ORM calls, so a burst
+    of uploads cannot stall text message delivery for other chambers.
+    At most WORKERS + QUEUE_SIZE jobs are accepted at a time; further submitters wait
+    for a free slot, which applies backpressure to the uploading connection only.
+    """
+
+    def __init__(self, latency_window=256):
+        self._executor = None
+        self._slots = None
+        self._loop = None
+        self._lock = Lock()
+        self.waiting = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._queue_waits = deque(maxlen=latency_window)
+        self._run_times = deque(maxlen=latency_window)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=settings.MEDIA_WORKER_POOL["WORKERS"],
+                thread_name_prefix="whisper-media",
+            )
+        return self._executor
+
+    def _get_slots(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            pool_settings = settings.MEDIA_WORKER_POOL
+            self._loop = loop
+            self._slots = asyncio.Semaphore(
+                pool_settings["WORKERS"] + pool_settings["QUEUE_SIZE"]
+            )
+        return self._slots
+
+    def _call(self, submitted, function, args):
+        started = monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self._queue_waits.append(started - submitted)
+
+        close_old_connections()
+        try:
+            result = function(*args)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        else:
+            with self._lock:
+                self.completed += 1
+            return result
+        finally:
+            close_old_connections()
+            with self._lock:
+                self.running -= 1
+                self._run_times.append(monotonic() - started)
+
+    async def run(self, function, *args):
+        submitted = monotonic()
+        slots = self._get_slots()
+        self.waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            with self._lock:
+                self.queued += 1
+            return await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), self._call, submitted, function, args
+            )
+        finally:
+            slots.release()
+
+    def stats(self):
+        def summarize(samples):
+            if not samples:
+                return {"avg": None, "p95": None, "max": None}
+            ordered = sorted(samples)
+            return {
+                "avg": sum(ordered) / len(ordered),
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+
+        with self._lock:
+            return {
+                "workers": settings.MEDIA_WORKER_POOL["WORKERS"],
+                "queue_size": settings.MEDIA_WORKER_POOL["QUEUE_SIZE"],
+                "queue_depth": self.queued + self.waiting,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "queue_wait_seconds": summarize(self._queue_waits),
+                "run_time_seconds": summarize(self._run_times),
+            }
+
+
+media_pool = MediaWorkerPool()
@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.db.transaction import atomic
+from asgiref.sync import sync_to_async
+import asyncio
+
+
+class MessageWriter:
+    """
+    Single writer for chat messages (group commit).
+    Messages queued while the previous batch was committing (plus an optional
+    BATCH_WINDOW wait) are inserted with one 'bulk_create' inside one transaction
+    (at most MAX_BATCH per transaction), instead of one or two write transactions
+    per message. Each caller awaits its own message and resumes with
+    the assigned id, timestamp and sequence number as soon as the batch commits.
+    If a batch fails, its messages are retried one by one so a single bad row only
+    fails its own caller.
+    """
+
+    def __init__(self):
+        self._pending = []  # (message, future) waiting for the next batch
+        self._task = None
+        self._loop = None
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.largest_batch = 0
+
+    async def write(self, message):
+        """
+        Queues an unsaved 'Message' and returns its (id, created, seq) once committed.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Futures of another event loop can never be resolved from this one
+            self._loop = loop
+            self._pending = []
+            self._task = None
+
+        future = loop.create_future()
+        self._pending.append((message, future))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run_writer())
+        return await future
+
+    async def _run_writer(self):
+        writer_settings = settings.MESSAGE_WRITER
+        while self._pending:
+            await asyncio.sleep(writer_settings["BATCH_WINDOW"])
+            batch = self._pending[: writer_settings["MAX_BATCH"]]
+            del self._pending[: len(batch)]
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            await sync_to_async(self._insert)(messages)
+        except Exception:
+            results = await sync_to_async(self._insert_each)(messages)
+        else:
+            results = [None] * len(batch)
+
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for (message, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                self.written += 1
+                future.set_result((message.id, message.created, message.seq))
+            else:
+                self.failed += 1
+                future.set_exception(error)
+
+    def _insert(self, messages):
+        from .models import Message
+
+        with atomic():
+            self._assign_sequences(messages)
+            Message.objects.bulk_create(messages)
+
+    def _insert_each(self, messages):
+        from .models import Message
+
+        results = []
+        for message in messages:
+            try:
+                with atomic():
+                    self._assign_sequences([message])
+                    Message.objects.bulk_create([message])
+            except Exception as error:
+                results.append(error)
+            else:
+                results.append(None)
+        return results
+
+    @staticmethod
+    def _assign_sequences(messages):
+        from .models import allocate_sequence
+
+        by_chamber = {}
+        for message in messages:
+            by_chamber.setdefault(message.chamber_id, []).append(message)
+        for chamber_id, chamber_messages in by_chamber.items():
+            first = allocate_sequence(chamber_id, len(chamber_messages))
+            if first is None:
+                continue  # The insert fails on the chamber foreign key
+            for offset, message in enumerate(chamber_messages):
+                message.seq = first + offset
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "largest_batch": self.largest_batch,
+        }
+
+
+message_writer = MessageWriter()
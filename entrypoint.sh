@@ -35,6 +35,12 @@ elif [ "$DEBUG_VALUE_LOWER" = "true" ]; then
     generate_ssl_files
 fi
 
+# Workers on the broker channel layer share channels through a local broker
+if [ "$CHANNEL_LAYER_BACKEND" = "broker" ]; then
+    echo "starting channel broker..."
+    python manage.py runbroker &
+fi
+
 # Start appropriate server
 case $SERVER_TYPE in
     "daphne")
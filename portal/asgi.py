@@ -19,6 +19,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "portal.settings")
 
 django.setup()
 
+from django.conf import settings
 from chat.routing import websocket_urlpatterns
 
 django_asgi_app = get_asgi_application()
@@ -34,4 +35,10 @@ application = ProtocolTypeRouter(
             )
         )
     }
-)
\ No newline at end of file
+)
+
+# Front-door mode: chamber websockets go to the worker owning the chamber
+if settings.CHAMBER_AFFINITY["WORKERS"]:
+    from chat.affinity import ChamberAffinityRouter
+
+    application = ChamberAffinityRouter(application)
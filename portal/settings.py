@@ -159,7 +159,151 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
 # Channel layer settings
-CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+CHANNEL_LAYER_CAPACITY = int(os.getenv("CHANNEL_LAYER_CAPACITY", 500))  # Per channel
+CHANNEL_LAYER_EXPIRY = int(os.getenv("CHANNEL_LAYER_EXPIRY", 60))  # Seconds
+# "memory" keeps channels inside one process; "broker" shares them between processes
+# and machines through the broker started with 'python manage.py runbroker'
+CHANNEL_LAYER_BACKEND = os.getenv("CHANNEL_LAYER_BACKEND", "memory")
+CHANNEL_BROKER_ADDRESS = os.getenv(
+    "CHANNEL_BROKER_ADDRESS", "unix:///tmp/whisper-broker.sock"
+)  # Or tcp://host:port
+# Presented by workers to the broker; derived from SECRET_KEY when unset
+CHANNEL_BROKER_SECRET = os.getenv("CHANNEL_BROKER_SECRET")
+if CHANNEL_LAYER_BACKEND == "broker":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.BrokerChannelLayer",
+            "CONFIG": {
+                "address": CHANNEL_BROKER_ADDRESS,
+                "capacity": CHANNEL_LAYER_CAPACITY,
+                "expiry": CHANNEL_LAYER_EXPIRY,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {
+                "capacity": CHANNEL_LAYER_CAPACITY,
+                "expiry": CHANNEL_LAYER_EXPIRY,
+            },
+        }
+    }
+
+# Front-door mode: chamber websockets are forwarded to the worker process owning the
+# chamber on a consistent hash ring (see 'chat.affinity'). Workers are started with
+# 'python manage.py runchamberworker --address <address>' and should share the broker
+# channel layer with the front doors
+CHAMBER_AFFINITY = {
+    "WORKERS": [
+        address for address in os.getenv("CHAMBER_WORKERS", "").split(",") if address
+    ],
+    "REPLICAS": 100,  # Ring points per worker
+    "HEALTH_INTERVAL": 2,  # Seconds between reconnection attempts to lost workers
+    # Sent to clients whose chamber moved to another worker, so they reconnect
+    "REBALANCE_CLOSE_CODE": 4009,
+    # Presented by front doors to workers; derived from SECRET_KEY when unset
+    "SECRET": os.getenv("CHAMBER_WORKER_SECRET"),
+}
+
+# Websocket admission control ('chat.admission'), per worker
+ADMISSION = {
+    "MAX_IN_FLIGHT": 32,  # Handshakes running at once
+    "MAX_QUEUED": 1000,  # Handshakes waiting for a slot
+    "QUEUE_TIMEOUT": 5,  # Seconds a handshake may wait for a slot
+    "MAX_CONNECTIONS": 10000,  # Open websockets
+    "MAX_USER_CONNECTIONS": 50,  # Open websockets per user
+    # Sent to rejected clients, with "retry-after=<RETRY_AFTER seconds>" as the reason
+    "RETRY_CLOSE_CODE": 4029,
+    "RETRY_AFTER": 5,
+}
+
+# Multiplexed per-user websocket ('ws/user/')
+USER_SOCKET = {
+    "MAX_CHAMBERS": 500,  # Chambers one connection may subscribe to
+}
+
+# Per-connection outbound queue settings
+OUTBOUND_QUEUE = {
+    "MAX_SIZE": 256,  # Frames queued for one connection
+    # Coalesced to the latest one, and dropped first when the queue is full
+    "EPHEMERAL_EVENTS": ["chat.typing", "chat.active"],
+    # Sent when a client falls too far behind and must reload its history
+    "RESYNC_CLOSE_CODE": 4008,
+    # Clients that opt in get frames queued within this window combined into one
+    "BATCH_WINDOW": 0.01,
+    "BATCH_MAX_EVENTS": 50,  # Largest number of events per combined frame
+}
+
+
+# Chamber membership index settings
+CHAMBER_MEMBERSHIP_INDEX = {
+    "MAX_CHAMBERS": 5000,  # Least recently used chambers are evicted beyond this
+    # Seconds; other processes' changes are broadcast (see 'chat.invalidation'),
+    # this bounds staleness should one be lost
+    "TTL": 300,
+}
+
+
+# Presence settings (seconds)
+PRESENCE = {
+    "FLUSH_INTERVAL": 1,  # How often batched presence changes are written
+    "OFFLINE_GRACE": 5,  # Reconnects within this window never write 'offline'
+    "LEASE_TTL": 90,  # Online leases are renewed every LEASE_TTL / 2
+    "ACTIVE_INTERVAL": 1,  # At most one 'chat.active' broadcast per chamber per interval
+    # Member snapshots from other processes expire unless refreshed within this window
+    "ACTIVE_TTL": 60,
+}
+
+MESSAGE_WRITER = {
+    # Extra wait before each batch. With 0, a batch commits as soon as the writer is
+    # free and holds every message queued during the previous commit
+    "BATCH_WINDOW": 0,
+    "MAX_BATCH": 500,  # Largest number of messages inserted per transaction
+}
+
+# Recent message events kept per chamber for replay on reconnect
+REPLAY = {
+    "MAX_EVENTS": 200,  # Per chamber
+    "MAX_BYTES": 256 * 1024,  # Per chamber
+    "MAX_TOTAL_BYTES": 64 * 1024 * 1024,  # All chambers; least recently active go first
+    "IDLE_TTL": 600,  # Buffers without new events for this long are evicted
+    "MAX_DATABASE_EVENTS": 500,  # Larger gaps are left to the 'messages since' API
+}
+
+WEBSOCKET_CODECS = {
+    # Module with 'dumps'/'loads' used for the JSON protocol, e.g. "orjson" if installed
+    "JSON_BACKEND": os.getenv("WEBSOCKET_JSON_BACKEND", "json"),
+    "MEMO_SIZE": 1024,  # Recent broadcasts whose per-codec encodings are kept
+}
+
+TYPING = {
+    "INTERVAL": 1,  # At most one merged 'chat.typing' broadcast per chamber per interval
+    "RATE": 2,  # Typing signals from one user within this window are dropped
+    "TTL": 6,  # Typists without a fresh signal for this long are expired
+}
+
+
+# Chunked media upload settings
+CHUNKED_UPLOADS = {
+    "CHUNK_SIZE": 512 * 1024,  # Largest accepted chunk, in bytes
+    "MAX_UPLOAD_SIZE": 200 * 1024 * 1024,
+    "MAX_USER_UPLOADS": 4,  # Uploads one user may have in progress at once
+    "MAX_USER_UPLOAD_BYTES": 400 * 1024 * 1024,  # Declared bytes across them
+    "EXPIRY": 60 * 60,  # Seconds an idle upload is kept for resumption
+    "SWEEP_INTERVAL": 60,  # How often expired uploads are removed
+    "TEMP_DIR": os.getenv("UPLOAD_TEMP_DIR"),  # Defaults to the system temp directory
+}
+
+
+# Media persistence worker pool settings
+MEDIA_WORKER_POOL = {
+    "WORKERS": int(os.getenv("MEDIA_WORKERS", 4)),
+    "QUEUE_SIZE": int(
+        os.getenv("MEDIA_QUEUE_SIZE", 16)
+    ),  # Jobs accepted beyond busy workers
+}
 
 
 # Storage settings
@@ -189,7 +333,7 @@ REST_FRAMEWORK = {
         "user": "100/min",
     },
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "user.authentication.CachedJWTAuthentication",
     ],
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
     "EXCEPTION_HANDLER": "portal.exception_handler.whisper_exception_handler",
@@ -213,6 +357,12 @@ SPECTACULAR_SETTINGS = {
     "REDOC_DIST": "SIDECAR",
 }
 
+# Authenticated principal cache (shared by websocket and REST authentication)
+AUTH_PRINCIPAL_CACHE = {
+    "MAX_ENTRIES": 10000,
+    "TTL": 60,  # Seconds; entries never outlive their token
+}
+
 
 # Mail settings
 CURRENT_HOST = os.getenv("CURRENT_HOST")
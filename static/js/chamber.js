@@ -27,32 +27,41 @@ function connectWebSocket(){
             document.getElementById("active-status").textContent = activeUserCount;
         }
         else if (data.type === "chat.typing") {
-
-            if (data.content && data.username === username) {
-                document.getElementById("active-status").textContent = data.content;
-            }
-            else{
-                document.getElementById("active-status").textContent = activeUserCount; 
-            }
+            // Other members typing; the server never includes this user
+            document.getElementById("active-status").textContent = data.content || activeUserCount;
         }
     }
 
     chatSocket.onclose = function(e){
+        if (e.code === 4008 || e.code === 4009) {
+            // Fell too far behind to catch up from the socket, or the chamber moved
+            // to another worker; reload the chamber
+            window.location.reload();
+            return;
+        }
+        if (e.code === 4029) {
+            // The server is busy; retry after the delay it gave, spread out so
+            // clients do not all come back at once
+            const retryAfter = parseInt((e.reason || "").split("=")[1]) || 5;
+            setTimeout(() => window.location.reload(), retryAfter * 1000 * (1 + Math.random()));
+            return;
+        }
         console.error("Chat socket closed unexpectedly.");
     };
 
     let inputId = document.getElementById("message-input");
-    let isMessageSent = false
+    let lastTypingSent = 0;
     inputId.focus();
     inputId.addEventListener("input", function(){
-        if (!isMessageSent) {
+        // Refresh the typing signal every few seconds so the server does not expire it
+        if (Date.now() - lastTypingSent > 3000) {
             chatSocket.send(JSON.stringify({"message": "typing", "message_type": "typing"}));
-            isMessageSent = true;
+            lastTypingSent = Date.now();
         }
     });
     inputId.addEventListener("blur", function(){
         chatSocket.send(JSON.stringify({"message": "not_typing", "message_type": "typing"}));
-        isMessageSent = false;
+        lastTypingSent = 0;
     });
 
 };
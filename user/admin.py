@@ -14,6 +14,7 @@ class UserAdmin(ModelAdmin):
         "is_staff",
         "is_active",
         "is_online",
+        "online_until",
         "created",
         "updated",
         "last_login",
@@ -0,0 +1,106 @@
+from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import copy
+
+
+class PrincipalCache:
+    """
+    Bounded, TTL-based cache of authenticated users keyed by token id (jti).
+    Shared by the websocket handshake and the DRF authentication class, so repeated
+    connects with the same token skip the user lookup.
+    Entries never outlive their token, are evicted least-recently-used once MAX_ENTRIES
+    is reached, and are invalidated when the user row changes or the user logs out.
+    Entries are only kept while 'coherent()' holds, i.e. while changes made by other
+    processes reach the cache ('chat.invalidation' sets it when it broadcasts them).
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()  # token key -> (expires, user)
+        self._keys_by_user = {}  # user id -> token keys
+        self._lock = Lock()
+        self.coherent = lambda: True
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, user = entry
+            if expires <= time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Each caller gets its own instance, so request-level changes are not shared
+        return copy.copy(user)
+
+    def set(self, key, user, token_expiry=None):
+        if not self.coherent():
+            return
+        cache_settings = settings.AUTH_PRINCIPAL_CACHE
+        expires = time() + cache_settings["TTL"]
+        if token_expiry is not None:
+            expires = min(expires, token_expiry)
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires, copy.copy(user))
+            self._keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > cache_settings["MAX_ENTRIES"]:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            user_id = entry[1].pk
+            keys = self._keys_by_user.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_user[user_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+principal_cache = PrincipalCache()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    'JWTAuthentication' that resolves the token's user through the shared principal cache.
+    """
+
+    def get_user(self, validated_token):
+        key = validated_token.get(api_settings.JTI_CLAIM)
+        if key is None:
+            return super().get_user(validated_token)
+
+        user = principal_cache.get(key)
+        if user is None:
+            user = super().get_user(validated_token)
+            principal_cache.set(key, user, validated_token.get("exp"))
+        return user
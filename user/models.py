@@ -72,6 +72,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_superuser = BooleanField(default=False)
     is_staff = BooleanField(default=False)
     is_online = BooleanField(default=False, db_index=True)
+    # Presence lease, renewed while the user is connected
+    online_until = DateTimeField(blank=True, null=True, db_index=True)
     created = DateTimeField(auto_now_add=True, db_index=True)
     updated = DateTimeField(auto_now=True)
     last_login = DateTimeField(auto_now=True)
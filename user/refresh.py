@@ -1,7 +1,9 @@
 from django.conf import settings
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from django.contrib.sessions.exceptions import SessionInterrupted
+from .authentication import principal_cache
 
 
 class SessionRefreshToken:
@@ -28,6 +30,7 @@ class SessionRefreshToken:
     def remove_token(self):
         """
         Method for blacklisting refresh token to be removed from session.
+        The user's cached principals are dropped along with it.
         """
         if self.refresh.get("refresh"):
             existing_refresh_token = self.check_token()
@@ -39,6 +42,9 @@ class SessionRefreshToken:
                             validated_refresh_token.blacklist()
                         except AttributeError:
                             pass
+                        principal_cache.invalidate_user(
+                            validated_refresh_token.get(api_settings.USER_ID_CLAIM)
+                        )
 
                     validated_refresh_token.set_jti()
                     validated_refresh_token.set_exp()
@@ -0,0 +1,12 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+from .models import User
+from .authentication import principal_cache
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_principal(sender, instance, **kwargs):
+    """
+    Triggered when a user row changes, so cached principals are never served stale.
+    """
+    principal_cache.invalidate_user(instance.pk)
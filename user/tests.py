@@ -340,6 +340,30 @@ class UserDetailViewTestCase(APITestCase):
         for string in ["id", "email", "username"]:
             self.assertIn(string, response.data)
 
+    def test_retrieve_user_detail_success_cached_principal(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        self.client.get(self.url, headers=headers)
+        # The authenticated user is served from the principal cache
+        with self.assertNumQueries(1):
+            self.client.get(self.url, headers=headers)
+
+        # Changes to the user row invalidate the cached principal
+        self.user.save()
+        with self.assertNumQueries(2):
+            self.client.get(self.url, headers=headers)
+
+    def test_retrieve_user_detail_not_modified_success(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        etag = self.client.get(self.url, headers=headers)["ETag"]
+        response = self.client.get(self.url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Presence changes do not touch 'updated', but are part of the validator
+        User.objects.filter(id=self.user.id).update(is_online=True)
+        response = self.client.get(self.url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data["is_online"])
+
     def test_retrieve_user_detail_failure_nonexistent(self):
         response = self.client.get(
             reverse(
@@ -439,6 +463,23 @@ class UserProfileDetailViewTestCase(APITransactionTestCase):
         for string in ["id", "username", "gender", "user"]:
             self.assertIn(string, response.data)
 
+    def test_retrieve_user_profile_detail_not_modified_success(self):
+        profile = UserProfile.objects.create(user=self.user)
+        headers = {"Authorization": f"Bearer {self.token}"}
+        response = self.client.get(self.url, headers=headers)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+        for validator in [
+            {"If-None-Match": etag},
+            {"If-Modified-Since": last_modified},
+        ]:
+            response = self.client.get(self.url, headers={**headers, **validator})
+            self.assertEqual(response.status_code, 304)
+
+        profile.bio = "Hello"
+        profile.save()
+        response = self.client.get(self.url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(response.data["bio"], "Hello")
+
     def test_retrieve_user_profile_detail_failure_nonexistent(self):
         response = self.client.get(
             reverse(
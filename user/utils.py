@@ -8,6 +8,17 @@ from django.utils import timezone
 from pyotp import TOTP, random_base32
 import smtplib
 from .choices import OTPTypeChoices
+from hashlib import md5
+
+
+def make_etag(*parts) -> str:
+    """
+    Returns a weak ETag for a representation determined by 'parts' (e.g. the
+    modification times it was built from), so conditional GETs can be answered
+    without building the representation.
+    """
+    digest = md5("|".join(str(part) for part in parts).encode("utf-8"))
+    return f'W/"{digest.hexdigest()}"'
 
 
 class GenerateUUID:
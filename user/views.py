@@ -1,10 +1,12 @@
 from django.db.transaction import atomic
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from .authentication import CachedJWTAuthentication
 from rest_framework.parsers import MultiPartParser, JSONParser
 from rest_framework.exceptions import NotFound
 from .serializers import (
@@ -18,6 +20,7 @@ from .serializers import (
 )
 from .refresh import SessionRefreshToken
 from .models import User, UserProfile
+from .utils import make_etag
 from portal.permissions import isCurrentUserOrReadOnly
 
 
@@ -100,7 +103,7 @@ class RefreshView(APIView):
 
 class LogoutView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
 
     def post(self, request):
         refresh_session_instance = SessionRefreshToken(request)
@@ -110,7 +113,7 @@ class LogoutView(APIView):
 
 class UserListView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     serializer_class = UserSerializer
 
     def get(self, request):
@@ -119,13 +122,47 @@ class UserListView(APIView):
         return Response(users_data, status=status.HTTP_200_OK)
 
 
+def requested_user(request, user_id):
+    # Read once per request, by the validators and then the view
+    if not hasattr(request, "requested_user"):
+        request.requested_user = (
+            User.objects.select_related("profile").filter(id=user_id).first()
+        )
+    return request.requested_user
+
+
+def user_detail_etag(request, user_id):
+    # 'is_online' and 'is_email_verified' change without touching 'updated'
+    # (see 'chat.presence')
+    user = requested_user(request, user_id)
+    if user is None:
+        return None
+    return make_etag(user.updated, user.is_online, user.is_email_verified)
+
+
+def user_profile_last_modified(request, user_id):
+    # The profile's 'updated' and its user's (for the username)
+    user = requested_user(request, user_id)
+    if user is None or not hasattr(user, "profile"):
+        return None
+    return max(user.updated, user.profile.updated)
+
+
+def user_profile_etag(request, user_id):
+    user = requested_user(request, user_id)
+    if user is None or not hasattr(user, "profile"):
+        return None
+    return make_etag(user.updated, user.profile.updated)
+
+
 class UserDetailView(APIView):
     permission_classes = [IsAuthenticated, isCurrentUserOrReadOnly]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     serializer_class = UserSerializer
 
+    @method_decorator(condition(etag_func=user_detail_etag))
     def get(self, request, user_id):
-        user = User.objects.filter(id=user_id).first()
+        user = requested_user(request, user_id)
         if user:
             user_data = self.serializer_class(user).data
             return Response(user_data, status=status.HTTP_200_OK)
@@ -147,7 +184,7 @@ class UserDetailView(APIView):
 
 class UserProfileListView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     serializer_class = UserProfileSerializer
 
     def get(self, request):
@@ -158,12 +195,17 @@ class UserProfileListView(APIView):
 
 class UserProfileDetailView(APIView):
     permission_classes = [IsAuthenticated, isCurrentUserOrReadOnly]
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     serializer_class = UserProfileSerializer
     parser_classes = [MultiPartParser, JSONParser]
 
+    @method_decorator(
+        condition(
+            etag_func=user_profile_etag, last_modified_func=user_profile_last_modified
+        )
+    )
     def get(self, request, user_id):
-        user = User.objects.select_related("profile").filter(id=user_id).first()
+        user = requested_user(request, user_id)
         if user:
             user_profile = user.profile
             user_profile_data = self.serializer_class(user_profile).data